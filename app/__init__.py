@@ -1,6 +1,3 @@
-from PySide6.QtWidgets import QApplication
-
-
 class g(object):
 
     log = None
@@ -13,4 +10,5 @@ class g(object):
 
     @classmethod
     def app(cls):
+        from PySide6.QtWidgets import QApplication
         return QApplication.instance()
@@ -0,0 +1,9 @@
+import sys
+import multiprocessing
+
+from .cli import main
+
+if __name__ == '__main__':
+    # Required for post-processing worker processes to start in a frozen build
+    multiprocessing.freeze_support()
+    sys.exit(main())
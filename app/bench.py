@@ -0,0 +1,396 @@
+"""
+End-to-end throughput benchmarks: each scenario runs the whole scan pipeline, by way of
+a headless ScanWorker, against an emulated NAPS2 install (see naps2/emulator.py), and
+measures pages per minute, how long pages spend in each stage, and peak memory use.
+
+    python -m app bench
+    python -m app bench single batch --pages 16
+    python -m app bench --save-baseline
+
+Results are compared with the baseline checked in at bench/baseline.json, if it has the
+same scenario: recorded on a different machine, only the relative change is meaningful.
+--save-baseline records the new results in it, and --max-regression fails the run if any
+result is that much worse than the baseline's (only checked against results recorded on
+a matching machine: same OS, processor, core count and Python version). Scenarios with
+several workers or scanners only show their speedup with several cores, so the baseline
+is best recorded on the kind of machine the stations run on. Runs on Linux only, since
+the emulated NAPS2.Console.exe is a script, and memory use is read from /proc.
+"""
+import os
+import json
+import math
+import time
+import shutil
+import platform
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from . import g
+from .core.naps2.emulator import EmulatorSettings, create_emulated_install, get_emulated_profile_names
+
+DEFAULT_BASELINE_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'bench', 'baseline.json'))
+
+# Percentiles reported for each stage's latency
+PERCENTILES = (50, 90, 99)
+
+# How often memory use is sampled, in seconds
+RSS_SAMPLE_INTERVAL = 0.05
+
+# How long to wait for the worker to find the emulated install, and for any page to move
+# on, before giving up on a scenario
+SETUP_TIMEOUT = 30.0
+STALL_TIMEOUT = 120.0
+
+
+@dataclass
+class Scenario:
+    """
+    A benchmark run: pages scanned in jobs of count pages each (as batch scans, if more
+    than 1), spread across the given number of emulated scanners, and post-processed
+    with the given chain.
+    """
+    name: str
+    description: str
+    pages: int
+    count: int = 1
+    is_front: bool = True
+    scanners: int = 1
+    postprocess: str = ''
+    emulator: EmulatorSettings = field(default_factory=EmulatorSettings)
+
+
+SCENARIOS = [
+    Scenario('single', 'Single-page front scans of four photos each, split and saved with a JPEG copy (300 DPI)', 8,
+             postprocess='split(); encode(png, 3); derive(jpg, 1024, 85)'),
+    Scenario('batch', 'The same, as one batch scan', 8, count=8,
+             postprocess='split(); encode(png, 3); derive(jpg, 1024, 85)'),
+    Scenario('backs', 'Single-page scans of blank backs, stored as placeholders (300 DPI)', 8, is_front=False,
+             postprocess='encode(png, 3)', emulator=EmulatorSettings(content='blank', latency=0.5)),
+    Scenario('scanners', 'Single-page front scans split across two scanners (300 DPI)', 8, scanners=2,
+             postprocess='split(); encode(png, 3); derive(jpg, 1024, 85)'),
+    Scenario('full-res', 'Single-page front scans of four photos each, at full resolution (600 DPI)', 4,
+             postprocess='split(); encode(png, 3); derive(jpg, 2048, 90)', emulator=EmulatorSettings(5100, 6600, latency=3.0)),
+]
+
+
+@dataclass
+class PageTimes:
+    """
+    When one page reached each point in the pipeline, from its ScanJob. Photos split from
+    a page are committed separately; committed_at is when the last one was.
+    """
+    scanner: str
+    queued_at: float
+    scanned_at: float
+    started_at: float
+    processed_at: float
+    committed_at: float
+
+
+class RssSampler:
+    """
+    Samples the memory use of this process and every process under it (post-processing
+    workers and NAPS2), on a background thread, keeping the peaks.
+    """
+
+    def __init__(self):
+        self.peak_main = 0
+        self.peak_total = 0
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(RSS_SAMPLE_INTERVAL)
+
+    def sample(self):
+        rss = {}
+        children = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % name) as fp:
+                    # The command name is in parentheses and may contain spaces
+                    ppid = int(fp.read().rsplit(')', 1)[1].split()[1])
+                with open('/proc/%s/statm' % name) as fp:
+                    rss[int(name)] = int(fp.read().split()[1]) * self._page_size
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(name))
+
+        pid = os.getpid()
+        total, stack = 0, [pid]
+        while stack:
+            process = stack.pop()
+            total += rss.get(process, 0)
+            stack.extend(children.get(process, []))
+        self.peak_main = max(self.peak_main, rss.get(pid, 0))
+        self.peak_total = max(self.peak_total, total)
+
+
+@contextmanager
+def _environ(values: dict[str, str]):
+    # Configuration is read from the environment first, so this overrides fscan.ini
+    # without touching it
+    previous = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    # Nearest-rank: always one of the measured values
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+
+def _summarize(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    summary = {'p%d' % percentile: round(_percentile(values, percentile), 3) for percentile in PERCENTILES}
+    summary['max'] = round(max(values), 3)
+    return summary
+
+
+def get_stage_latencies(pages: list[PageTimes]) -> dict[str, list[float]]:
+    """
+    Returns how long each page spent in each stage, in seconds:
+
+        scan     Since the previous page from the same scanner landed (or, for the
+                 first, since its job was queued)
+        wait     Waiting for a post-processing worker
+        process  Being post-processed
+        commit   Waiting for and being committed to the collection
+        post_scan  From landing to being committed: wait, process and commit together
+    """
+    latencies = {'scan': [], 'wait': [], 'process': [], 'commit': [], 'post_scan': []}
+    last_scanned_at = {}
+    for page in sorted(pages, key=lambda page: page.scanned_at):
+        latencies['scan'].append(page.scanned_at - max(page.queued_at, last_scanned_at.get(page.scanner, 0.0)))
+        last_scanned_at[page.scanner] = page.scanned_at
+        latencies['wait'].append(max(0.0, page.started_at - page.scanned_at))
+        latencies['process'].append(page.processed_at - page.started_at)
+        latencies['commit'].append(page.committed_at - page.processed_at)
+        latencies['post_scan'].append(page.committed_at - page.scanned_at)
+    return latencies
+
+
+def run_scenario(scenario: Scenario, workdir: str) -> dict:
+    """
+    Runs a scenario in a fresh emulated install and collection under workdir, and
+    returns its results.
+    """
+    from PySide6.QtCore import Qt
+    from .state.scan import ScanWorker, ScanWorkerState
+
+    install = create_emulated_install(os.path.join(workdir, 'naps2'), scenario.emulator, scenario.scanners)
+    front_names, back_names = get_emulated_profile_names(scenario.scanners)
+    config = {
+        'NAPS2_APP_DIR': install.app_dir,
+        'NAPS2_DATA_DIR': install.data_dir,
+        'SCAN_PROFILE_NAME_FRONT': '|'.join(front_names),
+        'SCAN_PROFILE_NAME_BACK': '|'.join(back_names),
+        'COLLECTION_DIR': os.path.join(workdir, 'collection'),
+        'SCAN_JOURNAL_DIR': os.path.join(workdir, 'journal'),
+        'POSTPROCESS_CHAIN': scenario.postprocess,
+    }
+
+    pages: dict[tuple[int, Optional[int]], PageTimes] = {}
+    failures = []
+    dropped = []
+    lock = threading.Lock()
+    progress = threading.Event()
+
+    def on_committed(job, item):
+        with lock:
+            key = (job.job_id, job.page)
+            committed_at = time.time()
+            if key in pages:
+                pages[key].committed_at = max(pages[key].committed_at, committed_at)
+            else:
+                pages[key] = PageTimes(job.scanner, job.queued_at, job.scanned_at, job.result.started_at, job.processed_at, committed_at)
+        progress.set()
+
+    def on_failed(job_id, page, reason):
+        with lock:
+            failures.append((job_id, page, reason))
+        progress.set()
+
+    def on_dropped(job):
+        with lock:
+            dropped.append((job.job_id, job.page))
+        progress.set()
+
+    sampler = RssSampler()
+    with _environ(config):
+        worker = ScanWorker()
+        # The worker's signals are emitted from its own thread, and there's no event loop
+        # to deliver them through: handle them right there
+        worker.itemCommitted.connect(on_committed, Qt.DirectConnection)
+        worker.jobFailed.connect(on_failed, Qt.DirectConnection)
+        worker.jobDropped.connect(on_dropped, Qt.DirectConnection)
+        thread = threading.Thread(target=worker.run, name='scan-worker')
+        sampler.start()
+        thread.start()
+        try:
+            deadline = time.time() + SETUP_TIMEOUT
+            while worker.state != ScanWorkerState.READY_TO_SCAN:
+                if time.time() > deadline:
+                    raise RuntimeError('Emulated NAPS2 install at %s was never ready to scan' % install.app_dir)
+                time.sleep(0.05)
+
+            g.log.info("Running scenario '%s': %s..." % (scenario.name, scenario.description))
+            started_at = time.time()
+            job_count = -(-scenario.pages // scenario.count)
+            job_ids = [worker.requestScan(scenario.is_front, scenario.count) for _ in range(job_count)]
+            last_progress_at = time.time()
+            while True:
+                # The pipeline only goes idle just after the last page is committed
+                if progress.wait(0.05):
+                    progress.clear()
+                    last_progress_at = time.time()
+                elif time.time() - last_progress_at > STALL_TIMEOUT:
+                    raise RuntimeError("Scenario '%s' stalled: no page was committed, dropped or failed for %ds" % (scenario.name, STALL_TIMEOUT))
+                with lock:
+                    # A whole job fails with page None; otherwise each page counts once
+                    failed_jobs = set(job_id for job_id, page, _ in failures if page is None)
+                    resolved = len(pages) + len(dropped) + sum(1 for _, page, _ in failures if page is not None)
+                    resolved += sum(scenario.count for job_id in failed_jobs if job_id in job_ids)
+                if resolved >= scenario.pages and worker.pipeline.is_idle:
+                    break
+            finished_at = max([page.committed_at for page in pages.values()] or [time.time()])
+        finally:
+            worker.stop()
+            thread.join()
+            sampler.stop()
+
+    elapsed = finished_at - started_at
+    latencies = get_stage_latencies(list(pages.values()))
+    return {
+        'description': scenario.description,
+        'pages': len(pages),
+        'failed': len(failures),
+        'dropped': len(dropped),
+        'elapsed': round(elapsed, 3),
+        'pages_per_minute': round(len(pages) / elapsed * 60, 2) if elapsed > 0 else None,
+        'latency': {stage: _summarize(values) for stage, values in latencies.items()},
+        'peak_rss_mb': {
+            'main': round(sampler.peak_main / 2 ** 20, 1),
+            'total': round(sampler.peak_total / 2 ** 20, 1),
+        },
+    }
+
+
+def get_machine_info() -> dict:
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+    }
+
+
+def get_machine_differences(machine: Optional[dict]) -> list[str]:
+    """
+    Returns how the machine a baseline result was recorded on (as returned by
+    get_machine_info()) differs from this one, in anything that makes their absolute
+    numbers incomparable: OS, processor, core count or Python version.
+    """
+    def get_key(info):
+        return {
+            'os': info.get('platform', '').split('-')[0],
+            'processor': info.get('processor'),
+            'cpu_count': info.get('cpu_count'),
+            'python': '.'.join(str(info.get('python', '')).split('.')[:2]),
+        }
+    if not machine:
+        return ['machine not recorded']
+    old, new = get_key(machine), get_key(get_machine_info())
+    return ['%s %s (baseline: %s)' % (name, new[name], old[name]) for name in new if new[name] != old[name]]
+
+
+def load_baseline(filepath: str) -> Optional[dict]:
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath) as fp:
+        return json.load(fp)
+
+
+def save_baseline(filepath: str, results: dict[str, dict]):
+    """
+    Records results in the baseline at filepath, replacing those of the same scenarios
+    and keeping the rest. The machine they were recorded on is recorded with them.
+    """
+    baseline = load_baseline(filepath) or {'scenarios': {}}
+    machine = get_machine_info()
+    for name, result in results.items():
+        baseline['scenarios'][name] = dict(result, machine=machine, recorded_at=time.strftime('%Y-%m-%d'))
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'w') as fp:
+        json.dump(baseline, fp, indent=2)
+        fp.write('\n')
+
+
+def compare(result: dict, baseline: dict) -> dict:
+    """
+    Returns the relative change (e.g. 0.1 for 10% higher) of a result's throughput,
+    median and p90 post-scan latency, and peak memory use from the baseline's.
+    """
+    def change(new, old):
+        return round(new / old - 1, 3) if new is not None and old else None
+    return {
+        'pages_per_minute': change(result['pages_per_minute'], baseline.get('pages_per_minute')),
+        'post_scan_p50': change(result['latency']['post_scan'].get('p50'), baseline['latency'].get('post_scan', {}).get('p50')),
+        'post_scan_p90': change(result['latency']['post_scan'].get('p90'), baseline['latency'].get('post_scan', {}).get('p90')),
+        'peak_rss_total': change(result['peak_rss_mb']['total'], baseline['peak_rss_mb'].get('total')),
+    }
+
+
+def get_regressions(change: dict, max_regression: float) -> list[str]:
+    """
+    Returns which of the changes returned by compare() are regressions of more than
+    max_regression (e.g. 0.1 for 10%): lower throughput, or higher latency or memory use.
+    """
+    return [
+        name for name, value in change.items()
+        if value is not None and (-value if name == 'pages_per_minute' else value) > max_regression
+    ]
+
+
+def run_benchmarks(scenarios: list[Scenario], workdir: Optional[str] = None, keep: bool = False) -> dict[str, dict]:
+    """
+    Runs each scenario in turn, in a directory of its own under workdir (by default, a
+    temporary directory that's removed afterwards, unless keep is set).
+    """
+    root = workdir or tempfile.mkdtemp(prefix='fscan-bench-')
+    results = {}
+    try:
+        for scenario in scenarios:
+            scenario_dir = os.path.join(root, scenario.name)
+            shutil.rmtree(scenario_dir, ignore_errors=True)
+            results[scenario.name] = run_scenario(scenario, scenario_dir)
+    finally:
+        if keep or workdir:
+            g.log.info('Benchmark files are in %s.' % root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
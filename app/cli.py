@@ -0,0 +1,276 @@
+"""
+Headless command-line interface, for unattended scan stations and scripted bulk jobs.
+Runs scans through the same pipeline as the GUI, without importing Qt:
+
+    python -m app scan --count 0 --output "scans/{date}/{seq:05d}.{ext}"
+    python -m app scan --back --collection D:\\Photos\\Box12
+    python -m app profiles
+    python -m app bench --save-baseline
+
+Progress is written to stdout as JSON, one event per line; log output goes to stderr.
+Exits with status 0 if every page was committed (or dropped as blank), 1 if any failed
+(or, for bench, if a result regressed by more than --max-regression), and 130 if
+interrupted.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from dataclasses import replace
+
+from . import g
+from .config import get_config_var
+from .loggers import ConsoleLogger
+from .core.profiling import PROFILE_KINDS, profiler
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_INTERRUPTED = 130
+
+
+class EventWriter:
+    """
+    Writes events to a stream as JSON lines, from any thread.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def write(self, event: str, **fields):
+        line = json.dumps(dict(event=event, time=round(time.time(), 3), **fields))
+        with self._lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+def _resolve_install():
+    from .core.naps2.install import get_configured_naps2_install
+    install = get_configured_naps2_install()
+    if not install:
+        g.log.error('NAPS2 is not configured: set NAPS2_APP_DIR and NAPS2_DATA_DIR, or run the GUI once to set it up.')
+    return install
+
+
+def _resolve_scanners(args, install):
+    """
+    Returns a Scanner for each --profile given, or for each configured profile pair if
+    none were. Each gets its own scan thread, so scans are spread across them.
+    """
+    from .core.pipeline import Scanner
+    from .core.naps2.profile import ProfileConfig, get_profile_configs, load_naps2_profiles
+    if args.profile:
+        profiles = {profile.display_name: profile for profile in load_naps2_profiles(install.data_dir)}
+        scanners = []
+        for profile_name in args.profile:
+            profile = profiles.get(profile_name)
+            if not profile:
+                g.log.error("No profile named '%s' exists in the configured NAPS2 installation." % profile_name)
+                return None
+            # The same profile serves for both sides: only the side being scanned is used
+            scanners.append(Scanner.from_profile_config(install, ProfileConfig(profile_name, profile_name, profile, profile)))
+        return scanners
+
+    profile_configs = get_profile_configs(install.data_dir)
+    if not profile_configs:
+        g.log.error('No scan profiles configured: pass --profile, or set SCAN_PROFILE_NAME_FRONT and SCAN_PROFILE_NAME_BACK.')
+        return None
+    return [Scanner.from_profile_config(install, config) for config in profile_configs]
+
+
+def _open_output(args):
+    from .core.collection import Collection
+    from .core.outputtemplate import TemplateOutput
+    if args.output:
+        try:
+            return TemplateOutput(args.output, args.start)
+        except ValueError as exc:
+            g.log.error('Invalid --output: %s' % exc)
+            return None
+
+    collection_dir = args.collection or get_config_var('COLLECTION_DIR')
+    if not collection_dir:
+        g.log.error('Nowhere to put scans: pass --output or --collection, or set COLLECTION_DIR.')
+        return None
+    return Collection(collection_dir)
+
+
+def cmd_scan(args, events: EventWriter) -> int:
+    if args.postprocess is not None:
+        os.environ['POSTPROCESS_CHAIN'] = args.postprocess
+
+    install = _resolve_install()
+    if not install:
+        return EXIT_FAILED
+    scanners = _resolve_scanners(args, install)
+    if not scanners:
+        return EXIT_FAILED
+    output = _open_output(args)
+    if not output:
+        return EXIT_FAILED
+
+    from .core.metrics import MetricsExporter, metrics
+    from .core.pipeline import ScanPipeline
+    counts = {'committed': 0, 'failed': 0, 'dropped': 0}
+
+    def on_progress(job, progress):
+        events.write('progress', job=job.job_id, scanner=job.scanner, page=progress.page, kind=progress.kind.name.lower(), message=progress.message)
+
+    def on_committed(job, item):
+        counts['committed'] += 1
+        image = item.front if job.is_front else item.back
+        events.write('committed', job=job.job_id, scanner=job.scanner, page=job.page, photo=job.region, seq=item.seq, side=image.side, path=output.get_abspath(image), sha256=image.sha256, width=image.width, height=image.height, duplicate_of=image.duplicate_of, derivatives=output.get_derivative_abspaths(image))
+
+    def on_failed(job, reason):
+        counts['failed'] += 1
+        events.write('failed', job=job.job_id, page=job.page, error=reason)
+
+    def on_dropped(job):
+        counts['dropped'] += 1
+        events.write('dropped', job=job.job_id, scanner=job.scanner, page=job.page)
+
+    started_at = time.time()
+    pipeline = ScanPipeline(on_progress=on_progress, on_committed=on_committed, on_failed=on_failed, on_dropped=on_dropped)
+    pipeline.set_scanners(scanners)
+    exporter = MetricsExporter.from_config(metrics)
+    if exporter:
+        exporter.start()
+    pipeline.start()
+    interrupted = False
+    try:
+        for _ in range(args.repeat):
+            job = pipeline.submit(not args.back, output, args.count)
+            events.write('queued', job=job.job_id, side='front' if job.is_front else 'back', count=args.count)
+        while not pipeline.is_idle:
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        interrupted = True
+        g.log.warning('Interrupted; cancelling scans and finishing any pages already scanned...')
+        pipeline.cancel()
+    finally:
+        pipeline.stop()
+        if exporter:
+            exporter.stop()
+
+    events.write('done', committed=counts['committed'], failed=counts['failed'], dropped=counts['dropped'], elapsed=round(time.time() - started_at, 3))
+    if interrupted:
+        return EXIT_INTERRUPTED
+    return EXIT_FAILED if counts['failed'] else EXIT_OK
+
+
+def cmd_profiles(args, events: EventWriter) -> int:
+    from .core.naps2.profile import load_naps2_profiles
+    install = _resolve_install()
+    if not install:
+        return EXIT_FAILED
+    for profile in load_naps2_profiles(install.data_dir):
+        events.write(
+            'profile',
+            name=profile.display_name,
+            device=profile.device.name if profile.device else None,
+            driver=profile.driver_name,
+            dpi=profile.dpi,
+            bit_depth=profile.bit_depth,
+            page_size=profile.page_size,
+            paper_source=profile.paper_source,
+            is_default=profile.is_default,
+        )
+    return EXIT_OK
+
+
+def cmd_bench(args, events: EventWriter) -> int:
+    from .bench import SCENARIOS, DEFAULT_BASELINE_PATH, compare, get_machine_differences, get_regressions, load_baseline, run_benchmarks, save_baseline
+    scenarios = [scenario for scenario in SCENARIOS if not args.scenarios or scenario.name in args.scenarios]
+    if args.pages:
+        scenarios = [replace(scenario, pages=args.pages, count=min(scenario.count, args.pages)) for scenario in scenarios]
+
+    baseline_path = args.baseline or DEFAULT_BASELINE_PATH
+    baseline = load_baseline(baseline_path) or {'scenarios': {}}
+    try:
+        results = run_benchmarks(scenarios, args.workdir, args.keep)
+    except RuntimeError as exc:
+        g.log.error('Benchmark failed: %s' % exc)
+        return EXIT_FAILED
+
+    regressed = False
+    for name, result in results.items():
+        previous = baseline['scenarios'].get(name)
+        change = compare(result, previous) if previous else None
+        events.write('result', scenario=name, **result, change=change)
+        g.log.info('%s: %.1f pages/min; post-scan latency p50 %.2fs, p90 %.2fs; peak RSS %.0f MB (%.0f MB in this process)%s' % (
+            name, result['pages_per_minute'] or 0, result['latency']['post_scan'].get('p50', 0), result['latency']['post_scan'].get('p90', 0),
+            result['peak_rss_mb']['total'], result['peak_rss_mb']['main'],
+            ('; %+.0f%% pages/min vs. baseline' % (change['pages_per_minute'] * 100)) if change and change['pages_per_minute'] is not None else '',
+        ))
+        if change and args.max_regression is not None:
+            differences = get_machine_differences(previous.get('machine'))
+            regressions = get_regressions(change, args.max_regression / 100) if not differences else []
+            if differences:
+                g.log.warning('%s: not checking for regressions, since the baseline was recorded on a different machine: %s' % (name, '; '.join(differences)))
+            if regressions:
+                g.log.error('%s: regressed by more than %g%% vs. baseline: %s' % (
+                    name, args.max_regression, ', '.join('%s %+.0f%%' % (metric, change[metric] * 100) for metric in regressions)
+                ))
+                regressed = True
+    if args.save_baseline:
+        save_baseline(baseline_path, results)
+        g.log.info('Saved baseline to %s.' % baseline_path)
+    return EXIT_FAILED if regressed or any(result['failed'] for result in results.values()) else EXIT_OK
+
+
+COMMANDS = {
+    'scan': cmd_scan,
+    'profiles': cmd_profiles,
+    'bench': cmd_bench,
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='fscan', description='Scan with NAPS2 without the GUI.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log debug output (including NAPS2 output) to stderr')
+    parser.add_argument('--profiler', choices=PROFILE_KINDS, help='profile the whole command, writing the profile to ~/.FScan/profiles (default: PROFILER)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan = subparsers.add_parser('scan', help='run one or more scans')
+    scan.add_argument('--back', action='store_true', help='scan backs (with the back profile) rather than fronts')
+    scan.add_argument('--profile', action='append', help='NAPS2 profile to scan with; repeat to scan on several scanners at once (default: SCAN_PROFILE_NAME_FRONT or SCAN_PROFILE_NAME_BACK)')
+    scan.add_argument('-n', '--count', type=int, default=1, help='pages per scan; 0 to scan every page in the feeder (default: 1)')
+    scan.add_argument('--repeat', type=int, default=1, help='number of scans to run back-to-back (default: 1)')
+    scan.add_argument('--postprocess', help='post-processing chain, overriding POSTPROCESS_CHAIN')
+    target = scan.add_mutually_exclusive_group()
+    target.add_argument('-o', '--output', help='output path template, e.g. "scans/{date}/{seq:05d}_{side}.{ext}"; fields: seq, side, profile, date, time, ext')
+    target.add_argument('--collection', help='collection directory to commit scans to (default: COLLECTION_DIR)')
+    scan.add_argument('--start', type=int, default=1, help='first {seq} number, with --output (default: 1)')
+
+    subparsers.add_parser('profiles', help='list the NAPS2 profiles that are available')
+
+    bench = subparsers.add_parser('bench', help='measure pipeline throughput against an emulated scanner (Linux only)')
+    bench.add_argument('scenarios', nargs='*', help='scenarios to run (default: all); see app/bench.py')
+    bench.add_argument('--pages', type=int, help='pages to scan in each scenario, overriding its default')
+    bench.add_argument('--baseline', help='baseline results to compare with (default: bench/baseline.json)')
+    bench.add_argument('--save-baseline', action='store_true', help='record the results in the baseline')
+    bench.add_argument('--max-regression', type=float, metavar='PERCENT', help='fail if throughput, post-scan latency or peak memory is more than PERCENT worse than a baseline recorded on a matching machine')
+    bench.add_argument('--workdir', help='directory to scan into, which is kept (default: a temporary directory)')
+    bench.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    log = ConsoleLogger.new('fscan', stream=sys.stderr, streamLevel=logging.DEBUG if args.verbose else logging.INFO)
+    g.init(log, None)
+
+    events = EventWriter(sys.stdout)
+    if args.profiler:
+        profiler.start(args.profiler, args.command)
+    else:
+        profiler.start_from_config(args.command)
+    try:
+        with profiler.profile():
+            return COMMANDS[args.command](args, events)
+    finally:
+        profiler.stop()
@@ -0,0 +1,113 @@
+"""
+Detection of blank pages, for the backs of photos: most have nothing on them, and
+aren't worth storing or processing at full resolution.
+
+A page is classified from a small downsampled copy, using three measures that each
+catch a different kind of marking:
+
+    texture      Standard deviation of what's left once the paper's overall tone and
+                 any gradual shading are subtracted: catches printing and patterns
+    edges        Fraction of pixels on an edge: catches handwriting and stamps
+    ink          Fraction of pixels far darker or lighter than the paper: catches
+                 small marks, like a date in one corner, that barely move the others
+
+A page is blank only if all three are under their thresholds.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+from ..config import get_config_var
+from ..lazyimport import lazy_import
+from .detect import downsample
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+BLANK_ACTIONS = ('keep', 'placeholder', 'drop')
+
+# Longest side of the copy of the page that's classified, in pixels (at most)
+CLASSIFY_SIZE = 256
+
+# Fraction of each side that's trimmed before classifying, to ignore shadows and the
+# lid at the edges of the page
+TRIM_FRACTION = 0.05
+
+# Difference from the paper's tone that counts as ink
+INK_THRESHOLD = 40
+
+
+@dataclass
+class BlankStats:
+    texture: float
+    edges: float
+    ink: float
+
+
+@dataclass
+class BlankCheck:
+    """
+    Thresholds for deciding that a page is blank, and what to do with blank pages:
+    'keep' them as they are, store a tiny 'placeholder' image in their place, or 'drop'
+    them altogether.
+    """
+    action: str = 'placeholder'
+    max_texture: float = 3.0
+    max_edges: float = 0.0005
+    max_ink: float = 0.0005
+    placeholder_size: int = 64
+
+    @classmethod
+    def from_config(cls) -> BlankCheck:
+        """
+        Reads BLANK_BACK_ACTION, BLANK_MAX_TEXTURE, BLANK_MAX_EDGES, BLANK_MAX_INK and
+        BLANK_PLACEHOLDER_SIZE (see fscan.ini). Raises ValueError if any are invalid.
+        """
+        defaults = cls()
+        action = get_config_var('BLANK_BACK_ACTION', defaults.action).strip().lower()
+        if action not in BLANK_ACTIONS:
+            raise ValueError("BLANK_BACK_ACTION must be one of %s, not '%s'" % (', '.join(BLANK_ACTIONS), action))
+        return cls(
+            action,
+            float(get_config_var('BLANK_MAX_TEXTURE', str(defaults.max_texture))),
+            float(get_config_var('BLANK_MAX_EDGES', str(defaults.max_edges))),
+            float(get_config_var('BLANK_MAX_INK', str(defaults.max_ink))),
+            int(get_config_var('BLANK_PLACEHOLDER_SIZE', str(defaults.placeholder_size))),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.action != 'keep'
+
+    def is_blank(self, image: np.ndarray) -> bool:
+        stats = measure_blankness(image)
+        return stats.texture <= self.max_texture and stats.edges <= self.max_edges and stats.ink <= self.max_ink
+
+    def make_placeholder(self, image: np.ndarray) -> np.ndarray:
+        small, _ = downsample(image, self.placeholder_size)
+        h, w = image.shape[:2]
+        scale = self.placeholder_size / max(h, w)
+        return cv2.resize(small, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def measure_blankness(image: np.ndarray) -> BlankStats:
+    """
+    Measures how much is on a page (BGR or grayscale), on a copy no more than
+    CLASSIFY_SIZE pixels across.
+    """
+    small, _ = downsample(image, CLASSIFY_SIZE)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+    h, w = gray.shape
+    dy, dx = int(h * TRIM_FRACTION), int(w * TRIM_FRACTION)
+    gray = gray[dy:h - dy, dx:w - dx]
+
+    # Subtract the paper's tone, shading and all, as a heavily blurred copy of itself
+    paper = cv2.GaussianBlur(gray, (0, 0), max(gray.shape) / 16)
+    residual = gray.astype(np.float32) - paper.astype(np.float32)
+
+    edges = cv2.Canny(gray, 30, 90)
+    return BlankStats(
+        texture=float(residual.std()),
+        edges=float(np.count_nonzero(edges)) / edges.size,
+        ink=float(np.count_nonzero(np.abs(residual) > INK_THRESHOLD)) / residual.size,
+    )
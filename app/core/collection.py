@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from .duplicates import DEFAULT_MAX_DISTANCE, DuplicateIndex, to_signed, to_unsigned
+
+INDEX_FILENAME = 'fscan.db'
+STAGING_DIRNAME = '.staging'
+ITEMS_DIRNAME = 'items'
+ITEMS_PER_SUBDIR = 1000
+
+# Pass as pair_seq to add_image() to have a back start an item of its own
+UNPAIRED = 0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL UNIQUE,
+    created_at REAL NOT NULL,
+    has_back INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS items_created_at ON items (created_at);
+CREATE INDEX IF NOT EXISTS items_has_back_seq ON items (has_back, seq);
+
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    item_id INTEGER NOT NULL REFERENCES items (id),
+    side TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    profile_name TEXT NOT NULL,
+    scanned_at REAL NOT NULL,
+    quad TEXT,
+    source TEXT,
+    blank INTEGER NOT NULL DEFAULT 0,
+    dhash INTEGER,
+    duplicate_of INTEGER,
+    derivatives TEXT,
+    UNIQUE (item_id, side)
+);
+CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256);
+'''
+
+# Columns added since the first version of the schema, added to older databases as
+# they're opened
+MIGRATIONS = [
+    ('images', 'quad', 'TEXT'),
+    ('images', 'source', 'TEXT'),
+    ('images', 'blank', 'INTEGER NOT NULL DEFAULT 0'),
+    ('images', 'dhash', 'INTEGER'),
+    ('images', 'duplicate_of', 'INTEGER'),
+    ('images', 'derivatives', 'TEXT'),
+]
+
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS images_side_source ON images (side, source);
+'''
+
+
+@dataclass
+class CollectionImage:
+    """
+    One side of a collection item. path is relative to the collection directory.
+
+    If the image was split from a scan of several photos, quad holds its corners in
+    that scan, and source identifies the scan: images with the same source were on the
+    glass together. A blank image is a tiny placeholder for a page that had nothing
+    on it. dhash is the image's perceptual hash, and duplicate_of the seq of the item
+    it looked like a rescan of when it was added, if any. derivatives are the paths of
+    smaller copies of the image, for viewing, written alongside it.
+    """
+    side: str
+    path: str
+    sha256: str
+    width: int
+    height: int
+    profile_name: str
+    scanned_at: float
+    quad: Optional[list[list[float]]] = None
+    source: Optional[str] = None
+    blank: bool = False
+    dhash: Optional[int] = None
+    duplicate_of: Optional[int] = None
+    derivatives: Optional[list[str]] = None
+
+
+@dataclass
+class CollectionItem:
+    """
+    A single physical item in a collection (e.g. a photo), identified by a sequence
+    number, with a scanned image of its front and/or back.
+    """
+    id: int
+    seq: int
+    created_at: float
+    front: Optional[CollectionImage] = None
+    back: Optional[CollectionImage] = None
+
+
+class Collection:
+    """
+    A directory of scanned items, indexed in an SQLite database that lives alongside
+    them. Every lookup goes through an index, so opening a collection and finding the
+    next sequence number or the most recent items is cheap no matter how many items
+    it holds. Image files are spread across numbered subdirectories to keep each
+    directory a manageable size.
+
+    A collection can be used from any thread; access to the database is serialized.
+    """
+
+    def __init__(self, dirpath: str):
+        self.dirpath = os.path.normpath(dirpath)
+        if not os.path.isdir(self.dirpath):
+            os.makedirs(self.dirpath)
+
+        self._lock = threading.Lock()
+        self._duplicate_index = None
+        self._db = sqlite3.connect(os.path.join(self.dirpath, INDEX_FILENAME), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._migrate()
+        self._db.executescript(INDEXES)
+
+    def _migrate(self):
+        for table, column, column_type in MIGRATIONS:
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(%s)' % table)]
+            if column not in columns:
+                self._db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, column_type))
+
+    @property
+    def staging_dir(self) -> str:
+        """
+        Directory where new scans are written before they're committed to the
+        collection: on the same volume, so that committing is just a rename.
+        """
+        return os.path.join(self.dirpath, STAGING_DIRNAME)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get_abspath(self, image: CollectionImage) -> str:
+        return os.path.join(self.dirpath, image.path)
+
+    def get_derivative_abspaths(self, image: CollectionImage) -> list[str]:
+        return [os.path.join(self.dirpath, path) for path in image.derivatives or []]
+
+    def next_seq(self) -> int:
+        with self._lock:
+            return self._next_seq()
+
+    def _next_seq(self) -> int:
+        row = self._db.execute('SELECT MAX(seq) FROM items').fetchone()
+        return (row[0] or 0) + 1
+
+    def get_item(self, seq: int) -> Optional[CollectionItem]:
+        with self._lock:
+            row = self._db.execute('SELECT id, seq, created_at FROM items WHERE seq = ?', (seq,)).fetchone()
+            return self._load_item(row) if row else None
+
+    def list_recent(self, limit: int) -> list[CollectionItem]:
+        with self._lock:
+            rows = self._db.execute('SELECT id, seq, created_at FROM items ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+            return [self._load_item(row) for row in rows]
+
+    def has_image(self, sha256: str) -> bool:
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM images WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone() is not None
+
+    def _load_item(self, row) -> CollectionItem:
+        item = CollectionItem(*row)
+        for image_row in self._db.execute('SELECT side, path, sha256, width, height, profile_name, scanned_at, quad, source, blank, dhash, duplicate_of, derivatives FROM images WHERE item_id = ?', (item.id,)):
+            side, path, sha256, width, height, profile_name, scanned_at, quad, source, blank, dhash, duplicate_of, derivatives = image_row
+            image = CollectionImage(
+                side, path, sha256, width, height, profile_name, scanned_at,
+                json.loads(quad) if quad else None, source, bool(blank), to_unsigned(dhash) if dhash is not None else None, duplicate_of,
+                json.loads(derivatives) if derivatives else None,
+            )
+            if image.side == 'front':
+                item.front = image
+            else:
+                item.back = image
+        return item
+
+    def find_duplicates(self, dhash: int, max_distance: int = DEFAULT_MAX_DISTANCE) -> list[tuple[int, int]]:
+        """
+        Returns (seq, distance) for each item with a front whose perceptual hash is within
+        max_distance bits of dhash, nearest first. The index of hashes is loaded on
+        first use, and kept up to date as images are added.
+        """
+        with self._lock:
+            if self._duplicate_index is None:
+                rows = self._db.execute("SELECT items.seq, images.dhash FROM images JOIN items ON items.id = images.item_id WHERE images.side = 'front' AND images.dhash IS NOT NULL").fetchall()
+                self._duplicate_index = DuplicateIndex.build([(seq, to_unsigned(dhash)) for seq, dhash in rows])
+            index = self._duplicate_index
+        return index.find(dhash, max_distance)
+
+    def get_unpaired_fronts(self) -> list[tuple[int, list[list[float]]]]:
+        """
+        Returns the seq and quad of each front from the most recent front scan, if it was
+        split into photos, that doesn't have a back yet: the candidates for pairing the
+        next back scan with.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT source FROM images WHERE side = 'front' ORDER BY id DESC LIMIT 1").fetchone()
+            if not row or not row[0]:
+                return []
+            rows = self._db.execute(
+                "SELECT items.seq, images.quad FROM images JOIN items ON items.id = images.item_id WHERE images.side = 'front' AND images.source = ? AND items.has_back = 0 ORDER BY items.seq",
+                (row[0],)
+            ).fetchall()
+            return [(seq, json.loads(quad)) for seq, quad in rows if quad]
+
+    def add_image(self, filepath: str, is_front: bool, sha256: str, width: int, height: int, profile_name: str, scanned_at: float, quad: Optional[list[list[float]]] = None, source: Optional[str] = None, pair_seq: Optional[int] = None, blank: bool = False, dhash: Optional[int] = None, duplicate_of: Optional[int] = None, derivative_filepaths: Optional[list[str]] = None) -> CollectionItem:
+        """
+        Moves the image at filepath, and any copies of it derived for viewing at
+        derivative_filepaths, into the collection and records it in the index. A
+        front image always starts a new item. A back image is attached to the item
+        numbered pair_seq if given (or starts a new item, if that's UNPAIRED), and
+        otherwise to the most recent item that doesn't yet have a back, or starts a new
+        item if there is none.
+        """
+        side = 'front' if is_front else 'back'
+        with self._lock, self._db:
+            item_row = None
+            if not is_front and pair_seq is None:
+                item_row = self._db.execute('SELECT id, seq, created_at FROM items WHERE has_back = 0 ORDER BY seq DESC LIMIT 1').fetchone()
+            elif not is_front and pair_seq != UNPAIRED:
+                item_row = self._db.execute('SELECT id, seq, created_at FROM items WHERE seq = ? AND has_back = 0', (pair_seq,)).fetchone()
+            if item_row is None:
+                seq, created_at = self._next_seq(), time.time()
+                cursor = self._db.execute('INSERT INTO items (seq, created_at) VALUES (?, ?)', (seq, created_at))
+                item_row = (cursor.lastrowid, seq, created_at)
+            item_id, seq, _ = item_row
+
+            relpath = os.path.join(ITEMS_DIRNAME, '%03d' % (seq // ITEMS_PER_SUBDIR), '%06d_%s%s' % (seq, side, os.path.splitext(filepath)[1]))
+            # Derived copies keep whatever their filenames add to the image's (e.g. _1024.jpg)
+            stem = os.path.splitext(filepath)[0]
+            derivative_relpaths = [os.path.splitext(relpath)[0] + x[len(stem):] for x in derivative_filepaths or []]
+            self._db.execute(
+                'INSERT INTO images (item_id, side, path, sha256, width, height, profile_name, scanned_at, quad, source, blank, dhash, duplicate_of, derivatives) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (item_id, side, relpath, sha256, width, height, profile_name, scanned_at, json.dumps(quad) if quad else None, source, int(blank), to_signed(dhash) if dhash is not None else None, duplicate_of,
+                 json.dumps(derivative_relpaths) if derivative_relpaths else None)
+            )
+            if not is_front:
+                self._db.execute('UPDATE items SET has_back = 1 WHERE id = ?', (item_id,))
+
+            # Move the file into place before the transaction commits, so the index never
+            # refers to an image that doesn't exist
+            abspath = os.path.join(self.dirpath, relpath)
+            os.makedirs(os.path.dirname(abspath), exist_ok=True)
+            for derivative_filepath, derivative_relpath in zip(derivative_filepaths or [], derivative_relpaths):
+                os.replace(derivative_filepath, os.path.join(self.dirpath, derivative_relpath))
+            os.replace(filepath, abspath)
+
+            if is_front and dhash is not None and self._duplicate_index is not None:
+                self._duplicate_index.add(seq, dhash)
+            return self._load_item(item_row)
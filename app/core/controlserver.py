@@ -0,0 +1,411 @@
+import re
+import json
+import time
+import hmac
+import asyncio
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from typing import Optional, Protocol
+
+from .. import g
+
+MAX_BODY_BYTES = 64 * 1024
+MAX_POLL_SECONDS = 60.0
+REQUEST_TIMEOUT_SECONDS = 10.0
+EVENT_LOG_LENGTH = 1000
+JOB_HISTORY_LENGTH = 1000
+
+HTTP_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class ScanController(Protocol):
+    """
+    What the control server needs from the application in order to drive it. Every
+    method is called on the server's own thread, and must not block.
+    """
+
+    def submit_scan(self, is_front: bool, count: int) -> int: ...
+    def cancel(self): ...
+    def configure(self): ...
+    def set_collection(self, dirpath: str): ...
+    def get_status(self) -> dict: ...
+
+
+class ApiError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class EventLog:
+    """
+    Numbered history of the most recent events, which clients can wait on. Only used
+    from the server's event loop.
+    """
+
+    def __init__(self, maxlen: int = EVENT_LOG_LENGTH):
+        self._events = deque(maxlen=maxlen)
+        self._next_seq = 1
+        self._waiters = set()
+
+    @property
+    def last_seq(self) -> int:
+        return self._next_seq - 1
+
+    def append(self, event: dict):
+        event['seq'] = self._next_seq
+        self._next_seq += 1
+        self._events.append(event)
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    def since(self, seq: int) -> list[dict]:
+        return [event for event in self._events if event['seq'] > seq]
+
+    async def wait(self, seq: int, timeout: float) -> list[dict]:
+        """
+        Returns the events after seq, waiting up to timeout seconds for one to arrive if
+        there are none yet.
+        """
+        events = self.since(seq)
+        if events or timeout <= 0:
+            return events
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._waiters.discard(waiter)
+        return self.since(seq)
+
+
+class JobRecord:
+    """
+    What the server knows about one scan job, pieced together from the events it's
+    seen. A job is finished once the scan stage is done with it and every page that
+    landed has been committed or has failed. Pages are counted as they land, rather than
+    from NAPS2's progress output, which isn't guaranteed to mention every page. A page
+    that was split into several photos only counts once every one of them has been
+    committed or has failed; a page that was dropped as blank counts right away.
+    """
+
+    def __init__(self, job_id: int, side: str, count: int):
+        self.job_id = job_id
+        self.side = side
+        self.count = count
+        self.state = 'submitted'
+        self.error = None
+        self.scanned = False
+        self.pages_scanned = 0
+        self.photos = {}    # Page number -> photos it was split into, if more than one
+        self.resolved = {}  # Page number -> photos committed or failed so far
+        self.items = []
+        self.failures = []
+        self.dropped = []
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.finished = asyncio.get_running_loop().create_future()
+
+    def on_event(self, event: dict):
+        kind = event['type']
+        if kind == 'queued':
+            self.state = 'queued'
+        elif kind == 'progress':
+            self.state = 'processing' if self.scanned or event['kind'] == 'done' else 'scanning'
+        elif kind == 'scanned':
+            self.scanned = True
+            self.pages_scanned = event['pages']
+            self.state = 'processing'
+        elif kind == 'split':
+            self.photos[event['page']] = event['photos']
+        elif kind == 'committed':
+            self.items.append(event['item'])
+            self._resolve(event['page'])
+        elif kind == 'dropped':
+            self.dropped.append(event['page'])
+            self.resolved[event['page']] = self.photos.get(event['page'], 1)
+        elif kind == 'failed':
+            self.failures.append({'page': event['page'], 'error': event['error']})
+            if event['page'] is None:
+                # The job as a whole failed (or was cancelled): no more pages are coming,
+                # though any that already landed may still be on their way. A single-page
+                # job has no page number, so this is also its page failing
+                self.scanned = True
+                self.error = event['error']
+                if self.count == 1:
+                    self._resolve(None)
+            else:
+                self._resolve(event['page'])
+
+        pages_resolved = sum(1 for page, resolved in self.resolved.items() if resolved >= self.photos.get(page, 1))
+        if self.scanned and pages_resolved >= self.pages_scanned:
+            self.state = 'failed' if self.error or (self.failures and not self.items) else 'completed'
+            self.finished_at = time.time()
+            if not self.finished.done():
+                self.finished.set_result(None)
+
+    def _resolve(self, page: Optional[int]):
+        self.resolved[page] = self.resolved.get(page, 0) + 1
+
+    def to_dict(self) -> dict:
+        return {
+            'job': self.job_id,
+            'side': self.side,
+            'count': self.count,
+            'state': self.state,
+            'error': self.error,
+            'items': self.items,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class ControlServer:
+    """
+    Local HTTP API for driving scans from another program, e.g. a tool that coordinates
+    several scan stations. Runs an asyncio event loop on its own thread, so any number
+    of clients can be connected (and waiting on long polls) without holding up the GUI
+    or the scan worker. Requests and responses are JSON:
+
+        GET  /status               Scanner state, configuration and queue depths
+        POST /jobs                 Queue a scan: {"side": "front"|"back", "count": 1}
+        GET  /jobs                 Recent jobs
+        GET  /jobs/<id>?wait=<s>   A job's status and results, optionally waiting up to
+                                   <s> seconds for it to finish
+        POST /cancel               Cancel the current scan and discard queued ones
+        POST /configure            Re-detect the NAPS2 installation and profiles, once
+                                   any queued scans are done (never prompts)
+        POST /collection           Switch collections: {"path": "..."}
+        GET  /events?since=<n>&wait=<s>
+                                   Events after sequence number <n>, waiting up to <s>
+                                   seconds for one to arrive (a long poll)
+
+    If a token is set, every request must carry it as 'Authorization: Bearer <token>'.
+    publish() may be called from any thread to add an event.
+    """
+
+    def __init__(self, controller: ScanController, host: str, port: int, token: Optional[str] = None):
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.token = token
+        self.events = None
+        self.jobs = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+        self._routes = [
+            ('GET', re.compile(r'^/status$'), self._get_status),
+            ('GET', re.compile(r'^/jobs$'), self._get_jobs),
+            ('POST', re.compile(r'^/jobs$'), self._post_job),
+            ('GET', re.compile(r'^/jobs/(\d+)$'), self._get_job),
+            ('POST', re.compile(r'^/cancel$'), self._post_cancel),
+            ('POST', re.compile(r'^/configure$'), self._post_configure),
+            ('POST', re.compile(r'^/collection$'), self._post_collection),
+            ('GET', re.compile(r'^/events$'), self._get_events),
+        ]
+
+    def start(self):
+        assert self._thread is None
+        self._thread = threading.Thread(target=self._run, name='fscan-control-server', daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self):
+        if self._thread and self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def publish(self, event_type: str, **fields):
+        if self._loop:
+            event = dict(type=event_type, time=round(time.time(), 3), **fields)
+            self._loop.call_soon_threadsafe(self._append_event, event)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self.events = EventLog()
+        try:
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle_connection, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            g.log.info('Control API listening on http://%s:%d/' % (self.host, self.port))
+        except OSError as exc:
+            g.log.error('Failed to start control API on %s:%d: %s' % (self.host, self.port, exc))
+            self._loop = None
+            self._started.set()
+            return
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    def _append_event(self, event: dict):
+        job = self.jobs.get(event.get('job'))
+        if job:
+            job.on_event(event)
+        self.events.append(event)
+
+    def _add_job(self, job: JobRecord):
+        self.jobs[job.job_id] = job
+        while len(self.jobs) > JOB_HISTORY_LENGTH:
+            del self.jobs[next(iter(self.jobs))]
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, path, query, headers, body = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT_SECONDS)
+                status, payload = await self._dispatch(method, path, query, headers, body)
+            except ApiError as exc:
+                status, payload = exc.status, {'error': exc.message}
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return
+            except Exception as exc:
+                g.log.error('Control API request failed: %s' % exc)
+                status, payload = 500, {'error': str(exc)}
+
+            data = json.dumps(payload).encode('utf-8')
+            writer.write((
+                'HTTP/1.1 %d %s\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n\r\n' % (status, HTTP_REASONS.get(status, ''), len(data))
+            ).encode('latin-1') + data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        parts = request_line.split(' ')
+        if len(parts) != 3:
+            raise ApiError(400, 'Malformed request line')
+        method, target, _ = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        value = headers.get('content-length', '0') or '0'
+        try:
+            length = int(value)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise ApiError(400, 'Invalid Content-Length: %s' % value)
+        if length > MAX_BODY_BYTES:
+            raise ApiError(413, 'Request body is too large')
+        body = await reader.readexactly(length) if length else b''
+
+        url = urlsplit(target)
+        return method.upper(), url.path, parse_qs(url.query), headers, body
+
+    async def _dispatch(self, method, path, query, headers, body):
+        if self.token:
+            supplied = headers.get('authorization', '')
+            if not hmac.compare_digest(supplied.encode('utf-8'), ('Bearer %s' % self.token).encode('utf-8')):
+                raise ApiError(401, 'Missing or invalid token')
+
+        path_matched = False
+        for route_method, regex, handler in self._routes:
+            match = regex.match(path)
+            if not match:
+                continue
+            path_matched = True
+            if route_method == method:
+                return await handler(match, query, self._parse_body(body))
+        if path_matched:
+            raise ApiError(405, 'Method not allowed')
+        raise ApiError(404, 'No such endpoint')
+
+    @staticmethod
+    def _parse_body(body: bytes) -> dict:
+        if not body:
+            return {}
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise ApiError(400, 'Request body is not valid JSON')
+        if not isinstance(data, dict):
+            raise ApiError(400, 'Request body must be a JSON object')
+        return data
+
+    @staticmethod
+    def _get_float(query: dict, name: str, default: float) -> float:
+        try:
+            return float(query[name][0]) if name in query else default
+        except ValueError:
+            raise ApiError(400, 'Invalid value for %s' % name)
+
+    async def _get_status(self, match, query, data):
+        status = self.controller.get_status()
+        status['last_event'] = self.events.last_seq
+        return 200, status
+
+    async def _get_jobs(self, match, query, data):
+        return 200, {'jobs': [job.to_dict() for job in self.jobs.values()]}
+
+    async def _post_job(self, match, query, data):
+        side = data.get('side', 'front')
+        count = data.get('count', 1)
+        if side not in ('front', 'back'):
+            raise ApiError(400, "side must be 'front' or 'back'")
+        if not isinstance(count, int) or count < 0:
+            raise ApiError(400, 'count must be a non-negative integer (0 scans every page in the feeder)')
+
+        job_id = self.controller.submit_scan(side == 'front', count)
+        job = JobRecord(job_id, side, count)
+        self._add_job(job)
+        return 202, job.to_dict()
+
+    async def _get_job(self, match, query, data):
+        job = self.jobs.get(int(match.group(1)))
+        if not job:
+            raise ApiError(404, 'No such job')
+        wait = min(self._get_float(query, 'wait', 0.0), MAX_POLL_SECONDS)
+        if wait > 0 and not job.finished.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(job.finished), wait)
+            except asyncio.TimeoutError:
+                pass
+        return 200, job.to_dict()
+
+    async def _post_cancel(self, match, query, data):
+        self.controller.cancel()
+        return 202, {}
+
+    async def _post_configure(self, match, query, data):
+        self.controller.configure()
+        return 202, {}
+
+    async def _post_collection(self, match, query, data):
+        dirpath = data.get('path')
+        if not isinstance(dirpath, str) or not dirpath:
+            raise ApiError(400, 'path is required')
+        self.controller.set_collection(dirpath)
+        return 202, {}
+
+    async def _get_events(self, match, query, data):
+        since = int(self._get_float(query, 'since', self.events.last_seq))
+        wait = min(self._get_float(query, 'wait', 0.0), MAX_POLL_SECONDS)
+        events = await self.events.wait(since, wait)
+        return 200, {'events': events, 'last': self.events.last_seq}
@@ -0,0 +1,164 @@
+"""
+Detection of separate photos in a single flatbed scan: several prints laid on the glass
+at once, against the scanner lid.
+
+Detection runs on a downsampled copy of the scan, which is plenty to find the edges of
+a print and is a small fraction of the work of looking at every pixel of a 600 DPI
+scan. Each photo found is then cut out of the full-resolution scan with a single
+perspective warp, which straightens it at the same time.
+"""
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+
+from ..lazyimport import lazy_import
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+# Longest side of the copy of the scan that detection runs on, in pixels (at most)
+DETECT_SIZE = 1024
+
+# Width of the strip around the edge of the scan that's sampled to find the colour of
+# the lid, as a fraction of the (downsampled) scan's shorter side
+BORDER_FRACTION = 0.02
+
+# Smallest difference from the lid colour that counts as part of a photo, whatever
+# Otsu's method makes of the image
+MIN_THRESHOLD = 16
+
+
+@dataclass
+class DetectedPhoto:
+    """
+    One photo found in a scan: quad is its four corners in full-resolution scan
+    coordinates, clockwise from the top left of the photo as it sits on the glass.
+    """
+    quad: np.ndarray
+    width: int
+    height: int
+    angle: float
+
+    @property
+    def bounds(self) -> tuple[int, int, int, int]:
+        x0, y0 = np.floor(self.quad.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(self.quad.max(axis=0)).astype(int)
+        return (int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+
+
+def downsample(image: np.ndarray, size: int) -> tuple[np.ndarray, int]:
+    """
+    Shrinks an image so that its longest side is at most size, returning the smaller
+    copy and the factor it was shrunk by. Shrinks by a whole number: OpenCV's area
+    interpolation has a much faster path for integer factors, which matters at 35
+    megapixels.
+    """
+    factor = math.ceil(max(image.shape[:2]) / size)
+    if factor <= 1:
+        return image, 1
+    return cv2.resize(image, None, fx=1 / factor, fy=1 / factor, interpolation=cv2.INTER_AREA), factor
+
+
+def _get_foreground_mask(small: np.ndarray) -> np.ndarray:
+    """
+    Returns a mask of everything in the downsampled scan that isn't the lid: pixels
+    whose colour differs enough from the lid's, plus strong edges, which catch the
+    outlines of prints with borders close to the lid's colour.
+    """
+    h, w = small.shape[:2]
+    border = max(2, int(min(h, w) * BORDER_FRACTION))
+    edge_pixels = np.concatenate([
+        small[:border].reshape(-1, 3), small[-border:].reshape(-1, 3),
+        small[:, :border].reshape(-1, 3), small[:, -border:].reshape(-1, 3),
+    ])
+    background = np.median(edge_pixels, axis=0).astype(np.int16)
+
+    distance = np.abs(small.astype(np.int16) - background).max(axis=2).astype(np.uint8)
+    distance = cv2.GaussianBlur(distance, (5, 5), 0)
+    threshold, _ = cv2.threshold(distance, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    _, mask = cv2.threshold(distance, max(threshold, MIN_THRESHOLD), 255, cv2.THRESH_BINARY)
+
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(gray, 20, 60)
+    mask = cv2.bitwise_or(mask, edges)
+
+    # Close small gaps in each photo's outline, then drop specks of dust
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    return mask
+
+
+def _order_corners(points: np.ndarray) -> np.ndarray:
+    # Top-left has the smallest x + y and bottom-right the largest; top-right has the
+    # smallest y - x and bottom-left the largest
+    s = points.sum(axis=1)
+    d = points[:, 1] - points[:, 0]
+    return np.array([points[np.argmin(s)], points[np.argmin(d)], points[np.argmax(s)], points[np.argmax(d)]], dtype=np.float32)
+
+
+def _get_quad(contour: np.ndarray) -> np.ndarray:
+    """
+    Returns the corners of a photo's outline: the outline itself, if it simplifies to
+    a convex quadrilateral, or else the smallest rectangle that encloses it.
+    """
+    hull = cv2.convexHull(contour)
+    approx = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+    if len(approx) == 4 and cv2.isContourConvex(approx):
+        return _order_corners(approx.reshape(4, 2).astype(np.float32))
+    return _order_corners(cv2.boxPoints(cv2.minAreaRect(contour)).astype(np.float32))
+
+
+def detect_photos(image: np.ndarray, max_photos: int = 6, min_area: float = 0.02) -> list[DetectedPhoto]:
+    """
+    Finds the separate photos in a scan, returning them in reading order (top to
+    bottom, then left to right). min_area is the smallest photo to look for, as a
+    fraction of the area of the scan; only the max_photos largest are returned.
+    Returns an empty list if nothing stands out from the lid.
+    """
+    small, factor = downsample(image, DETECT_SIZE)
+    mask = _get_foreground_mask(small)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    min_pixels = min_area * small.shape[0] * small.shape[1]
+    contours = [contour for contour in contours if cv2.contourArea(contour) >= min_pixels]
+    contours = sorted(contours, key=cv2.contourArea, reverse=True)[:max_photos]
+
+    photos = []
+    for contour in contours:
+        quad = _get_quad(contour) * factor
+        width = int(round(max(np.linalg.norm(quad[1] - quad[0]), np.linalg.norm(quad[2] - quad[3]))))
+        height = int(round(max(np.linalg.norm(quad[3] - quad[0]), np.linalg.norm(quad[2] - quad[1]))))
+        top = quad[1] - quad[0]
+        angle = float(np.degrees(np.arctan2(top[1], top[0])))
+        photos.append(DetectedPhoto(quad, width, height, angle))
+
+    # Group photos into rows: a photo starts a new row if its top is below the middle of
+    # the previous photo in the list
+    photos.sort(key=lambda photo: photo.bounds[1])
+    rows = []
+    for photo in photos:
+        x, y, w, h = photo.bounds
+        if rows and y < rows[-1][0]:
+            rows[-1][1].append(photo)
+        else:
+            rows.append([y + h / 2, [photo]])
+    return [photo for _, row in rows for photo in sorted(row, key=lambda photo: photo.bounds[0])]
+
+
+def extract_photo(image: np.ndarray, photo: DetectedPhoto) -> np.ndarray:
+    """
+    Cuts a detected photo out of the full-resolution scan, straightened. Only the
+    photo's own bounding box is warped, so the cost depends on the size of the photo,
+    not of the scan.
+    """
+    x, y, w, h = photo.bounds
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(image.shape[1], x + w), min(image.shape[0], y + h)
+    region = image[y0:y1, x0:x1]
+
+    src = (photo.quad - np.array([x0, y0], dtype=np.float32)).astype(np.float32)
+    dst = np.array([[0, 0], [photo.width - 1, 0], [photo.width - 1, photo.height - 1], [0, photo.height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(src, dst)
+    return cv2.warpPerspective(region, matrix, (photo.width, photo.height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
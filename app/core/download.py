@@ -0,0 +1,257 @@
+import os
+import json
+import hashlib
+import zipfile
+from typing import Optional, Callable
+
+from .. import g
+from ..lazyimport import lazy_import
+
+requests = lazy_import('requests')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+def get_default_cache_dir() -> str:
+    return os.path.join(os.path.expanduser('~'), '.FScan', 'cache')
+
+
+def _hash_file(filepath: str) -> 'hashlib._Hash':
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h
+
+
+def download_file(
+    url: str,
+    filepath: str,
+    expected_size: Optional[int] = None,
+    expected_sha256: Optional[str] = None,
+    on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+    headers: Optional[dict] = None,
+    timeout: float = 30.0,
+) -> str:
+    """
+    Downloads url to filepath in chunks, hashing the data as it arrives, and returns its
+    SHA-256. Data is written to filepath + '.part' until the download is complete and
+    verified: if a previous attempt left a partial file behind, the download resumes
+    from where it left off with an HTTP Range request (falling back to starting over if
+    the server doesn't honor it). Raises DownloadError if the download fails or doesn't
+    match the expected size or hash; a mismatched partial file is deleted so the next
+    attempt starts clean.
+
+    on_progress, if given, is called with (bytes received, total bytes or None).
+    """
+    part_filepath = filepath + '.part'
+    request_headers = dict(headers or {})
+
+    offset = os.path.getsize(part_filepath) if os.path.isfile(part_filepath) else 0
+    if expected_size is not None and offset > expected_size:
+        os.remove(part_filepath)
+        offset = 0
+    h = _hash_file(part_filepath) if offset else hashlib.sha256()
+    if offset:
+        request_headers['Range'] = 'bytes=%d-' % offset
+
+    try:
+        with requests.get(url, headers=request_headers, stream=True, timeout=timeout) as r:
+            if r.status_code == 416 and offset and offset == expected_size:
+                # We already have the whole thing
+                pass
+            elif r.status_code == 206 and offset:
+                g.log.info('Resuming download at %d bytes' % offset)
+                _receive(r, part_filepath, 'ab', h, offset, expected_size, on_progress)
+            elif r.ok:
+                if offset:
+                    g.log.info('Server did not honor range request; restarting download')
+                offset = 0
+                h = hashlib.sha256()
+                _receive(r, part_filepath, 'wb', h, offset, expected_size, on_progress)
+            else:
+                raise DownloadError('Failed to download %s: HTTP %d' % (url, r.status_code))
+    except requests.RequestException as exc:
+        # Leave the partial file in place so that the next attempt can resume
+        raise DownloadError('Failed to download %s: %s' % (url, exc)) from exc
+
+    size = os.path.getsize(part_filepath)
+    sha256 = h.hexdigest()
+    if expected_size is not None and size != expected_size:
+        os.remove(part_filepath)
+        raise DownloadError('Downloaded %d bytes from %s; expected %d' % (size, url, expected_size))
+    if expected_sha256 and sha256 != expected_sha256.lower():
+        os.remove(part_filepath)
+        raise DownloadError('SHA-256 of %s is %s; expected %s' % (url, sha256, expected_sha256))
+
+    os.replace(part_filepath, filepath)
+    return sha256
+
+
+def _receive(r, part_filepath, mode, h, offset, expected_size, on_progress):
+    total = expected_size
+    if total is None and 'Content-Length' in r.headers:
+        total = offset + int(r.headers['Content-Length'])
+
+    received = offset
+    with open(part_filepath, mode) as fp:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            fp.write(chunk)
+            h.update(chunk)
+            received += len(chunk)
+            if on_progress:
+                on_progress(received, total)
+
+
+def extract_zip(zip_filepath: str, dest_dirpath: str, on_progress: Optional[Callable[[int, int], None]] = None):
+    """
+    Extracts every file in a zip archive into dest_dirpath, streaming each member to
+    disk in chunks. on_progress, if given, is called with (uncompressed bytes written,
+    total uncompressed bytes). Raises DownloadError if a member would be written
+    outside of dest_dirpath.
+    """
+    dest_dirpath = os.path.abspath(dest_dirpath)
+    with zipfile.ZipFile(zip_filepath, 'r') as zf:
+        members = zf.infolist()
+        total = sum(info.file_size for info in members)
+        written = 0
+        for info in members:
+            target_path = os.path.abspath(os.path.join(dest_dirpath, info.filename))
+            if os.path.commonpath([dest_dirpath, target_path]) != dest_dirpath:
+                raise DownloadError('Refusing to extract %s outside of %s' % (info.filename, dest_dirpath))
+
+            if info.is_dir():
+                os.makedirs(target_path, exist_ok=True)
+                continue
+
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with zf.open(info) as src, open(target_path, 'wb') as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    written += len(chunk)
+                    if on_progress:
+                        on_progress(written, total)
+
+
+class ArtifactCache:
+    """
+    Local cache of downloaded metadata and artifacts, so that repeated installs (or
+    installs on several stations that share a cache directory) need no network.
+
+    JSON metadata is cached along with its ETag: it's revalidated with a conditional
+    request, and the cached copy is used if the server says it's unchanged or can't be
+    reached. Artifacts are stored under a caller-supplied key (e.g. a release ID)
+    along with their SHA-256, which is checked before a cached artifact is reused.
+    """
+
+    def __init__(self, dirpath: str):
+        self.dirpath = dirpath
+
+    def _get_metadata_path(self, url: str) -> str:
+        return os.path.join(self.dirpath, 'metadata', '%s.json' % hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get_artifact_path(self, key: str, filename: str) -> str:
+        return os.path.join(self.dirpath, 'artifacts', key, filename)
+
+    def get_metadata(self, url: str, headers: Optional[dict] = None, timeout: float = 5.0) -> tuple[dict, Optional[str]]:
+        """
+        Returns the JSON document at url, along with its ETag. Raises DownloadError if
+        the document can't be fetched and isn't cached.
+        """
+        metadata_path = self._get_metadata_path(url)
+        cached = None
+        if os.path.isfile(metadata_path):
+            with open(metadata_path, 'r', encoding='utf-8') as fp:
+                cached = json.load(fp)
+
+        request_headers = dict(headers or {})
+        if cached and cached.get('etag'):
+            request_headers['If-None-Match'] = cached['etag']
+
+        try:
+            r = requests.get(url, headers=request_headers, timeout=timeout)
+        except requests.RequestException as exc:
+            if cached:
+                g.log.warning('Failed to fetch %s (%s); using cached copy' % (url, exc))
+                return cached['data'], cached.get('etag')
+            raise DownloadError('Failed to fetch %s: %s' % (url, exc)) from exc
+
+        if r.status_code == 304 and cached:
+            g.log.debug('%s is unchanged (ETag %s)' % (url, cached.get('etag')))
+            return cached['data'], cached.get('etag')
+
+        if not r.ok:
+            desc = ''
+            try:
+                desc = ': ' + r.json()['message']
+            except Exception:
+                pass
+            if cached:
+                g.log.warning('Failed to fetch %s (HTTP %d%s); using cached copy' % (url, r.status_code, desc))
+                return cached['data'], cached.get('etag')
+            raise DownloadError('Failed to fetch %s: HTTP %d%s' % (url, r.status_code, desc))
+
+        try:
+            data = r.json()
+        except ValueError as exc:
+            raise DownloadError('Failed to decode response from %s as JSON: %s' % (url, exc)) from exc
+
+        etag = r.headers.get('ETag')
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        temp_path = metadata_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as fp:
+            json.dump({'url': url, 'etag': etag, 'data': data}, fp)
+        os.replace(temp_path, metadata_path)
+        return data, etag
+
+    def get_artifact(
+        self,
+        key: str,
+        filename: str,
+        url: str,
+        expected_size: Optional[int] = None,
+        expected_sha256: Optional[str] = None,
+        on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+    ) -> str:
+        """
+        Returns the path to a verified copy of the artifact at url, downloading it (or
+        resuming an interrupted download) if it isn't already cached under key.
+        """
+        artifact_path = self.get_artifact_path(key, filename)
+        sha256_path = artifact_path + '.sha256'
+        if os.path.isfile(artifact_path) and os.path.isfile(sha256_path):
+            with open(sha256_path, 'r') as fp:
+                recorded_sha256 = fp.read().strip()
+            if (not expected_sha256 or recorded_sha256 == expected_sha256.lower()) and _hash_file(artifact_path).hexdigest() == recorded_sha256:
+                g.log.info('Using cached %s' % artifact_path)
+                return artifact_path
+            g.log.warning('Cached %s failed verification; downloading again' % artifact_path)
+            os.remove(artifact_path)
+
+        os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+        sha256 = download_file(url, artifact_path, expected_size, expected_sha256, on_progress)
+        with open(sha256_path, 'w') as fp:
+            fp.write(sha256)
+        return artifact_path
+
+
+def make_progress_logger(label: str, step_percent: int = 10) -> Callable[[int, Optional[int]], None]:
+    """
+    Returns an on_progress callback that logs label with the percentage complete, every
+    step_percent percent.
+    """
+    state = {'next_percent': 0}
+
+    def on_progress(done: int, total: Optional[int]):
+        if not total:
+            return
+        percent = done * 100 // total
+        if percent >= state['next_percent']:
+            g.log.info('%s: %d%% (%d / %d bytes)' % (label, percent, done, total))
+            state['next_percent'] = (percent // step_percent + 1) * step_percent
+
+    return on_progress
@@ -0,0 +1,102 @@
+"""
+Duplicate detection by perceptual hash: the same photo scanned twice never produces the
+same file, but it does produce nearly the same dHash, so likely duplicates are the
+images whose hashes differ in only a few bits.
+"""
+from __future__ import annotations
+
+import threading
+from typing import Optional
+
+from ..lazyimport import lazy_import
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+# Most bits (of 64) in which two hashes can differ for their images to count as
+# likely duplicates
+DEFAULT_MAX_DISTANCE = 8
+
+_popcount_lut = None
+
+
+def compute_dhash(image: np.ndarray) -> int:
+    """
+    Returns the 64-bit difference hash of an image: shrunk to 9x8 grayscale, one bit
+    per pair of horizontally adjacent pixels, set where brightness increases. Robust to
+    scaling, compression and small changes in exposure.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def to_signed(dhash: int) -> int:
+    # SQLite integers are signed 64-bit
+    return dhash - (1 << 64) if dhash >= (1 << 63) else dhash
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    global _popcount_lut
+    if _popcount_lut is None:
+        _popcount_lut = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return _popcount_lut[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+class DuplicateIndex:
+    """
+    Every hash in a collection, held in a flat array, so that finding the ones near a
+    new hash is a single vectorized XOR and popcount over all of them: well under a
+    millisecond at 100,000 images, with nothing to rebalance as images are added.
+    Safe to use from any thread.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._seqs = np.zeros(capacity, dtype=np.int64)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, entries: list[tuple[int, int]]) -> DuplicateIndex:
+        """
+        Returns an index of the given (seq, dhash) pairs, with room to grow.
+        """
+        index = cls(max(1024, 2 * len(entries)))
+        if entries:
+            index._seqs[:len(entries)] = np.fromiter((seq for seq, _ in entries), dtype=np.int64, count=len(entries))
+            index._hashes[:len(entries)] = np.fromiter((dhash for _, dhash in entries), dtype=np.uint64, count=len(entries))
+            index._count = len(entries)
+        return index
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, seq: int, dhash: int):
+        with self._lock:
+            if self._count == len(self._hashes):
+                self._hashes = np.concatenate([self._hashes, np.zeros_like(self._hashes)])
+                self._seqs = np.concatenate([self._seqs, np.zeros_like(self._seqs)])
+            self._hashes[self._count] = dhash
+            self._seqs[self._count] = seq
+            self._count += 1
+
+    def find(self, dhash: int, max_distance: int = DEFAULT_MAX_DISTANCE, exclude_seq: Optional[int] = None) -> list[tuple[int, int]]:
+        """
+        Returns (seq, distance) for each image whose hash is within max_distance bits of
+        dhash, nearest first.
+        """
+        with self._lock:
+            hashes = self._hashes[:self._count]
+            seqs = self._seqs[:self._count]
+        distances = _popcount(np.bitwise_xor(hashes, np.uint64(dhash)))
+        matches = np.flatnonzero(distances <= max_distance)
+        matches = matches[np.argsort(distances[matches], kind='stable')]
+        return [(int(seqs[i]), int(distances[i])) for i in matches if seqs[i] != exclude_seq]
@@ -0,0 +1,171 @@
+import os
+import json
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from .. import g
+from ..config import get_config_var
+
+JOURNAL_FILENAME = 'journal.jsonl'
+
+# Every state a scan job (or a page of a batch job) passes through, in order. Each
+# transition is appended to the journal as it happens.
+QUEUED = 'queued'          # Submitted to the pipeline, waiting for a scanner
+SCANNING = 'scanning'      # NAPS2 has been invoked
+SCANNED = 'scanned'        # A batch job's NAPS2 invocation has finished
+WRITTEN = 'written'        # NAPS2 has written the page to the staging directory
+SPLIT = 'split'            # The page was split into several photos, each tracked on its own
+PROCESSED = 'processed'    # The page (or photo) has been post-processed, ready to commit
+COMMITTED = 'committed'    # The page has been moved into its collection
+DROPPED = 'dropped'        # The page was blank, and left out of its collection
+FAILED = 'failed'          # The job or page failed, or was cancelled
+
+# States that a job can be picked up from after a restart, without being rescanned
+RESUMABLE_STATES = (WRITTEN, PROCESSED)
+FINAL_STATES = (SCANNED, SPLIT, COMMITTED, DROPPED, FAILED)
+
+
+def get_default_journal_dir() -> str:
+    return os.path.join(os.path.expanduser('~'), '.FScan')
+
+
+@dataclass
+class JournalEntry:
+    """
+    The most recent record of one job, or of one page of a batch job, or of one photo
+    split from a page: everything that's needed to pick it back up, or to clean up
+    after it.
+    """
+    session: str
+    job_id: int
+    page: Optional[int]
+    state: str
+    time: float
+    is_front: bool
+    count: int
+    collection: str
+    output_filepath: str
+    scanner: Optional[str] = None
+    profile_name: Optional[str] = None
+    scanned_at: Optional[float] = None
+    processed_filepath: Optional[str] = None
+    sha256: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    reason: Optional[str] = None
+    region: Optional[int] = None
+    quad: Optional[list[list[float]]] = None
+    blank: Optional[bool] = None
+    dhash: Optional[int] = None
+    derivatives: Optional[list[str]] = None
+
+    @property
+    def key(self) -> tuple[str, int, Optional[int], Optional[int]]:
+        return (self.session, self.job_id, self.page, self.region)
+
+    @property
+    def label(self) -> str:
+        label = 'Job %d' % self.job_id
+        if self.page is not None:
+            label += ' page %d' % self.page
+        if self.region is not None:
+            label += ' photo %d' % self.region
+        return label + ' of session %s' % self.session
+
+    def to_json(self) -> str:
+        return json.dumps({name: value for name, value in self.__dict__.items() if value is not None})
+
+    @classmethod
+    def from_json(cls, line: str) -> 'JournalEntry':
+        fields = json.loads(line)
+        fields.setdefault('page', None)
+        return cls(**fields)
+
+
+class JobJournal:
+    """
+    Append-only log of the state transitions of every scan job, one JSON object per
+    line. Each record is fsync'd before the pipeline moves on, so if the app (or the
+    machine) goes down mid-session, the journal still says which pages were scanned and
+    how far each one got: on the next startup, replay() returns the jobs that never
+    finished, so that pages already sitting in a staging directory can be processed and
+    committed without being scanned again.
+
+    Every record carries the job's full context rather than just what changed, so that
+    the last record for a job is all that replay needs. Safe to use from any thread.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._fd = None
+
+    @classmethod
+    def from_config(cls) -> 'JobJournal':
+        dirpath = get_config_var('SCAN_JOURNAL_DIR') or get_default_journal_dir()
+        return cls(os.path.join(dirpath, JOURNAL_FILENAME))
+
+    def _open(self):
+        if self._fd is None:
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            self._fd = os.open(self.filepath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        return self._fd
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def append(self, *entries: JournalEntry):
+        # Several records are written (and synced) together, so that they land together
+        data = ''.join(entry.to_json() + '\n' for entry in entries).encode('utf-8')
+        with self._lock:
+            fd = self._open()
+            os.write(fd, data)
+            os.fsync(fd)
+
+    def replay(self) -> list[JournalEntry]:
+        """
+        Reads the journal, returning the last record of every job (and every page) that
+        didn't reach a final state, oldest first. A torn record at the end of the file,
+        left by a crash mid-write, is ignored.
+        """
+        latest: dict[tuple, JournalEntry] = {}
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as fp:
+                for lineno, line in enumerate(fp, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = JournalEntry.from_json(line)
+                    except (ValueError, TypeError) as exc:
+                        g.log.warning('Ignoring unreadable record at %s:%d (%s).' % (self.filepath, lineno, exc))
+                        continue
+                    latest[entry.key] = entry
+        except FileNotFoundError:
+            return []
+
+        # A batch job is finished once NAPS2 is done with it: from then on, each of its
+        # pages is tracked under its own key
+        return [entry for entry in latest.values() if entry.state not in FINAL_STATES]
+
+    def compact(self, entries: list[JournalEntry]):
+        """
+        Replaces the journal with just the given records, dropping the history of every
+        job that has finished. Written to a new file first, so that a crash partway
+        through leaves the old journal intact.
+        """
+        tmp_filepath = self.filepath + '.tmp'
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            with open(tmp_filepath, 'w', encoding='utf-8') as fp:
+                for entry in entries:
+                    fp.write(entry.to_json() + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_filepath, self.filepath)
@@ -0,0 +1,339 @@
+"""
+Always-on instrumentation: counters, gauges and latency histograms, kept in memory and
+written out periodically as a Prometheus text-format file (for node_exporter's textfile
+collector, or anything else that reads it) and as a JSON snapshot.
+
+Histograms are HDR-style: each power of two is split into SUB_BUCKET_COUNT buckets, so
+every value is kept to within about 3% whatever its magnitude, from microseconds to
+hours, in a few hundred integers. Recording a value is a handful of integer operations
+under a lock, cheap enough to leave on everywhere.
+
+Metrics are looked up by name and labels from the registry, and created on first use:
+
+    metrics.histogram('fscan_stage_seconds', stage='commit').record(elapsed)
+    metrics.counter('fscan_items_committed_total', side='front').inc()
+"""
+import os
+import json
+import time
+import threading
+from typing import Optional
+
+from .. import g
+from ..config import get_config_var
+
+# Each power of two is split into this many buckets (a power of two itself), for a
+# relative error of at most 1/SUB_BUCKET_COUNT
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+
+# Histograms count whole microseconds
+UNITS_PER_SECOND = 1000000
+
+# Upper bounds of the buckets exported to Prometheus, in seconds
+EXPORT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 150.0, 600.0)
+
+# Percentiles included in JSON snapshots
+SNAPSHOT_PERCENTILES = (50, 90, 99, 99.9)
+
+PROMETHEUS_FILENAME = 'fscan.prom'
+SNAPSHOT_FILENAME = 'fscan.json'
+
+
+def _get_bucket_index(value: int) -> int:
+    # Values under 2 * SUB_BUCKET_COUNT get a bucket each; above that, each power of two
+    # gets SUB_BUCKET_COUNT buckets, indexed by the value's top bits
+    shift = max(0, value.bit_length() - SUB_BUCKET_BITS - 1)
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def _get_bucket_bounds(index: int) -> tuple[int, int]:
+    # The lowest value in the bucket, and the lowest in the next one
+    if index < 2 * SUB_BUCKET_COUNT:
+        return index, index + 1
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    low = (index - (shift << SUB_BUCKET_BITS)) << shift
+    return low, low + (1 << shift)
+
+
+class Histogram:
+    """
+    Distribution of durations, in seconds, to a precision of about 3%.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self._counts = []
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        value = max(0, int(seconds * UNITS_PER_SECOND))
+        index = _get_bucket_index(value)
+        with self._lock:
+            if index >= len(self._counts):
+                self._counts.extend([0] * (index + 1 - len(self._counts)))
+            self._counts[index] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """
+        Returns the value (in seconds) that the given percentage of recorded values are
+        at or below, or None if nothing has been recorded.
+        """
+        with self._lock:
+            counts, count, maximum = list(self._counts), self.count, self.max
+        if not count:
+            return None
+        target = max(1, int(percentile / 100 * count + 0.5))
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= target:
+                # The middle of the bucket, but never beyond the largest value recorded
+                low, high = _get_bucket_bounds(index)
+                return min((low + high - 1) / 2, maximum) / UNITS_PER_SECOND
+        return maximum / UNITS_PER_SECOND
+
+    def get_cumulative_counts(self, bounds: tuple[float, ...]) -> list[int]:
+        """
+        Returns the number of recorded values at or below each bound, in seconds, as
+        Prometheus buckets count them. Values are attributed to the bound their bucket
+        falls within.
+        """
+        with self._lock:
+            counts = list(self._counts)
+        cumulative = []
+        index, seen = 0, 0
+        for bound in bounds:
+            limit = bound * UNITS_PER_SECOND
+            while index < len(counts) and _get_bucket_bounds(index)[1] - 1 <= limit:
+                seen += counts[index]
+                index += 1
+            cumulative.append(seen)
+        return cumulative
+
+    def get_summary(self) -> dict:
+        summary = {
+            'count': self.count,
+            'sum': self.total / UNITS_PER_SECOND,
+            'min': self.min / UNITS_PER_SECOND if self.min is not None else None,
+            'max': self.max / UNITS_PER_SECOND if self.max is not None else None,
+        }
+        for percentile in SNAPSHOT_PERCENTILES:
+            summary['p%s' % ('%g' % percentile).replace('.', '')] = self.percentile(percentile)
+        return summary
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Timer:
+    """
+    Context manager that records how long its block took in a histogram.
+    """
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.record(time.perf_counter() - self.started_at)
+
+
+class MetricsRegistry:
+    """
+    Every metric recorded in this process, by name and labels. Safe to use from any
+    thread.
+    """
+
+    def __init__(self):
+        self._metrics: dict[tuple, object] = {}
+        self._help: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_type: type, name: str, labels: dict[str, str]):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, metric_type())
+        return metric
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        return self._get(Histogram, name, labels)
+
+    def counter(self, name: str, **labels: str) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name: str, **labels: str) -> Gauge:
+        return self._get(Gauge, name, labels)
+
+    def time(self, name: str, **labels: str) -> Timer:
+        return Timer(self.histogram(name, **labels))
+
+    def _get_families(self) -> dict[str, list[tuple[dict[str, str], object]]]:
+        with self._lock:
+            items = list(self._metrics.items())
+        families = {}
+        for (name, labels), metric in sorted(items, key=lambda item: item[0]):
+            families.setdefault(name, []).append((dict(labels), metric))
+        return families
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current value of every metric, with a summary of each histogram.
+        """
+        snapshot = {'time': time.time(), 'counters': {}, 'gauges': {}, 'histograms': {}}
+        for name, members in self._get_families().items():
+            for labels, metric in members:
+                if isinstance(metric, Histogram):
+                    snapshot['histograms'].setdefault(name, []).append(dict(labels=labels, **metric.get_summary()))
+                elif isinstance(metric, Counter):
+                    snapshot['counters'].setdefault(name, []).append({'labels': labels, 'value': metric.value})
+                else:
+                    snapshot['gauges'].setdefault(name, []).append({'labels': labels, 'value': metric.value})
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        """
+        Returns every metric in Prometheus' text exposition format.
+        """
+        lines = []
+        for name, members in self._get_families().items():
+            metric_type = {Histogram: 'histogram', Counter: 'counter', Gauge: 'gauge'}[type(members[0][1])]
+            if name in self._help:
+                lines.append('# HELP %s %s' % (name, self._help[name]))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, metric in members:
+                if isinstance(metric, Histogram):
+                    cumulative = metric.get_cumulative_counts(EXPORT_BUCKETS)
+                    for bound, count in zip(EXPORT_BUCKETS, cumulative):
+                        lines.append('%s_bucket%s %d' % (name, _format_labels(labels, le='%g' % bound), count))
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels, le='+Inf'), metric.count))
+                    lines.append('%s_sum%s %.6f' % (name, _format_labels(labels), metric.total / UNITS_PER_SECOND))
+                    lines.append('%s_count%s %d' % (name, _format_labels(labels), metric.count))
+                else:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), '%g' % metric.value))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: dict[str, str], **extra: str) -> str:
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (key, escape(value)) for key, value in labels.items())
+
+
+def _write_atomically(filepath: str, content: str):
+    # Readers never see a half-written file
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w') as fp:
+        fp.write(content)
+    os.replace(tmp_filepath, filepath)
+
+
+def get_default_metrics_dir() -> str:
+    return os.path.join(os.path.expanduser('~'), '.FScan', 'metrics')
+
+
+class MetricsExporter:
+    """
+    Writes the registry's metrics to PROMETHEUS_FILENAME and SNAPSHOT_FILENAME in a
+    directory every interval seconds, on a background thread, and once more when
+    stopped.
+    """
+
+    def __init__(self, registry: MetricsRegistry, dirpath: str, interval: float):
+        self.registry = registry
+        self.dirpath = dirpath
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, registry: MetricsRegistry) -> Optional['MetricsExporter']:
+        """
+        Reads METRICS_DIR and METRICS_INTERVAL_SECONDS (see fscan.ini). Returns None if
+        exporting is turned off, or the interval isn't a number.
+        """
+        value = get_config_var('METRICS_INTERVAL_SECONDS', '15')
+        try:
+            interval = float(value)
+        except ValueError:
+            g.log.error('Not exporting metrics: invalid METRICS_INTERVAL_SECONDS: %s' % value)
+            return None
+        if interval <= 0:
+            return None
+        return cls(registry, get_config_var('METRICS_DIR') or get_default_metrics_dir(), interval)
+
+    def start(self):
+        assert self._thread is None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='fscan-metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.write()
+
+    def write(self):
+        try:
+            os.makedirs(self.dirpath, exist_ok=True)
+            _write_atomically(os.path.join(self.dirpath, PROMETHEUS_FILENAME), self.registry.to_prometheus())
+            _write_atomically(os.path.join(self.dirpath, SNAPSHOT_FILENAME), json.dumps(self.registry.snapshot(), indent=2))
+        except OSError as exc:
+            g.log.error('Failed to write metrics to %s: %s' % (self.dirpath, exc))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+
+# The registry that the whole application records to
+metrics = MetricsRegistry()
+metrics.describe('fscan_command_seconds', 'Time taken by each command run by the scan worker.')
+metrics.describe('fscan_process_spawn_seconds', 'Time taken to start a subprocess, e.g. NAPS2.Console.exe.')
+metrics.describe('fscan_stage_seconds', 'Time each page spends in each stage of the scan pipeline.')
+metrics.describe('fscan_postprocess_seconds', 'Time taken by each step of post-processing, per image.')
+metrics.describe('fscan_encode_seconds', 'Time taken to encode each output of an image.')
+metrics.describe('fscan_stage_depth', 'Jobs currently in each stage of the scan pipeline.')
+metrics.describe('fscan_jobs_queued_total', 'Scan jobs submitted to the pipeline.')
+metrics.describe('fscan_pages_scanned_total', 'Pages written by NAPS2.')
+metrics.describe('fscan_items_committed_total', 'Images committed to a collection, by side.')
+metrics.describe('fscan_pages_failed_total', 'Jobs or pages that failed or were cancelled.')
+metrics.describe('fscan_pages_dropped_total', 'Blank backs left out of the collection.')
+metrics.describe('fscan_duplicates_flagged_total', 'Fronts flagged as likely rescans of an earlier item.')
@@ -1,5 +1,7 @@
 import os
+from enum import Enum
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -26,7 +28,43 @@ class ScanDevice:
     name: str
 
 
+@dataclass(frozen=True)
+class ScanProfile:
+    """
+    A scan profile as defined in NAPS2's profiles.xml. dpi and bit_depth are parsed
+    from NAPS2's enum values (e.g. 'Dpi300', 'C24Bit'), and are None if unrecognized;
+    page_size and paper_source are left as NAPS2's raw values (e.g. 'Letter', 'Feeder').
+    """
+    display_name: str
+    device: Optional[ScanDevice]
+    driver_name: str
+    dpi: Optional[int]
+    bit_depth: Optional[int]
+    page_size: str
+    paper_source: str
+    is_default: bool
+
+
 @dataclass
 class ProfileConfig:
     front_profile_name: str
     back_profile_name: str
+    front_profile: Optional[ScanProfile] = None
+    back_profile: Optional[ScanProfile] = None
+
+
+class ScanProgressKind(Enum):
+    STARTED = 1        # NAPS2 has started scanning
+    PAGE_ACQUIRED = 2  # The scanner has delivered a page (numbered from 1)
+    WRITING = 3        # NAPS2 is writing scanned pages to disk
+    DONE = 4           # NAPS2 has finished writing its output
+
+
+@dataclass
+class ScanProgress:
+    """
+    A structured progress event, parsed from the verbose output of NAPS2.Console.exe.
+    """
+    kind: ScanProgressKind
+    page: Optional[int] = None
+    message: str = ''
@@ -0,0 +1,240 @@
+"""
+Stand-in for NAPS2.Console.exe, for measuring and testing the scan pipeline without a
+scanner (or Windows). It takes the same arguments that invoke_naps2_scan() and
+invoke_naps2_batch_scan() pass to NAPS2, prints the same kind of progress, and writes a
+synthetic image for every page after a configurable delay.
+
+create_emulated_install() sets up a directory that looks like a portable NAPS2 install,
+with a NAPS2.Console.exe that runs this module, and a profiles.xml with a pair of front
+and back profiles for each emulated scanner. It can then be configured like any other
+install (NAPS2_APP_DIR and NAPS2_DATA_DIR). Settings are read from emulator.json in the
+app directory, so they can be changed between scans.
+
+Synthetic pages come in these kinds of content:
+
+    photos   Several photo-like prints on a light lid, at a slight angle: exercises
+             photo detection, splitting and duplicate detection
+    blank    An empty page with faint paper texture, like the back of most photos
+    noise    Random pixels: the worst case for compression
+    <path>   Any other value is the path of an image to write for every page
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import stat
+import time
+import fcntl
+import argparse
+from dataclasses import asdict, dataclass, fields
+
+from ...lazyimport import lazy_import
+from .data import NAPS2Install
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+SETTINGS_FILENAME = 'emulator.json'
+
+# Counts the pages every emulated scanner in an install has ever scanned, so that each
+# one is different, however many invocations they're spread across
+COUNTER_FILENAME = 'emulator.count'
+
+CONSOLE_EXE_SCRIPT = '''#!%(python)s
+# NAPS2.Console.exe emulator, created by app.core.naps2.emulator
+import sys
+sys.path.insert(0, %(root)r)
+from app.core.naps2.emulator import main
+sys.exit(main(sys.argv[1:], %(settings)r))
+'''
+
+PROFILE_XML = '''  <ScanProfile>
+    <Version>2</Version>
+    <Device><ID>EMULATED-%(index)d</ID><Name>%(device)s</Name></Device>
+    <DriverName>emulated</DriverName>
+    <DisplayName>%(name)s</DisplayName>
+    <IsDefault>%(is_default)s</IsDefault>
+    <BitDepth>C24Bit</BitDepth>
+    <PageSize>Letter</PageSize>
+    <Resolution>Dpi%(dpi)d</Resolution>
+    <PaperSource>Glass</PaperSource>
+  </ScanProfile>
+'''
+
+
+@dataclass
+class EmulatorSettings:
+    """
+    How the emulated scanner behaves: each page is width x height pixels of the given
+    content, and takes at least latency seconds to scan (including the time it takes to
+    make and write the image), after startup seconds to start up once per invocation.
+    seed makes the synthetic content repeatable: the nth page scanned in a fresh install
+    is always the same, and different from every other.
+    """
+    width: int = 2550
+    height: int = 3300
+    content: str = 'photos'
+    latency: float = 1.0
+    startup: float = 0.5
+    seed: int = 0
+
+    @classmethod
+    def load(cls, filepath: str) -> EmulatorSettings:
+        with open(filepath) as fp:
+            values = json.load(fp)
+        names = set(field.name for field in fields(cls))
+        return cls(**{name: value for name, value in values.items() if name in names})
+
+    def save(self, filepath: str):
+        with open(filepath, 'w') as fp:
+            json.dump(asdict(self), fp, indent=2)
+
+    @property
+    def dpi(self) -> int:
+        # As if the page were US Letter size, 8.5 inches across
+        return int(round(self.width / 8.5))
+
+
+def get_emulated_profile_names(scanner_count: int = 1) -> tuple[list[str], list[str]]:
+    """
+    Returns the names of the front and back profiles that create_emulated_install()
+    makes for the given number of scanners.
+    """
+    if scanner_count == 1:
+        return ['Front'], ['Back']
+    return ['Front %d' % (i + 1) for i in range(scanner_count)], ['Back %d' % (i + 1) for i in range(scanner_count)]
+
+
+def create_emulated_install(dirpath: str, settings: EmulatorSettings, scanner_count: int = 1) -> NAPS2Install:
+    """
+    Creates (or updates) an emulated portable NAPS2 install in dirpath, with App and
+    Data directories, and returns it. Only runs on systems that can execute a script
+    directly, i.e. not Windows.
+    """
+    install = NAPS2Install(os.path.join(dirpath, 'App'), os.path.join(dirpath, 'Data'))
+    os.makedirs(install.app_dir, exist_ok=True)
+    os.makedirs(install.data_dir, exist_ok=True)
+
+    settings_filepath = os.path.join(install.app_dir, SETTINGS_FILENAME)
+    settings.save(settings_filepath)
+    if os.path.isfile(os.path.join(install.app_dir, COUNTER_FILENAME)):
+        os.remove(os.path.join(install.app_dir, COUNTER_FILENAME))
+
+    # NAPS2.exe only needs to exist, for the install to be recognized
+    with open(os.path.join(install.app_dir, 'NAPS2.exe'), 'w') as fp:
+        fp.write('')
+    console_exe_path = os.path.join(install.app_dir, 'NAPS2.Console.exe')
+    root = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+    with open(console_exe_path, 'w') as fp:
+        fp.write(CONSOLE_EXE_SCRIPT % {'python': sys.executable, 'root': root, 'settings': settings_filepath})
+    os.chmod(console_exe_path, os.stat(console_exe_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    front_names, back_names = get_emulated_profile_names(scanner_count)
+    profiles = []
+    for index, (front_name, back_name) in enumerate(zip(front_names, back_names)):
+        device = 'Emulated Scanner' if scanner_count == 1 else 'Emulated Scanner %d' % (index + 1)
+        for name in (front_name, back_name):
+            profiles.append(PROFILE_XML % {'index': index + 1, 'device': device, 'name': name, 'is_default': 'true' if not profiles else 'false', 'dpi': settings.dpi})
+    with open(os.path.join(install.data_dir, 'profiles.xml'), 'w') as fp:
+        fp.write('<?xml version="1.0"?>\n<ArrayOfScanProfile xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n%s</ArrayOfScanProfile>\n' % ''.join(profiles))
+    return install
+
+
+def _next_page_number(app_dir: str) -> int:
+    # Several emulated scanners can be scanning at once
+    with open(os.path.join(app_dir, COUNTER_FILENAME), 'a+') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        fp.seek(0)
+        number = int(fp.read().strip() or '0') + 1
+        fp.seek(0)
+        fp.truncate()
+        fp.write(str(number))
+    return number
+
+
+def make_page(settings: EmulatorSettings, page: int) -> np.ndarray:
+    """
+    Returns the synthetic image for the nth page scanned (numbered from 1), as BGR.
+    """
+    if settings.content not in ('photos', 'blank', 'noise'):
+        image = cv2.imread(settings.content, cv2.IMREAD_COLOR)
+        if image is None:
+            raise RuntimeError('Failed to load image: %s' % settings.content)
+        return image
+
+    rng = np.random.default_rng((settings.seed, page))
+    h, w = settings.height, settings.width
+    if settings.content == 'noise':
+        return rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+    # Paper or lid: a light, even tone with a little grain
+    tone = 236 if settings.content == 'photos' else 224
+    grain = rng.integers(tone - 3, tone + 4, (h, w, 1), dtype=np.uint8)
+    image = np.repeat(grain, 3, axis=2)
+    if settings.content == 'blank':
+        return image
+
+    # A grid of prints, each a smooth blend of colours with some blobs for detail,
+    # rotated a few degrees off square
+    cols, rows = (2, 2) if w < h else (3, 2)
+    cell_w, cell_h = w // cols, h // rows
+    for row in range(rows):
+        for col in range(cols):
+            pw, ph = int(cell_w * rng.uniform(0.6, 0.8)), int(cell_h * rng.uniform(0.6, 0.8))
+            corners = rng.integers(40, 220, (2, 2, 3)).astype(np.float32)
+            photo = cv2.resize(corners, (pw, ph), interpolation=cv2.INTER_LINEAR)
+            for _ in range(8):
+                centre = (int(rng.integers(0, pw)), int(rng.integers(0, ph)))
+                radius = int(rng.integers(min(pw, ph) // 20, min(pw, ph) // 6))
+                cv2.circle(photo, centre, radius, [float(x) for x in rng.integers(0, 256, 3)], -1)
+            photo = cv2.GaussianBlur(photo, (0, 0), 3).astype(np.uint8)
+
+            # Each print stays within its own cell, so only the cell needs warping
+            matrix = cv2.getRotationMatrix2D((pw / 2, ph / 2), float(rng.uniform(-4, 4)), 1.0)
+            matrix[0, 2] += (cell_w - pw) / 2
+            matrix[1, 2] += (cell_h - ph) / 2
+            mask = cv2.warpAffine(np.full((ph, pw), 255, dtype=np.uint8), matrix, (cell_w, cell_h), flags=cv2.INTER_NEAREST)
+            warped = cv2.warpAffine(photo, matrix, (cell_w, cell_h), flags=cv2.INTER_LINEAR)
+            cell = image[cell_h * row:cell_h * (row + 1), cell_w * col:cell_w * (col + 1)]
+            np.copyto(cell, warped, where=mask[..., None] > 0)
+    return image
+
+
+def _parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='NAPS2.Console.exe')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-p', '--profile', required=True)
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('-n', '--number', type=int, default=1)
+    parser.add_argument('--delay', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str], settings_filepath: str) -> int:
+    """
+    Runs the emulator with NAPS2.Console.exe's arguments: -p and -o, and optionally -v,
+    -n and --delay. A $(nnnn) in the output path is replaced with each page's number.
+    """
+    args = _parse_args(argv)
+    settings = EmulatorSettings.load(settings_filepath)
+    if args.verbose:
+        print('Beginning scan...', flush=True)
+    time.sleep(settings.startup)
+
+    for page in range(1, max(args.number, 1) + 1):
+        if page > 1 and args.delay:
+            time.sleep(args.delay / 1000)
+        started_at = time.perf_counter()
+        image = make_page(settings, _next_page_number(os.path.dirname(settings_filepath)))
+        filepath = args.output.replace('$(nnnn)', '%04d' % page)
+        if not cv2.imwrite(filepath, image):
+            print('Error saving images to %s' % filepath, flush=True)
+            return 1
+        time.sleep(max(0.0, settings.latency - (time.perf_counter() - started_at)))
+        if args.verbose:
+            print('Scanned page %d.' % page, flush=True)
+
+    if args.verbose:
+        print('Finished saving images to %s' % args.output, flush=True)
+    return 0
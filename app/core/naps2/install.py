@@ -1,13 +1,11 @@
 import os
 import sys
-import zipfile
 import subprocess
-import requests
-import urllib.request
 from typing import Optional
 
 from ... import g
 from ...config import get_config_var, update_config
+from ..download import DownloadError, ArtifactCache, extract_zip, get_default_cache_dir, make_progress_logger
 from .data import NAPS2Install
 
 GITHUB_API_HEADERS = {'Accept': 'application/vnd.github.v3+json'}
@@ -146,7 +144,21 @@ def get_suggested_naps2_install() -> Optional[NAPS2Install]:
             return NAPS2Install(installed_app_dir, get_naps2_default_data_dir())
 
 
+def _get_asset_sha256(asset_data: dict) -> Optional[str]:
+    # GitHub reports a digest for each release asset in the form 'sha256:<hex>'
+    digest = asset_data.get('digest') or ''
+    return digest[len('sha256:'):] if digest.startswith('sha256:') else None
+
+
 def install_naps2_portable() -> Optional[NAPS2Install]:
+    """
+    Downloads the latest NAPS2 portable release and extracts it to ./naps2, relative to
+    this program. Release metadata and the downloaded archive are kept in a local cache
+    (NAPS2_CACHE_DIR, ~/.FScan/cache by default), so reinstalling the same release
+    needs no network, and an interrupted download resumes where it left off. The
+    release API can be pointed elsewhere (e.g. a local mirror) with
+    NAPS2_RELEASE_API_URL.
+    """
     install_dirpath = os.path.join(_get_binary_dir(), 'naps2')
     g.log.info('Will install NAPS2 portable to: %s' % install_dirpath)
     if os.path.isdir(install_dirpath):
@@ -155,26 +167,14 @@ def install_naps2_portable() -> Optional[NAPS2Install]:
         g.log.info('Creating directory: %s' % install_dirpath)
         os.makedirs(install_dirpath)
 
-    g.log.info('Checking GitHub for latest NAPS2 release...')
-    try:
-        r = requests.get(NAPS2_GITHUB_API_URL, headers=GITHUB_API_HEADERS, timeout=5.0)
-    except Exception as exc:
-        g.log.error('Failed to get release data from GitHub API: %s' % exc)
-        return None
-
-    if not r.ok:
-        desc = ''
-        try:
-            desc = ': ' + r.json()['message']
-        except:
-            pass
-        g.log.error('Failed to get release data from GitHub API: Error %d%s' % (r.status_code, desc))
-        return None
+    cache = ArtifactCache(get_config_var('NAPS2_CACHE_DIR', get_default_cache_dir()))
+    api_url = get_config_var('NAPS2_RELEASE_API_URL', NAPS2_GITHUB_API_URL)
 
+    g.log.info('Checking for latest NAPS2 release...')
     try:
-        release_data = r.json()
-    except Exception as exc:
-        g.log.error('Failed to decode response data as JSON: %s' % exc)
+        release_data, etag = cache.get_metadata(api_url, headers=GITHUB_API_HEADERS)
+    except DownloadError as exc:
+        g.log.error('Failed to get release data: %s' % exc)
         return None
 
     release_name = release_data['name']
@@ -193,23 +193,28 @@ def install_naps2_portable() -> Optional[NAPS2Install]:
     asset_id = asset_data['id']
     asset_updated_at = asset_data['updated_at']
     asset_size_in_bytes = asset_data['size']
+    asset_sha256 = _get_asset_sha256(asset_data)
     g.log.info('%s is asset ID %d; last updated %s; %d bytes total' % (asset_filename, asset_id, asset_updated_at, asset_size_in_bytes))
-    
-    zip_filepath = os.path.join(install_dirpath, asset_filename)
 
+    # Cache the archive by release and asset, so a re-uploaded asset is fetched again
     asset_url = asset_data['browser_download_url']
-    g.log.info('Downloading NAPS2 v%s portable release...' % release_name)
+    cache_key = '%d_%d_%s' % (release_id, asset_id, asset_updated_at.replace(':', ''))
+    g.log.info('Fetching NAPS2 v%s portable release...' % release_name)
     g.log.info('From: %s' % asset_url)
-    g.log.info('  To: %s' % zip_filepath)
-    urllib.request.urlretrieve(asset_url, zip_filepath)
-    g.log.info('Downloaded %s.' % asset_filename)
+    g.log.info('  To: %s' % cache.get_artifact_path(cache_key, asset_filename))
+    try:
+        zip_filepath = cache.get_artifact(cache_key, asset_filename, asset_url, asset_size_in_bytes, asset_sha256, make_progress_logger('Downloading %s' % asset_filename))
+    except DownloadError as exc:
+        g.log.error('Failed to download NAPS2: %s' % exc)
+        return None
+    g.log.info('Fetched %s.' % asset_filename)
 
     g.log.info('Extracting NAPS2 to %s...' % install_dirpath)
-    with zipfile.ZipFile(zip_filepath, 'r') as zf:
-        zf.extractall(install_dirpath)
-
-    g.log.info('Deleting %s...' % asset_filename)
-    os.remove(zip_filepath)
+    try:
+        extract_zip(zip_filepath, install_dirpath, make_progress_logger('Extracting %s' % asset_filename, 25))
+    except (DownloadError, OSError) as exc:
+        g.log.error('Failed to extract NAPS2: %s' % exc)
+        return None
 
     g.log.info('Installed NAPS2 v%s Portable to %s.' % (release_name, install_dirpath))
     return NAPS2Install(os.path.join(install_dirpath, 'App'), os.path.join(install_dirpath, 'Data'))
@@ -1,34 +1,89 @@
 import os
+import re
+import threading
 import xml.etree.ElementTree as ET
 from typing import Optional
 
 from ... import g
 from ...config import get_config_var, update_config
-from .data import ProfileConfig, ScanDevice
+from .data import ProfileConfig, ScanDevice, ScanProfile
+
+DPI_REGEX = re.compile(r'Dpi(\d+)')
+BIT_DEPTHS = {'C24Bit': 24, 'Grayscale': 8, 'BlackWhite': 1}
+PROFILE_NAME_SEPARATOR = '|'
+
+# Parsed profiles, keyed by the normalized path of each profiles.xml file: each value
+# is ((mtime_ns, size), profiles), so that we re-parse only if NAPS2 rewrites the file
+__profiles_cache__: dict[str, tuple[tuple[int, int], list[ScanProfile]]] = {}
+__profiles_cache_lock__ = threading.Lock()
+
+
+def _get_text(elem: ET.Element, tag: str) -> str:
+    child = elem.find(tag)
+    return (child.text or '') if child is not None else ''
+
+
+def _parse_profile(profile_elem: ET.Element) -> ScanProfile:
+    device = None
+    device_elem = profile_elem.find('Device')
+    if device_elem is not None and device_elem.find('ID') is not None:
+        device = ScanDevice(_get_text(device_elem, 'ID'), _get_text(device_elem, 'Name'))
+
+    dpi_match = DPI_REGEX.fullmatch(_get_text(profile_elem, 'Resolution'))
+    return ScanProfile(
+        display_name=_get_text(profile_elem, 'DisplayName'),
+        device=device,
+        driver_name=_get_text(profile_elem, 'DriverName'),
+        dpi=int(dpi_match.group(1)) if dpi_match else None,
+        bit_depth=BIT_DEPTHS.get(_get_text(profile_elem, 'BitDepth')),
+        page_size=_get_text(profile_elem, 'PageSize'),
+        paper_source=_get_text(profile_elem, 'PaperSource'),
+        is_default=_get_text(profile_elem, 'IsDefault').lower() == 'true',
+    )
+
+
+def _parse_profiles_xml(profiles_xml_path: str) -> list[ScanProfile]:
+    with open(profiles_xml_path) as fp:
+        tree = ET.parse(fp)
+    root = tree.getroot()
+    assert root.tag == 'ArrayOfScanProfile'
+    return [_parse_profile(profile_elem) for profile_elem in root]
+
+
+def load_naps2_profiles(data_dir: str) -> list[ScanProfile]:
+    """
+    Returns every scan profile defined in the profiles.xml file in the given NAPS2 data
+    directory. The parsed result is cached until the file's mtime or size changes, so
+    repeated calls are cheap.
+    """
+    profiles_xml_path = os.path.normcase(os.path.abspath(os.path.join(data_dir, 'profiles.xml')))
+    try:
+        st = os.stat(profiles_xml_path)
+    except OSError:
+        return []
+    key = (st.st_mtime_ns, st.st_size)
 
+    with __profiles_cache_lock__:
+        cached = __profiles_cache__.get(profiles_xml_path)
+    if cached and cached[0] == key:
+        return list(cached[1])
 
-def _parse_profiles_xml(data_dir: str) -> Optional[ET.Element]:
-    profiles_xml_path = os.path.join(data_dir, 'profiles.xml')
-    if os.path.isfile(profiles_xml_path):
-        with open(profiles_xml_path) as fp:
-            tree = ET.parse(fp)
-        root = tree.getroot()
-        assert root.tag == 'ArrayOfScanProfile'
-        return root
+    g.log.debug('Parsing %s' % profiles_xml_path)
+    profiles = _parse_profiles_xml(profiles_xml_path)
+    with __profiles_cache_lock__:
+        __profiles_cache__[profiles_xml_path] = (key, profiles)
+    return list(profiles)
 
 
-def list_naps2_devices(data_dir: str) -> list[ScanDevice]:
-    profiles_xml = _parse_profiles_xml(data_dir)
-    if not profiles_xml:
-        return []
+def get_naps2_profile(data_dir: str, profile_name: str) -> Optional[ScanProfile]:
+    return next((x for x in load_naps2_profiles(data_dir) if x.display_name == profile_name), None)
+
 
+def list_naps2_devices(data_dir: str) -> list[ScanDevice]:
     device_names_by_id = {}
-    for profile in profiles_xml:
-        device_elem = profile.find('Device')
-        assert device_elem is not None
-        id_elem, name_elem = device_elem.find('ID'), device_elem.find('Name')
-        assert id_elem is not None and name_elem is not None
-        device_names_by_id[id_elem.text] = name_elem.text
+    for profile in load_naps2_profiles(data_dir):
+        if profile.device:
+            device_names_by_id[profile.device.uuid] = profile.device.name
 
     devices = []
     for device_id, device_name in sorted(device_names_by_id.items(), key=lambda x: x[1]):
@@ -37,43 +92,70 @@ def list_naps2_devices(data_dir: str) -> list[ScanDevice]:
 
 
 def list_naps2_profile_names(data_dir: str) -> list[str]:
-    profiles_xml = _parse_profiles_xml(data_dir)
-    if not profiles_xml:
-        return []
+    return sorted(set(profile.display_name for profile in load_naps2_profiles(data_dir)))
 
-    profile_names = set()
-    for profile in profiles_xml:
-        name_elem = profile.find('DisplayName')
-        assert name_elem is not None
-        profile_names.add(name_elem.text)
-    return sorted(profile_names)
 
+def _split_profile_names(value: Optional[str]) -> list[str]:
+    return [name.strip() for name in (value or '').split(PROFILE_NAME_SEPARATOR) if name.strip()]
 
-def get_profile_config(data_dir: str) -> Optional[ProfileConfig]:
-    front_profile_name = get_config_var('SCAN_PROFILE_NAME_FRONT')
-    back_profile_name = get_config_var('SCAN_PROFILE_NAME_BACK')
-    if not front_profile_name and not back_profile_name:
+
+def get_profile_configs(data_dir: str) -> list[ProfileConfig]:
+    """
+    Returns a ProfileConfig for each scanner that's configured. SCAN_PROFILE_NAME_FRONT
+    and SCAN_PROFILE_NAME_BACK may each list several profile names, separated by '|':
+    the profiles at the same position in each list make up one scanner's config, e.g.
+
+        SCAN_PROFILE_NAME_FRONT=Front (V600 #1)|Front (V600 #2)
+        SCAN_PROFILE_NAME_BACK=Back (V600 #1)|Back (V600 #2)
+
+    Returns an empty list if the configuration is missing or invalid.
+    """
+    front_profile_names = _split_profile_names(get_config_var('SCAN_PROFILE_NAME_FRONT'))
+    back_profile_names = _split_profile_names(get_config_var('SCAN_PROFILE_NAME_BACK'))
+    if not front_profile_names and not back_profile_names:
         g.log.debug('NAPS2 profile names (SCAN_PROFILE_NAME_FRONT, SCAN_PROFILE_NAME_BACK) not configured.')
-        return None
+        return []
 
-    if not front_profile_name or not back_profile_name:
-        var_name = 'SCAN_PROFILE_NAME_BACK' if front_profile_name else 'SCAN_PROFILE_NAME_FRONT'
+    if not front_profile_names or not back_profile_names:
+        var_name = 'SCAN_PROFILE_NAME_BACK' if front_profile_names else 'SCAN_PROFILE_NAME_FRONT'
         g.log.warn('Incomplete profile configuration: %s is not set.' % var_name)
-        return None
+        return []
 
-    profile_names = list_naps2_profile_names(data_dir)
-    if front_profile_name not in profile_names:
-        g.log.warn("Invalid SCAN_PROFILE_NAME_FRONT: no profile named '%s' exists in the currently-configured NAPS2 installation." % front_profile_name)
-        return None
-    if back_profile_name not in profile_names:
-        g.log.warn("Invalid SCAN_PROFILE_NAME_BACK: no profile named '%s' exists in the currently-configured NAPS2 installation." % front_profile_name)
-        return None
+    if len(front_profile_names) != len(back_profile_names):
+        g.log.warn('Incomplete profile configuration: SCAN_PROFILE_NAME_FRONT lists %d profile(s), but SCAN_PROFILE_NAME_BACK lists %d.' % (len(front_profile_names), len(back_profile_names)))
+        return []
+
+    configs = []
+    for front_profile_name, back_profile_name in zip(front_profile_names, back_profile_names):
+        front_profile = get_naps2_profile(data_dir, front_profile_name)
+        if not front_profile:
+            g.log.warn("Invalid SCAN_PROFILE_NAME_FRONT: no profile named '%s' exists in the currently-configured NAPS2 installation." % front_profile_name)
+            return []
+        back_profile = get_naps2_profile(data_dir, back_profile_name)
+        if not back_profile:
+            g.log.warn("Invalid SCAN_PROFILE_NAME_BACK: no profile named '%s' exists in the currently-configured NAPS2 installation." % back_profile_name)
+            return []
+        if front_profile.device and back_profile.device and front_profile.device.uuid != back_profile.device.uuid:
+            g.log.warn("Profiles '%s' and '%s' are paired, but scan with different devices." % (front_profile_name, back_profile_name))
+        configs.append(ProfileConfig(front_profile_name, back_profile_name, front_profile, back_profile))
+    return configs
 
-    return ProfileConfig(front_profile_name, back_profile_name)
+
+def get_profile_config(data_dir: str) -> Optional[ProfileConfig]:
+    """
+    Returns the config for the first (or only) scanner that's configured.
+    """
+    configs = get_profile_configs(data_dir)
+    return configs[0] if configs else None
 
 
 def set_profile_config(new_config: ProfileConfig):
+    """
+    Saves the config for the first scanner, keeping any others that are configured.
+    """
+    front_profile_names = _split_profile_names(get_config_var('SCAN_PROFILE_NAME_FRONT'))[1:]
+    back_profile_names = _split_profile_names(get_config_var('SCAN_PROFILE_NAME_BACK'))[1:]
     update_config({
-        'SCAN_PROFILE_NAME_FRONT': new_config.front_profile_name,
-        'SCAN_PROFILE_NAME_BACK': new_config.back_profile_name,
+        'SCAN_PROFILE_NAME_FRONT': PROFILE_NAME_SEPARATOR.join([new_config.front_profile_name] + front_profile_names),
+        'SCAN_PROFILE_NAME_BACK': PROFILE_NAME_SEPARATOR.join([new_config.back_profile_name] + back_profile_names),
     })
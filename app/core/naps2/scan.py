@@ -1,18 +1,105 @@
 import os
+import re
+from typing import Callable, Optional
 
 from ... import g
-from ..process import run_process
-from .data import NAPS2Install
+from ..process import CancelToken, run_process
+from .data import NAPS2Install, ScanProgress, ScanProgressKind
 
+# Patterns matching the lines NAPS2.Console.exe prints when run with -v
+PROGRESS_REGEXES = [
+    (re.compile(r'^(Beginning|Starting) scan', re.IGNORECASE), ScanProgressKind.STARTED),
+    (re.compile(r'^Scanned page (\d+)', re.IGNORECASE), ScanProgressKind.PAGE_ACQUIRED),
+    (re.compile(r'^(Exporting|Saving|Writing)\D*(\d+)?', re.IGNORECASE), ScanProgressKind.WRITING),
+    (re.compile(r'^(Finished saving|Successfully saved)', re.IGNORECASE), ScanProgressKind.DONE),
+]
 
-def invoke_naps2_scan(install: NAPS2Install, profile_name: str, output_filepath: str):
+
+def parse_naps2_progress(line: str) -> Optional[ScanProgress]:
+    line = line.strip()
+    for regex, kind in PROGRESS_REGEXES:
+        match = regex.match(line)
+        if match:
+            page_str = next((x for x in match.groups() if x and x.isdigit()), None)
+            return ScanProgress(kind, int(page_str) if page_str else None, line)
+    return None
+
+
+def _run_naps2_console(args, on_line: Optional[Callable[[str], None]], on_progress: Optional[Callable[[ScanProgress], None]], timeout: Optional[float], cancel_token: Optional[CancelToken]):
+    seen_done = False
+    def handle_line(line: str):
+        nonlocal seen_done
+        if on_progress:
+            progress = parse_naps2_progress(line)
+            if progress:
+                seen_done = seen_done or progress.kind == ScanProgressKind.DONE
+                on_progress(progress)
+        if on_line:
+            on_line(line)
+
+    exitcode = run_process(args, on_line=handle_line, timeout=timeout, cancel_token=cancel_token)
+    if exitcode != 0:
+        raise RuntimeError('NAPS2.Console.exe failed with exit code %d' % exitcode)
+    if on_progress and not seen_done:
+        on_progress(ScanProgress(ScanProgressKind.DONE))
+
+
+def invoke_naps2_scan(install: NAPS2Install, profile_name: str, output_filepath: str, on_progress: Optional[Callable[[ScanProgress], None]] = None, timeout: Optional[float] = None, cancel_token: Optional[CancelToken] = None):
     console_exe_path = os.path.join(install.app_dir, 'NAPS2.Console.exe')
     args = [console_exe_path, '-v', '-p', profile_name, '-o', output_filepath]
 
     g.log.info("Invoking NAPS2.Console.exe with profile '%s'..." % profile_name)
-    exitcode = run_process(args)
-    if exitcode != 0:
-        raise RuntimeError('NAPS2.Console.exe failed with exit code %d' % exitcode)
+    _run_naps2_console(args, None, on_progress, timeout, cancel_token)
     if not os.path.isfile(output_filepath):
         raise RuntimeError('NAPS2.Console.exe failed to write file: %s' % output_filepath)
     g.log.info('Scan finished.')
+
+
+def _list_batch_pages(output_dir: str, prefix: str, ext: str) -> list[tuple[int, str]]:
+    pages = []
+    for filename in os.listdir(output_dir):
+        stem, file_ext = os.path.splitext(filename)
+        if file_ext.lower() == ext.lower() and stem.startswith(prefix) and stem[len(prefix):].isdigit():
+            pages.append((int(stem[len(prefix):]), os.path.join(output_dir, filename)))
+    return sorted(pages)
+
+
+def invoke_naps2_batch_scan(install: NAPS2Install, profile_name: str, output_dir: str, prefix: str, count: int, on_page: Callable[[int, str], None], delay_ms: int = 0, on_progress: Optional[Callable[[ScanProgress], None]] = None, timeout: Optional[float] = None, cancel_token: Optional[CancelToken] = None) -> int:
+    """
+    Scans multiple pages with a single invocation of NAPS2.Console.exe, avoiding the
+    startup and device initialization cost of running it once per page. If count is
+    nonzero, NAPS2 runs that many scans back-to-back; otherwise it makes a single pass
+    that scans every page in the feeder (assuming the profile is set up to use it).
+
+    Pages are written to output_dir as numbered images named after prefix. on_page is
+    called with the page number and path of each one as soon as it's known to be fully
+    written: i.e. once NAPS2 has started writing the next page, or once it exits.
+    Returns the number of pages scanned.
+    """
+    ext = '.png'
+    console_exe_path = os.path.join(install.app_dir, 'NAPS2.Console.exe')
+    output_pattern = os.path.join(output_dir, prefix + '$(nnnn)' + ext)
+    args = [console_exe_path, '-v', '-p', profile_name, '-o', output_pattern]
+    if count:
+        args += ['-n', str(count)]
+        if delay_ms:
+            args += ['--delay', str(delay_ms)]
+
+    # Each line of output gives us an opportunity to check for newly-written pages
+    landed = set()
+    def check_for_pages(is_finished: bool):
+        pages = _list_batch_pages(output_dir, prefix, ext)
+        if not is_finished:
+            pages = pages[:-1]
+        for page, filepath in pages:
+            if page not in landed:
+                landed.add(page)
+                on_page(page, filepath)
+
+    g.log.info("Invoking NAPS2.Console.exe with profile '%s' for %s..." % (profile_name, ('%d scans' % count) if count else 'all pages in feeder'))
+    _run_naps2_console(args, lambda line: check_for_pages(False), on_progress, timeout, cancel_token)
+    check_for_pages(True)
+    if not landed:
+        raise RuntimeError('NAPS2.Console.exe failed to write any pages to: %s' % output_dir)
+    g.log.info('Batch scan finished: %d page(s).' % len(landed))
+    return len(landed)
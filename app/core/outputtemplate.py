@@ -0,0 +1,122 @@
+import os
+import re
+import time
+import string
+import threading
+
+from .collection import CollectionImage, CollectionItem, UNPAIRED
+from .duplicates import DEFAULT_MAX_DISTANCE, DuplicateIndex
+
+STAGING_DIRNAME = '.staging'
+
+TEMPLATE_FIELDS = ('seq', 'side', 'profile', 'date', 'time', 'ext')
+
+
+class TemplateOutput:
+    """
+    Commit target that writes each scanned image to a path built from a template, for
+    scanning straight to a directory structure of the caller's choosing instead of into
+    a collection. It can be passed to ScanPipeline.submit() in place of a Collection.
+
+    Templates are str.format() strings that can refer to these fields:
+
+        {seq}      Item sequence number, counting up from start_seq (e.g. {seq:04d})
+        {side}     'front' or 'back'
+        {profile}  Name of the NAPS2 profile used for the scan
+        {date}     Date the page was scanned, as YYYY-MM-DD
+        {time}     Time the page was scanned, as HHMMSS
+        {ext}      File extension of the processed image, without the dot
+
+    e.g. 'scans/{date}/{seq:05d}_{side}.{ext}'. Items are numbered the same way as in a
+    collection: a front image always starts a new item, and a back image belongs to the
+    item it's paired with, or else the most recent item that doesn't yet have a back.
+    Copies derived for viewing are written next to each image, named after it (e.g.
+    0001_front_1024.jpg). Existing files are never overwritten.
+    """
+
+    def __init__(self, template: str, start_seq: int = 1):
+        field_names = set(name for _, name, _, _ in string.Formatter().parse(template) if name is not None)
+        unknown = field_names - set(TEMPLATE_FIELDS)
+        if unknown:
+            raise ValueError('Unknown field(s) in output template: %s' % ', '.join(sorted(unknown)))
+        if 'seq' not in field_names and 'time' not in field_names:
+            raise ValueError('Output template must include {seq} or {time}, so that each file gets its own name')
+
+        self.template = template
+        self._next_seq = start_seq
+        self._items = []
+        self._duplicate_index = DuplicateIndex()
+        self._lock = threading.Lock()
+
+        # Stage new scans in the deepest directory that every output path shares, so
+        # that committing them is a rename on the same volume
+        static_prefix = re.split(r'\{', template, maxsplit=1)[0]
+        self.dirpath = os.path.abspath(os.path.dirname(static_prefix) or '.')
+
+    @property
+    def staging_dir(self) -> str:
+        return os.path.join(self.dirpath, STAGING_DIRNAME)
+
+    def get_abspath(self, image: CollectionImage) -> str:
+        # Paths of images written from a template are always absolute
+        return image.path
+
+    def get_derivative_abspaths(self, image: CollectionImage) -> list[str]:
+        return image.derivatives or []
+
+    def format_path(self, seq: int, side: str, profile_name: str, scanned_at: float, ext: str) -> str:
+        t = time.localtime(scanned_at)
+        return os.path.abspath(self.template.format(
+            seq=seq,
+            side=side,
+            profile=profile_name,
+            date=time.strftime('%Y-%m-%d', t),
+            time=time.strftime('%H%M%S', t),
+            ext=ext,
+        ))
+
+    def find_duplicates(self, dhash: int, max_distance: int = DEFAULT_MAX_DISTANCE) -> list[tuple[int, int]]:
+        # Only images written in this session are known about
+        return self._duplicate_index.find(dhash, max_distance)
+
+    def get_unpaired_fronts(self) -> list[tuple[int, list[list[float]]]]:
+        with self._lock:
+            fronts = [item.front for item in self._items if item.front]
+            if not fronts or not fronts[-1].source:
+                return []
+            source = fronts[-1].source
+            return [(item.seq, item.front.quad) for item in self._items if item.front and item.front.source == source and item.front.quad and item.back is None]
+
+    def add_image(self, filepath: str, is_front: bool, sha256: str, width: int, height: int, profile_name: str, scanned_at: float, quad=None, source=None, pair_seq=None, blank=False, dhash=None, duplicate_of=None, derivative_filepaths=None) -> CollectionItem:
+        side = 'front' if is_front else 'back'
+        with self._lock:
+            item = None
+            if not is_front and pair_seq is None:
+                item = next((x for x in reversed(self._items) if x.back is None), None)
+            elif not is_front and pair_seq != UNPAIRED:
+                item = next((x for x in self._items if x.seq == pair_seq and x.back is None), None)
+            if item is None:
+                item = CollectionItem(len(self._items) + 1, self._next_seq, time.time())
+                self._next_seq += 1
+                self._items.append(item)
+
+            ext = os.path.splitext(filepath)[1].lstrip('.')
+            abspath = self.format_path(item.seq, side, profile_name, scanned_at, ext)
+            stem = os.path.splitext(filepath)[0]
+            derivative_abspaths = [os.path.splitext(abspath)[0] + x[len(stem):] for x in derivative_filepaths or []]
+            for path in [abspath] + derivative_abspaths:
+                if os.path.exists(path):
+                    raise RuntimeError('Output file already exists: %s' % path)
+            os.makedirs(os.path.dirname(abspath), exist_ok=True)
+            for derivative_filepath, derivative_abspath in zip(derivative_filepaths or [], derivative_abspaths):
+                os.replace(derivative_filepath, derivative_abspath)
+            os.replace(filepath, abspath)
+
+            image = CollectionImage(side, abspath, sha256, width, height, profile_name, scanned_at, quad, source, blank, dhash, duplicate_of, derivative_abspaths or None)
+            if is_front:
+                item.front = image
+                if dhash is not None:
+                    self._duplicate_index.add(item.seq, dhash)
+            else:
+                item.back = image
+            return item
@@ -0,0 +1,74 @@
+"""
+Pairing of back scans with front scans, for photos that are flipped over in place on
+the glass between a front pass and a back pass.
+
+A flipped photo lands roughly where it lay before, with the same size and proportions,
+so each back is matched to the front whose position and shape it corresponds to best.
+Every front/back combination is scored at once, as a cost matrix.
+"""
+from __future__ import annotations
+
+from typing import Optional
+
+from ..lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+# Highest cost at which a back is still considered to be the same photo as a front.
+# Costs are in units of the front's long side: a back whose centre has moved by a
+# quarter of the photo's length, with the same size, costs 0.25.
+MAX_PAIR_COST = 0.5
+
+
+def get_quad_features(quads: list) -> np.ndarray:
+    """
+    Returns an array of (centre x, centre y, long side, short side) for each quad,
+    given as four (x, y) corners. Sides are sorted, since which way a photo is flipped
+    doesn't change its shape.
+    """
+    corners = np.asarray(quads, dtype=np.float64).reshape(-1, 4, 2)
+    centres = corners.mean(axis=1)
+    # Average opposite sides, to even out any perspective in the detected outline
+    side_a = (np.linalg.norm(corners[:, 1] - corners[:, 0], axis=1) + np.linalg.norm(corners[:, 2] - corners[:, 3], axis=1)) / 2
+    side_b = (np.linalg.norm(corners[:, 3] - corners[:, 0], axis=1) + np.linalg.norm(corners[:, 2] - corners[:, 1], axis=1)) / 2
+    return np.column_stack([centres, np.maximum(side_a, side_b), np.minimum(side_a, side_b)])
+
+
+def get_pair_costs(front_quads: list, back_quads: list) -> np.ndarray:
+    """
+    Returns a (fronts x backs) matrix of the cost of pairing each front with each back:
+    how far the centre has moved, plus how much the size and the aspect ratio differ,
+    each relative to the front.
+    """
+    fronts = get_quad_features(front_quads)[:, None, :]
+    backs = get_quad_features(back_quads)[None, :, :]
+    long_side = np.maximum(fronts[..., 2], 1.0)
+    short_side = np.maximum(fronts[..., 3], 1.0)
+
+    offset = np.hypot(backs[..., 0] - fronts[..., 0], backs[..., 1] - fronts[..., 1]) / long_side
+    size = np.abs(backs[..., 2] - fronts[..., 2]) / long_side + np.abs(backs[..., 3] - fronts[..., 3]) / short_side
+    aspect = np.abs(np.log(np.maximum(backs[..., 2], 1.0) / np.maximum(backs[..., 3], 1.0)) - np.log(long_side / short_side))
+    return offset + size + aspect
+
+
+def pair_regions(front_quads: list, back_quads: list, max_cost: float = MAX_PAIR_COST) -> list[Optional[int]]:
+    """
+    Matches each back to at most one front, returning the index of the front for each
+    back, or None if no front corresponds closely enough. Pairs are taken cheapest
+    first, so a back that's a near-perfect match for a front always gets it.
+    """
+    assignment: list[Optional[int]] = [None] * len(back_quads)
+    if not front_quads or not back_quads:
+        return assignment
+
+    costs = get_pair_costs(front_quads, back_quads)
+    taken_fronts = set()
+    for flat_index in np.argsort(costs, axis=None):
+        front, back = np.unravel_index(flat_index, costs.shape)
+        if costs[front, back] > max_cost:
+            break
+        if front in taken_fronts or assignment[back] is not None:
+            continue
+        assignment[back] = int(front)
+        taken_fronts.add(front)
+    return assignment
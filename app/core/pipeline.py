@@ -0,0 +1,805 @@
+import os
+import time
+import tempfile
+import threading
+import itertools
+import traceback
+from concurrent.futures import Future
+from functools import partial
+from dataclasses import dataclass, field, replace
+from queue import Queue, Empty
+from typing import Callable, Optional
+
+from .. import g
+from ..config import get_config_var
+from .process import CancelToken, ProcessCancelledError
+from .collection import Collection, CollectionItem, UNPAIRED
+from .journal import JobJournal, JournalEntry, QUEUED, SCANNING, SCANNED, WRITTEN, SPLIT, PROCESSED, COMMITTED, DROPPED, FAILED
+from .naps2.data import NAPS2Install, ProfileConfig, ScanProgress, ScanProgressKind
+from .naps2.scan import invoke_naps2_scan, invoke_naps2_batch_scan
+from .blank import BlankCheck
+from .duplicates import DEFAULT_MAX_DISTANCE
+from .metrics import Timer, metrics
+from .pairing import pair_regions
+from .profiling import profiler
+from .postprocess import PostProcessor, PostProcessResult, parse_postprocess_chain
+
+
+@dataclass(frozen=True)
+class Scanner:
+    """
+    One attached scanner, as the scan stage sees it: the NAPS2 installation to scan
+    with, and the profiles that scan fronts and backs on this particular device.
+    name is only for display; device_id (NAPS2's ID for the device, if known) is what
+    tells two scanners of the same model apart.
+    """
+    name: str
+    install: NAPS2Install
+    front_profile_name: str
+    back_profile_name: str
+    device_id: Optional[str] = None
+
+    @classmethod
+    def from_profile_config(cls, install: NAPS2Install, config: ProfileConfig) -> 'Scanner':
+        profile = config.front_profile or config.back_profile
+        device = profile.device if profile else None
+        name = device.name if device else config.front_profile_name
+        return cls(name, install, config.front_profile_name, config.back_profile_name, device.uuid if device else None)
+
+
+@dataclass
+class ScanJob:
+    """
+    A single requested scan, tracked as it moves through the pipeline: the scan stage
+    has NAPS2 write it to output_filepath (in the pipeline's staging directory), the
+    process stage post-processes that file into new ones in the collection's staging
+    directory, and the commit stage moves the results into the collection.
+
+    Jobs aren't tied to a scanner until one picks them up: at that point, scanner,
+    install and profile_name are filled in.
+
+    If count is anything other than 1, the job is a batch: the scan stage invokes NAPS2
+    once to scan that many pages (or every page in the feeder, if count is 0), and each
+    page continues through the pipeline as its own job, with the same job_id and the
+    page number set.
+
+    Likewise, if post-processing splits a page into several photos, each continues on
+    to the commit stage as its own job, with the region (the photo's number) set, and
+    region_quads holding where every photo from the page was found.
+    """
+    job_id: int
+    is_front: bool
+    output_filepath: str
+    collection: Collection
+    count: int = 1
+    scanner: Optional[str] = None
+    install: Optional[NAPS2Install] = None
+    profile_name: Optional[str] = None
+    page: Optional[int] = None
+    region: Optional[int] = None
+    region_quads: Optional[list] = None
+    queued_at: float = field(default_factory=time.time)
+    scanned_at: Optional[float] = None
+    processed_at: Optional[float] = None
+    result: Optional[PostProcessResult] = None
+    cancel_generation: int = 0
+
+    @property
+    def label(self) -> str:
+        label = 'Job %d' % self.job_id
+        if self.page is not None:
+            label += ' page %d' % self.page
+        if self.region is not None:
+            label += ' photo %d' % self.region
+        return label
+
+
+class PipelineStage:
+    """
+    One stage of the scan pipeline: a background thread that pulls jobs from a queue
+    and runs them through a handler, one at a time. Depth counts jobs that are either
+    waiting in the queue or currently being handled.
+
+    A stage can also be started with several handlers, each run by its own thread; the
+    threads share the queue, so each job goes to whichever thread is free first.
+    """
+
+    def __init__(self, name: str, handler: Callable[[ScanJob], None], on_depth_changed: Optional[Callable[[], None]] = None, on_error: Optional[Callable[[ScanJob, Exception], None]] = None):
+        self.name = name
+        self.handler = handler
+        self.on_depth_changed = on_depth_changed
+        self.on_error = on_error
+        self._queue = Queue()
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    @property
+    def thread_count(self) -> int:
+        return len(self._threads)
+
+    def start(self, handlers: Optional[list[Callable[[ScanJob], None]]] = None):
+        assert not self._threads
+        handlers = [self.handler] if handlers is None else handlers
+        for index, handler in enumerate(handlers):
+            name = 'fscan-%s' % self.name if len(handlers) == 1 else 'fscan-%s-%d' % (self.name, index + 1)
+            thread = threading.Thread(target=self._run, args=(handler,), name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        # Each thread exits when it takes a sentinel from the queue, once all the jobs
+        # ahead of it have been handled
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def put(self, job: ScanJob):
+        self._adjust_depth(1)
+        self._queue.put(job)
+
+    def clear(self) -> list[ScanJob]:
+        """
+        Discards any jobs that are still waiting in the queue (but not the one that's
+        currently being handled, if any), returning the discarded jobs.
+        """
+        discarded = []
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except Empty:
+                break
+            if job is None:
+                self._queue.put(None)
+                break
+            discarded.append(job)
+            self._adjust_depth(-1)
+        return discarded
+
+    def _adjust_depth(self, delta: int):
+        with self._lock:
+            self._depth += delta
+            metrics.gauge('fscan_stage_depth', stage=self.name).set(self._depth)
+        if self.on_depth_changed:
+            self.on_depth_changed()
+
+    def _run(self, handler: Callable[[ScanJob], None]):
+        histogram = metrics.histogram('fscan_stage_seconds', stage=self.name)
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                with Timer(histogram), profiler.profile():
+                    handler(job)
+            except Exception as exc:
+                g.log.error('%s failed in %s stage:' % (job.label, self.name))
+                for line in traceback.format_exc().splitlines():
+                    g.log.error(line)
+                if self.on_error:
+                    self.on_error(job, exc)
+            finally:
+                self._adjust_depth(-1)
+
+
+def _get_postprocess_ops():
+    chain = get_config_var('POSTPROCESS_CHAIN', '')
+    try:
+        return parse_postprocess_chain(chain)
+    except ValueError as exc:
+        g.log.error('Ignoring invalid POSTPROCESS_CHAIN: %s' % exc)
+        return []
+
+
+def _get_blank_check() -> BlankCheck:
+    try:
+        return BlankCheck.from_config()
+    except ValueError as exc:
+        g.log.error('Not checking for blank backs: %s' % exc)
+        return BlankCheck('keep')
+
+
+def _get_duplicate_max_distance() -> int:
+    value = get_config_var('DUPLICATE_MAX_DISTANCE', str(DEFAULT_MAX_DISTANCE))
+    try:
+        return int(value)
+    except ValueError:
+        g.log.error('Ignoring invalid DUPLICATE_MAX_DISTANCE: %s (using %d)' % (value, DEFAULT_MAX_DISTANCE))
+        return DEFAULT_MAX_DISTANCE
+
+
+def _get_staging_dir() -> str:
+    # Raw scans are written once and read once, by post-processing, so by default they
+    # never go near the collection's disk: they're staged in RAM where there's a tmpfs
+    # to do it with, or else in the system's temp directory. Windows has no tmpfs, so
+    # there that's on disk unless SCAN_STAGING_DIR points at a RAM disk
+    value = get_config_var('SCAN_STAGING_DIR')
+    if value:
+        dirpath = os.path.abspath(os.path.expanduser(value))
+        g.log.info('Staging scans in %s (SCAN_STAGING_DIR).' % dirpath)
+    elif os.path.isdir('/dev/shm'):
+        dirpath = os.path.join('/dev/shm', 'FScan')
+        g.log.info('Staging scans in RAM, in %s.' % dirpath)
+    else:
+        dirpath = os.path.join(tempfile.gettempdir(), 'FScan')
+        g.log.info('Staging scans on disk, in %s: set SCAN_STAGING_DIR to a RAM disk to keep them in memory.' % dirpath)
+    return dirpath
+
+
+def _get_postprocess_workers() -> Optional[int]:
+    # None (unset, or 0) for one worker per core
+    value = get_config_var('POSTPROCESS_WORKERS')
+    if not value:
+        return None
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = -1
+    if workers < 0:
+        g.log.error('Ignoring invalid POSTPROCESS_WORKERS: %s (using one per core)' % value)
+        return None
+    return workers or None
+
+
+def _get_batch_delay_ms() -> int:
+    value = get_config_var('SCAN_BATCH_DELAY_MS', '0')
+    try:
+        delay_ms = int(value)
+    except ValueError:
+        delay_ms = -1
+    if delay_ms < 0:
+        g.log.error('Ignoring invalid SCAN_BATCH_DELAY_MS: %s (using 0)' % value)
+        return 0
+    return delay_ms
+
+
+def _get_scan_timeout_seconds() -> float:
+    value = get_config_var('SCAN_TIMEOUT_SECONDS', '300')
+    try:
+        return float(value)
+    except ValueError:
+        g.log.error('Ignoring invalid SCAN_TIMEOUT_SECONDS: %s (using 300)' % value)
+        return 300.0
+
+
+def _get_scan_timeout(seconds: float, count: int) -> Optional[float]:
+    # Scans of the entire feeder could take any amount of time; otherwise, allow each
+    # page the configured amount of time (5 minutes by default) before giving up
+    if seconds <= 0 or count == 0:
+        return None
+    return seconds * count
+
+
+def _get_batch_prefix(output_filepath: str) -> str:
+    # Batch scans write each page alongside where a single scan would have gone, with
+    # the page number appended
+    return os.path.splitext(os.path.basename(output_filepath))[0] + '_p'
+
+
+def _record_postprocess_metrics(job: ScanJob, results: list[PostProcessResult]):
+    """
+    Records how long a page waited for a worker and took to post-process, and how long
+    each step took. Photos split from a page share the steps up to the split, which are
+    recorded once; each photo's own steps are recorded for each.
+    """
+    if not results or job.scanned_at is None:
+        return
+    started_at = results[0].started_at
+    metrics.histogram('fscan_stage_seconds', stage='wait').record(max(0.0, started_at - job.scanned_at))
+    metrics.histogram('fscan_stage_seconds', stage='process').record(job.processed_at - started_at)
+
+    shared = 0
+    while all(len(result.timings) > shared and result.timings[shared] == results[0].timings[shared] for result in results):
+        shared += 1
+    timings = results[0].timings[:shared] + [timing for result in results for timing in result.timings[shared:]]
+    for name, seconds in timings:
+        if name.startswith('encode '):
+            metrics.histogram('fscan_encode_seconds', output=name[len('encode '):]).record(seconds)
+        else:
+            metrics.histogram('fscan_postprocess_seconds', step=name).record(seconds)
+
+
+def _remove_file(filepath: Optional[str]):
+    if filepath and os.path.isfile(filepath):
+        os.remove(filepath)
+
+
+class ScanPipeline:
+    """
+    Runs scan jobs through three stages: the scan stage invokes NAPS2 for each queued
+    job back-to-back, the process stage post-processes the files that NAPS2 has already
+    written in a pool of worker processes, and the commit stage handles the results.
+    The scanner never sits idle waiting on disk or CPU work for the previous job.
+
+    The scan stage runs one thread per scanner (see set_scanners()), all pulling from
+    the same queue: each job goes to whichever scanner is free first, so with several
+    scanners attached, they all scan at once.
+
+    Jobs are committed to whatever the caller passes as the collection when submitting
+    them: a Collection, or anything with the same staging_dir and add_image() (e.g. a
+    TemplateOutput). on_failed is called with a short description if a job (or a page
+    of a batch job) fails in any stage or is cancelled. on_scanned is called once the
+    scan stage is done with a job, whether or not NAPS2 succeeded, with the number of
+    pages that landed: each is then either committed or failed. If post-processing
+    splits a page into several photos, on_split is called with the number of photos,
+    each of which is then committed or failed in turn. A page whose every image is
+    blank, with BLANK_BACK_ACTION=drop, is neither: on_dropped is called instead.
+
+    If given a journal, the pipeline records every job's progress in it as it goes, and
+    recover() can pick up where a previous session left off (see JobJournal).
+
+    NAPS2 writes each scan to the staging directory (SCAN_STAGING_DIR, RAM-backed by
+    default), and only the post-processed outputs are written to the collection's own
+    staging directory, so that the collection's disk never sees the full-size scans.
+    """
+
+    def __init__(self, on_depth_changed: Optional[Callable[[], None]] = None, on_progress: Optional[Callable[[ScanJob, ScanProgress], None]] = None, on_committed: Optional[Callable[[ScanJob, CollectionItem], None]] = None, on_failed: Optional[Callable[[ScanJob, str], None]] = None, journal: Optional[JobJournal] = None, on_scanned: Optional[Callable[[ScanJob, int], None]] = None, on_split: Optional[Callable[[ScanJob, int], None]] = None, on_dropped: Optional[Callable[[ScanJob], None]] = None):
+        self.on_progress = on_progress
+        self.on_dropped = on_dropped
+        self.on_scanned = on_scanned
+        self.on_split = on_split
+        self.on_committed = on_committed
+        self.on_failed = on_failed
+        self.journal = journal
+        self.scan_stage = PipelineStage('scan', self._scan, on_depth_changed, self._on_stage_error)
+        self.process_stage = PostProcessor('process', _get_postprocess_ops(), _get_postprocess_workers(), on_depth_changed, _get_blank_check())
+        self.commit_stage = PipelineStage('commit', self._commit, on_depth_changed, self._on_stage_error)
+        self.scanners: list[Scanner] = []
+        # Every cancel() bumps the generation, and cancels any job queued before it: even
+        # one that a scan thread has already taken off the queue but not yet started
+        self._cancel_generation = 0
+        self._cancel_tokens: dict[int, CancelToken] = {}
+        self._cancel_lock = threading.Lock()
+        self._started = False
+        self._pair_seqs: dict[str, list[Optional[int]]] = {}
+        self._duplicate_max_distance = _get_duplicate_max_distance()
+        self._scan_timeout_seconds = _get_scan_timeout_seconds()
+        self._batch_delay_ms = _get_batch_delay_ms()
+        self._staging_dir = _get_staging_dir()
+        self._job_ids = itertools.count(1)
+        self._job_id_lock = threading.Lock()
+        self._session = time.strftime('%Y%m%d-%H%M%S')
+
+    @property
+    def is_idle(self) -> bool:
+        # Each stage hands a job on to the next before letting go of it, so this is never
+        # momentarily true while a job is between stages
+        return not any(self.depths.values())
+
+    @property
+    def depths(self) -> dict[str, int]:
+        return {
+            self.scan_stage.name: self.scan_stage.depth,
+            self.process_stage.name: self.process_stage.depth,
+            self.commit_stage.name: self.commit_stage.depth,
+        }
+
+    def start(self):
+        self._started = True
+        self.scan_stage.start(self._get_scan_handlers())
+        self.process_stage.start()
+        self.commit_stage.start()
+
+    def set_scanners(self, scanners: list[Scanner]):
+        """
+        Sets the scanners that jobs are dispatched to, one scan thread apiece. Should be
+        called while no scans are in progress: if the pipeline is running, any jobs that
+        are already queued are scanned with the previous scanners first.
+        """
+        if scanners == self.scanners:
+            return
+        if not scanners and self.scan_stage.depth > 0:
+            # With no scan threads left, queued jobs would never be picked up
+            self._discard_queued_scans()
+        device_ids = [scanner.device_id for scanner in scanners if scanner.device_id]
+        for device_id in set(device_ids):
+            if device_ids.count(device_id) > 1:
+                name = next(scanner.name for scanner in scanners if scanner.device_id == device_id)
+                g.log.warning("%d scanner configs use the same device ('%s'): scans on it will contend for the device." % (device_ids.count(device_id), name))
+
+        # Scanners of the same model have the same name: number them, to tell them apart
+        # in the log and the UI
+        names = [scanner.name for scanner in scanners]
+        scanners = [replace(scanner, name='%s #%d' % (scanner.name, index + 1)) if names.count(scanner.name) > 1 else scanner for index, scanner in enumerate(scanners)]
+
+        if self._started:
+            self.scan_stage.stop()
+        self.scanners = scanners
+        if self._started:
+            self.scan_stage.start(self._get_scan_handlers())
+        if len(scanners) > 1:
+            g.log.info('Scanning with %d scanners: %s.' % (len(scanners), ', '.join(scanner.name for scanner in scanners)))
+
+    def _get_scan_handlers(self) -> list[Callable[[ScanJob], None]]:
+        return [partial(self._scan, scanner) for scanner in self.scanners]
+
+    def stop(self):
+        # Scans that haven't started yet are abandoned, but anything that's already
+        # been scanned is allowed to finish processing
+        self._discard_queued_scans()
+        self.scan_stage.stop()
+        self.process_stage.stop()
+        self.commit_stage.stop()
+        self._started = False
+        if self.journal:
+            self.journal.close()
+
+    def cancel(self):
+        """
+        Discards all queued scans, and kills NAPS2 if it's currently scanning. Pages that
+        have already been scanned continue through the pipeline. Safe to call from any
+        thread.
+        """
+        with self._cancel_lock:
+            self._cancel_generation += 1
+            tokens = list(self._cancel_tokens.values())
+        self._discard_queued_scans()
+        if self.scan_stage.depth > 0:
+            g.log.warning('Cancelling the current scan(s).')
+            for token in tokens:
+                token.cancel()
+
+    def _discard_queued_scans(self):
+        discarded = self.scan_stage.clear()
+        if discarded:
+            g.log.warning('Discarding %d queued scan(s).' % len(discarded))
+        for job in discarded:
+            self._fail(job, 'cancelled')
+
+    def _fail(self, job: ScanJob, reason: str):
+        metrics.counter('fscan_pages_failed_total').inc()
+        self._record(job, FAILED, reason=reason)
+        # FAILED is final, so nothing else would ever remove the raw scan from staging.
+        # (A whole batch's output_filepath is only the pattern its pages are named by.)
+        if job.count == 1 or job.page is not None:
+            _remove_file(job.output_filepath)
+        if self.on_failed:
+            self.on_failed(job, reason)
+
+    def _on_stage_error(self, job: ScanJob, exc: Exception):
+        self._fail(job, str(exc) or type(exc).__name__)
+
+    def _get_journal_entry(self, job: ScanJob, state: str, reason: Optional[str] = None) -> JournalEntry:
+        result = job.result
+        return JournalEntry(
+            self._session, job.job_id, job.page, state, time.time(), job.is_front, job.count, job.collection.dirpath, job.output_filepath,
+            job.scanner, job.profile_name, job.scanned_at,
+            result.output_filepath if result else None, result.sha256 if result else None, result.width if result else None, result.height if result else None,
+            reason, job.region, result.quad if result else None, result.blank if result else None, result.dhash if result else None,
+            result.derivatives if result else None,
+        )
+
+    def _record(self, job: ScanJob, state: str, reason: Optional[str] = None, regions: Optional[list[ScanJob]] = None):
+        if not self.journal:
+            return
+        entries = [self._get_journal_entry(region, PROCESSED) for region in regions or []]
+        entries.append(self._get_journal_entry(job, state, reason))
+        try:
+            self.journal.append(*entries)
+        except OSError as exc:
+            # Losing the journal shouldn't stop the scan: it only matters after a crash
+            g.log.error('Failed to write to the job journal at %s: %s' % (self.journal.filepath, exc))
+
+    def recover(self, open_collection: Callable[[str], Optional[Collection]]) -> int:
+        """
+        Replays the journal left by previous sessions: pages that were scanned but never
+        committed are processed and committed now (or just committed, if they'd already
+        been processed), rather than scanned again. Jobs that were interrupted before
+        their pages were written are cleaned up and reported. open_collection is called
+        to get the collection for each job's directory. Returns the number of pages
+        resumed.
+        """
+        if not self.journal:
+            return 0
+        entries = self.journal.replay()
+        if not entries:
+            return 0
+        g.log.info('Found %d unfinished job(s) in the job journal.' % len(entries))
+
+        collections = {}
+        resumed = []
+        staged_filepaths = set()
+        for entry in entries:
+            if entry.state in (WRITTEN, PROCESSED):
+                staged_filepaths.update(filepath for filepath in [entry.output_filepath, entry.processed_filepath] + (entry.derivatives or []) if filepath)
+        for entry in entries:
+            if entry.collection not in collections:
+                collections[entry.collection] = open_collection(entry.collection) if os.path.isdir(entry.collection) else None
+            job = self._recover_entry(entry, collections[entry.collection], staged_filepaths)
+            if job:
+                resumed.append(job)
+
+        # Start over with a journal of just the resumed jobs, under their new IDs, before
+        # handing them on: at no point does the journal lose track of a staged page
+        self.journal.compact([])
+        for job in resumed:
+            self._record(job, PROCESSED if job.result else WRITTEN)
+        for job in resumed:
+            if job.result:
+                self.commit_stage.put(job)
+            else:
+                self._submit_processing(job)
+        if resumed:
+            g.log.info('Resuming %d page(s) that were scanned in a previous session.' % len(resumed))
+        return len(resumed)
+
+    def _recover_entry(self, entry: JournalEntry, collection: Optional[Collection], staged_filepaths: set[str]) -> Optional[ScanJob]:
+        if entry.state == QUEUED:
+            g.log.warning('%s was queued but never scanned: scan it again.' % entry.label)
+            return None
+        if entry.state == SCANNING:
+            # Whatever NAPS2 got as far as writing can't be trusted to be complete
+            g.log.warning('%s was interrupted while scanning: scan it again.' % entry.label)
+            if entry.count == 1:
+                _remove_file(entry.output_filepath)
+            else:
+                # Pages of a batch that were journaled as written are resumed on their
+                # own; anything else NAPS2 left behind goes
+                output_dir = os.path.dirname(entry.output_filepath)
+                prefix = _get_batch_prefix(entry.output_filepath)
+                for filename in os.listdir(output_dir) if os.path.isdir(output_dir) else []:
+                    filepath = os.path.join(output_dir, filename)
+                    if filename.startswith(prefix) and filepath not in staged_filepaths:
+                        _remove_file(filepath)
+            return None
+
+        assert entry.state in (WRITTEN, PROCESSED), entry.state
+        if collection is None:
+            g.log.error('%s can\'t be resumed: its collection at %s is unavailable.' % (entry.label, entry.collection))
+            return None
+        if entry.state == PROCESSED and entry.sha256 and collection.has_image(entry.sha256):
+            # Committed, but the app went down before the journal said so
+            g.log.info('%s was already committed.' % entry.label)
+            _remove_file(entry.output_filepath)
+            return None
+
+        job = ScanJob(self.allocate_job_id(), entry.is_front, entry.output_filepath, collection, entry.count, entry.scanner, None, entry.profile_name, entry.page, entry.region, scanned_at=entry.scanned_at or entry.time)
+        if entry.state == PROCESSED and entry.processed_filepath and os.path.isfile(entry.processed_filepath):
+            job.processed_at = time.time()
+            # Derived copies are only a convenience: commit whichever of them survived
+            derivatives = [filepath for filepath in entry.derivatives or [] if os.path.isfile(filepath)]
+            job.result = PostProcessResult(entry.processed_filepath, entry.width, entry.height, entry.sha256, job.processed_at, quad=entry.quad, blank=bool(entry.blank), dhash=entry.dhash, derivatives=derivatives)
+        elif entry.region is not None:
+            # Post-processing the scan again would split out every photo, not just this one
+            g.log.error('%s can\'t be resumed: its processed image is missing from %s.' % (entry.label, entry.processed_filepath))
+            return None
+        elif not os.path.isfile(entry.output_filepath):
+            g.log.error('%s can\'t be resumed: its scanned image is missing from %s.' % (entry.label, entry.output_filepath))
+            return None
+        g.log.info('%s: resuming %s as %s.' % (job.label, entry.label.lower(), 'a commit' if job.result else 'post-processing'))
+        return job
+
+    def allocate_job_id(self) -> int:
+        """
+        Reserves a job ID ahead of submitting a job, so that callers can refer to the job
+        before it's been handed to the pipeline. Safe to call from any thread.
+        """
+        with self._job_id_lock:
+            return next(self._job_ids)
+
+    def submit(self, is_front: bool, collection: Collection, count: int = 1, job_id: Optional[int] = None) -> ScanJob:
+        if not self.scanners:
+            raise RuntimeError('No scanners are configured')
+        if job_id is None:
+            job_id = self.allocate_job_id()
+        output_filepath = os.path.join(self._staging_dir, 'scan_%s_%03d.png' % (self._session, job_id))
+        job = ScanJob(job_id, is_front, output_filepath, collection, count, cancel_generation=self._cancel_generation)
+        if count == 1:
+            g.log.info('Queued scan job %d (%s).' % (job.job_id, 'front' if is_front else 'back'))
+        else:
+            g.log.info('Queued batch scan job %d (%s; %s).' % (job.job_id, 'front' if is_front else 'back', ('%d pages' % count) if count else 'all pages in feeder'))
+        self._record(job, QUEUED)
+        metrics.counter('fscan_jobs_queued_total').inc()
+        self.scan_stage.put(job)
+        return job
+
+    def _scan(self, scanner: Scanner, job: ScanJob):
+        job.scanner = scanner.name
+        job.install = scanner.install
+        job.profile_name = scanner.front_profile_name if job.is_front else scanner.back_profile_name
+        if len(self.scanners) > 1:
+            g.log.info('%s: scanning on %s.' % (job.label, scanner.name))
+
+        output_dir = os.path.dirname(job.output_filepath)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        with self._cancel_lock:
+            cancelled = job.cancel_generation != self._cancel_generation
+            if not cancelled:
+                cancel_token = self._cancel_tokens[job.job_id] = CancelToken()
+        if cancelled:
+            g.log.warning('%s cancelled.' % job.label)
+            self._fail(job, 'cancelled')
+            return
+
+        self._record(job, SCANNING)
+        acquired_at = {}
+        written = []
+        on_progress = partial(self._on_scan_progress, job, acquired_at, [time.time()])
+        timeout = _get_scan_timeout(self._scan_timeout_seconds, job.count)
+        try:
+            try:
+                self._invoke_scan(job, output_dir, on_progress, timeout, cancel_token, acquired_at, written)
+            except BaseException:
+                self._remove_unlanded_pages(job, written)
+                raise
+            finally:
+                # Before the job can fail, so that anyone waiting on it knows to wait for
+                # the pages that did land
+                if self.on_scanned:
+                    self.on_scanned(job, len(written))
+        except ProcessCancelledError:
+            g.log.warning('%s cancelled.' % job.label)
+            self._fail(job, 'cancelled')
+        finally:
+            with self._cancel_lock:
+                del self._cancel_tokens[job.job_id]
+
+    def _remove_unlanded_pages(self, job: ScanJob, written: list[ScanJob]):
+        # Whatever a failed batch scan was in the middle of writing never landed, and
+        # nothing else will ever clean it up (a single scan's file goes when it fails)
+        if job.count == 1:
+            return
+        output_dir = os.path.dirname(job.output_filepath)
+        prefix = _get_batch_prefix(job.output_filepath)
+        landed = set(page_job.output_filepath for page_job in written)
+        for filename in os.listdir(output_dir) if os.path.isdir(output_dir) else []:
+            filepath = os.path.join(output_dir, filename)
+            if filename.startswith(prefix) and filepath not in landed:
+                _remove_file(filepath)
+
+    def _on_scan_progress(self, job: ScanJob, acquired_at: dict[int, float], last_acquired_at: list[float], progress: ScanProgress):
+        # Time how long the scanner takes to deliver each page, and note when it did, to
+        # time how long it then takes to land on disk
+        if progress.kind == ScanProgressKind.PAGE_ACQUIRED:
+            now = time.time()
+            metrics.histogram('fscan_stage_seconds', stage='acquire').record(now - last_acquired_at[0])
+            last_acquired_at[0] = acquired_at[progress.page or 1] = now
+        if self.on_progress:
+            self.on_progress(job, progress)
+
+    def _on_page_written(self, job: ScanJob, acquired_at: Optional[float], written: list[ScanJob]):
+        written.append(job)
+        metrics.counter('fscan_pages_scanned_total').inc()
+        if acquired_at is not None:
+            metrics.histogram('fscan_stage_seconds', stage='write').record(job.scanned_at - acquired_at)
+
+    def _invoke_scan(self, job: ScanJob, output_dir: str, on_progress, timeout: Optional[float], cancel_token: CancelToken, acquired_at: dict[int, float], written: list[ScanJob]):
+        if job.count == 1:
+            invoke_naps2_scan(job.install, job.profile_name, job.output_filepath, on_progress, timeout, cancel_token)
+            job.scanned_at = time.time()
+            self._on_page_written(job, acquired_at.get(1), written)
+            self._record(job, WRITTEN)
+            self._submit_processing(job)
+            return
+
+        # Batch scans stream each page into the process stage as soon as it lands
+        def on_page(page: int, filepath: str):
+            page_job = replace(job, output_filepath=filepath, page=page, scanned_at=time.time())
+            self._on_page_written(page_job, acquired_at.get(page), written)
+            self._record(page_job, WRITTEN)
+            self._submit_processing(page_job)
+        invoke_naps2_batch_scan(job.install, job.profile_name, output_dir, _get_batch_prefix(job.output_filepath), job.count, on_page, self._batch_delay_ms, on_progress, timeout, cancel_token)
+        self._record(job, SCANNED)
+
+    def _submit_processing(self, job: ScanJob):
+        # Outputs are written where they can be moved into the collection with a rename
+        output_dir = job.collection.staging_dir
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+        output_stem = os.path.join(output_dir, os.path.splitext(os.path.basename(job.output_filepath))[0] + '_processed')
+        # Only backs are checked for being blank: fronts are always kept
+        self.process_stage.submit(job.output_filepath, output_stem, partial(self._on_processed, job), check_blank=not job.is_front)
+
+    def _on_processed(self, job: ScanJob, future: Future):
+        exc = future.exception()
+        if exc:
+            g.log.error('%s failed in %s stage: %s' % (job.label, self.process_stage.name, exc))
+            self._fail(job, str(exc) or type(exc).__name__)
+            return
+        job.processed_at = time.time()
+        results = future.result()
+        _record_postprocess_metrics(job, results)
+        if not results:
+            g.log.info('%s: back is blank; dropped.' % job.label)
+            metrics.counter('fscan_pages_dropped_total').inc()
+            self._record(job, DROPPED)
+            _remove_file(job.output_filepath)
+            if self.on_dropped:
+                self.on_dropped(job)
+            return
+        if len(results) == 1:
+            job.result = results[0]
+            job.region_quads = [job.result.quad] if job.result.quad else None
+            self._record(job, PROCESSED)
+            self.commit_stage.put(job)
+            return
+
+        # Each photo split from the page becomes an item of its own, committed in
+        # reading order
+        blanks = sum(1 for result in results if result.blank)
+        g.log.info('%s: found %d photos%s.' % (job.label, len(results), (' (%d blank)' % blanks) if blanks else ''))
+        region_quads = [result.quad for result in results]
+        regions = [replace(job, region=index + 1, result=result, region_quads=region_quads) for index, result in enumerate(results)]
+        self._record(job, SPLIT, regions=regions)
+        if self.on_split:
+            self.on_split(job, len(regions))
+        for region in regions:
+            self.commit_stage.put(region)
+
+    def _commit(self, job: ScanJob):
+        result = job.result
+        assert result and job.scanned_at and job.processed_at
+        waited = result.started_at - job.scanned_at
+        elapsed = job.processed_at - result.started_at
+        g.log.info('%s: post-processed to %dx%d in %.2fs (waited %.2fs; %s).' % (
+            job.label, result.width, result.height, elapsed, waited,
+            ', '.join('%s %.3fs' % (name, seconds) for name, seconds in result.timings)
+        ))
+
+        source = '%s/%d/%d' % (self._session, job.job_id, job.page or 0)
+        pair_seq = self._get_pair_seq(job, source) if not job.is_front and result.quad else None
+        duplicate_of = self._find_duplicate(job) if job.is_front and result.dhash is not None else None
+        item = job.collection.add_image(
+            result.output_filepath, job.is_front, result.sha256, result.width, result.height, job.profile_name, job.scanned_at,
+            result.quad, source, pair_seq, result.blank, result.dhash, duplicate_of, result.derivatives,
+        )
+        self._record(job, COMMITTED)
+        metrics.counter('fscan_items_committed_total', side='front' if job.is_front else 'back').inc()
+        metrics.histogram('fscan_stage_seconds', stage='post_scan').record(time.time() - job.scanned_at)
+        _remove_file(job.output_filepath)
+        g.log.info('%s: committed as item #%d (%s).' % (job.label, item.seq, 'front' if job.is_front else ('blank back' if result.blank else 'back')))
+        if self.on_committed:
+            self.on_committed(job, item)
+
+    def _find_duplicate(self, job: ScanJob) -> Optional[int]:
+        """
+        Returns the seq of the item that a new front looks most like a rescan of, if any,
+        by comparing perceptual hashes with every front already in the collection.
+        """
+        t = time.perf_counter()
+        matches = job.collection.find_duplicates(job.result.dhash, self._duplicate_max_distance)
+        elapsed = time.perf_counter() - t
+        if not matches:
+            return None
+        seq, distance = matches[0]
+        metrics.counter('fscan_duplicates_flagged_total').inc()
+        g.log.warning('%s: looks like a rescan of item #%d (%d of 64 bits differ; checked in %.1fms).' % (job.label, seq, distance, elapsed * 1000))
+        return seq
+
+    def _get_pair_seq(self, job: ScanJob, source: str) -> Optional[int]:
+        """
+        Returns the seq of the front that a back photo should be paired with: all the
+        photos from one back scan are matched against the fronts of the last front scan
+        together, when the first of them is committed. Returns UNPAIRED for a photo that
+        matches no front, or None if there are no fronts to pair with (in which case the
+        collection pairs the back the same way as any other).
+        """
+        if job.region_quads is None:
+            # A photo resumed on its own, after a restart
+            back_quads, index = [job.result.quad], 0
+        else:
+            back_quads, index = job.region_quads, (job.region or 1) - 1
+
+        pair_seqs = self._pair_seqs.get(source)
+        if pair_seqs is None:
+            fronts = job.collection.get_unpaired_fronts()
+            if fronts:
+                assignment = pair_regions([quad for _, quad in fronts], back_quads)
+                pair_seqs = [fronts[front][0] if front is not None else UNPAIRED for front in assignment]
+                g.log.info('%s: paired %d of %d back(s) with the %d front(s) from the last front scan.' % (
+                    job.label, sum(1 for seq in pair_seqs if seq != UNPAIRED), len(back_quads), len(fronts)
+                ))
+            else:
+                pair_seqs = [None] * len(back_quads)
+            self._pair_seqs[source] = pair_seqs
+        if index == len(pair_seqs) - 1:
+            del self._pair_seqs[source]
+        return pair_seqs[index]
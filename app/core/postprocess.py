@@ -0,0 +1,431 @@
+from __future__ import annotations
+
+import os
+import re
+import mmap
+import time
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Union
+
+from ..lazyimport import lazy_import
+from .blank import BlankCheck
+from .detect import detect_photos, extract_photo
+from .duplicates import compute_dhash
+from .metrics import metrics
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+OP_REGEX = re.compile(r'\s*([a-z]+)\s*\(([^)]*)\)\s*;?')
+
+# Most threads in each worker process that encode and write the outputs of an image
+# (its master and derived copies) at the same time. OpenCV and hashlib release the GIL
+# while they work, so the outputs really do run in parallel.
+ENCODE_THREADS = 4
+
+_encode_pool = None
+_encode_threads = ENCODE_THREADS
+
+
+@dataclass
+class CropOp:
+    """ Crops the image to the rectangle at (x, y) with size (w, h), in pixels. """
+    x: int
+    y: int
+    w: int
+    h: int
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        return image[self.y:self.y + self.h, self.x:self.x + self.w]
+
+
+@dataclass
+class RotateOp:
+    """ Rotates the image clockwise by the given number of degrees. """
+    degrees: float
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        degrees = self.degrees % 360
+        if degrees == 0:
+            return image
+        if degrees == 90:
+            return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+        if degrees == 180:
+            return cv2.rotate(image, cv2.ROTATE_180)
+        if degrees == 270:
+            return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+        # Arbitrary angles: expand the canvas so that no corners are clipped
+        h, w = image.shape[:2]
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), -degrees, 1.0)
+        cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+        new_w, new_h = int(h * sin + w * cos), int(h * cos + w * sin)
+        matrix[0, 2] += new_w / 2 - w / 2
+        matrix[1, 2] += new_h / 2 - h / 2
+        return cv2.warpAffine(image, matrix, (new_w, new_h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
+@dataclass
+class LevelsOp:
+    """ Remaps input levels [black, white] to the full range, with optional gamma. """
+    black: int
+    white: int
+    gamma: float = 1.0
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        x = (np.arange(256, dtype=np.float32) - self.black) / max(1, self.white - self.black)
+        lut = np.clip(np.power(np.clip(x, 0.0, 1.0), 1.0 / self.gamma) * 255.0 + 0.5, 0, 255).astype(np.uint8)
+        return cv2.LUT(image, lut)
+
+
+@dataclass
+class ResizeOp:
+    """ Scales the image by the given factor. """
+    scale: float
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        interpolation = cv2.INTER_AREA if self.scale < 1.0 else cv2.INTER_CUBIC
+        return cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=interpolation)
+
+
+@dataclass
+class EncodeOp:
+    """
+    Selects the format the processed image is written in: ext is a file extension
+    that OpenCV can encode (e.g. 'png', 'tiff', 'jpg'), and level is the PNG compression
+    level, TIFF compression scheme (1 for none, 5 for LZW, 8 for Deflate) or JPEG/WebP
+    quality, if given.
+    """
+    ext: str = 'png'
+    level: Optional[int] = None
+
+    @property
+    def params(self) -> list[int]:
+        if self.level is None:
+            return []
+        if self.ext == 'png':
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.level]
+        if self.ext in ('jpg', 'jpeg'):
+            return [cv2.IMWRITE_JPEG_QUALITY, self.level]
+        if self.ext == 'webp':
+            return [cv2.IMWRITE_WEBP_QUALITY, self.level]
+        if self.ext in ('tif', 'tiff'):
+            return [cv2.IMWRITE_TIFF_COMPRESSION, self.level]
+        return []
+
+
+@dataclass
+class DeriveOp:
+    """
+    Also writes a copy of the processed image for viewing or sharing, alongside the
+    master: scaled down so that its longest side is at most size pixels (0 to keep the
+    full size), in format ext, with level as for EncodeOp. A chain can derive any number
+    of copies, wherever it is in the chain; they're all made from the final image, in
+    parallel with the master.
+    """
+    ext: str = 'jpg'
+    size: int = 0
+    level: Optional[int] = None
+
+    @property
+    def label(self) -> str:
+        return '%s@%s' % (self.ext, self.size or 'full')
+
+    @property
+    def params(self) -> list[int]:
+        return EncodeOp(self.ext, self.level).params
+
+    def get_filepath(self, stem: str) -> str:
+        return '%s_%s.%s' % (stem, self.size or 'full', self.ext)
+
+
+@dataclass
+class SplitOp:
+    """
+    Splits a scan of several photos laid on the glass at once into one image per photo,
+    each cropped and straightened (see detect_photos()). Finds at most max_photos, no
+    smaller than min_area percent of the scan. Operations after this one in the chain
+    apply to each photo separately. If no photos are found, the whole scan is kept.
+    """
+    max_photos: int = 6
+    min_area: float = 2.0
+
+    def split(self, image: np.ndarray) -> list[tuple[np.ndarray, Optional[list[list[float]]]]]:
+        photos = detect_photos(image, self.max_photos, self.min_area / 100.0)
+        if not photos:
+            return [(image, None)]
+        return [(extract_photo(image, photo), photo.quad.round(1).tolist()) for photo in photos]
+
+
+PostProcessOp = Union[CropOp, RotateOp, LevelsOp, ResizeOp, EncodeOp, DeriveOp, SplitOp]
+
+OP_TYPES = {
+    'crop': (CropOp, (int, int, int, int)),
+    'rotate': (RotateOp, (float,)),
+    'levels': (LevelsOp, (int, int, float)),
+    'resize': (ResizeOp, (float,)),
+    'encode': (EncodeOp, (str, int)),
+    'derive': (DeriveOp, (str, int, int)),
+    'split': (SplitOp, (int, float)),
+}
+
+
+def parse_postprocess_chain(s: str) -> list[PostProcessOp]:
+    """
+    Parses a chain of post-processing operations from a string such as
+    'rotate(90); levels(8, 248); resize(0.5); encode(png, 3); derive(jpg, 2048, 90)'.
+    Raises ValueError if the string can't be parsed.
+    """
+    ops = []
+    pos = 0
+    s = s.strip()
+    while pos < len(s):
+        match = OP_REGEX.match(s, pos)
+        if not match:
+            raise ValueError('Invalid post-processing chain at position %d: %s' % (pos, s[pos:]))
+        name, args_str = match.group(1), match.group(2)
+        if name not in OP_TYPES:
+            raise ValueError("Unknown post-processing operation '%s'" % name)
+        op_class, arg_types = OP_TYPES[name]
+        args = [x.strip() for x in args_str.split(',')] if args_str.strip() else []
+        if len(args) > len(arg_types):
+            raise ValueError("Too many arguments to '%s': %s" % (name, args_str))
+        try:
+            ops.append(op_class(*[arg_type(arg) for arg_type, arg in zip(arg_types, args)]))
+        except (TypeError, ValueError) as exc:
+            raise ValueError("Invalid arguments to '%s': %s (%s)" % (name, args_str, exc))
+        pos = match.end()
+
+    labels = [op.label for op in ops if isinstance(op, DeriveOp)]
+    for label in set(labels):
+        if labels.count(label) > 1:
+            raise ValueError("More than one derived copy would be written as '%s'" % label)
+    return ops
+
+
+@dataclass
+class PostProcessResult:
+    output_filepath: str
+    width: int
+    height: int
+    sha256: str
+    started_at: float
+    timings: list[tuple[str, float]] = field(default_factory=list)
+    quad: Optional[list[list[float]]] = None  # Corners in the scan, if split from it
+    blank: bool = False  # Written as a placeholder, in place of a blank page
+    dhash: Optional[int] = None  # Perceptual hash, for finding duplicates
+    derivatives: list[str] = field(default_factory=list)  # Copies written by DeriveOps
+
+
+def run_postprocess_chain(input_filepath: str, output_stem: str, ops: list[PostProcessOp], blank_check: Optional[BlankCheck] = None) -> list[PostProcessResult]:
+    """
+    Loads the image at input_filepath, runs it through the given operations in order,
+    and writes the result to output_stem plus the extension selected by the last
+    EncodeOp in the chain (PNG by default), with a copy for each DeriveOp. Runs in a
+    worker process; the outputs of each image are encoded in parallel, from the image
+    in memory.
+
+    Returns one result per image written: just the one, unless a SplitOp found several
+    photos in the scan, in which case each is written to output_stem with its number
+    appended, in reading order.
+
+    If given a blank_check, each image is checked for being blank as soon as it's
+    loaded (or split from the scan), and blank images skip the rest of the chain: they
+    are written as placeholders or left out of the results, as the check says.
+    """
+    started_at = time.time()
+    timings = []
+
+    t = time.perf_counter()
+    image = _load_image(input_filepath)
+    timings.append(('decode', time.perf_counter() - t))
+
+    # Each image is (pixels, quad, is blank)
+    images = [(image, None, False)]
+    check_blanks = blank_check is not None and blank_check.enabled
+    if check_blanks and not any(isinstance(op, SplitOp) for op in ops):
+        images, timings = _check_blanks(images, blank_check, timings)
+
+    encode_op = EncodeOp()
+    derive_ops = [op for op in ops if isinstance(op, DeriveOp)]
+    for op in ops:
+        if isinstance(op, EncodeOp):
+            encode_op = op
+            continue
+        if isinstance(op, DeriveOp):
+            continue
+        t = time.perf_counter()
+        if isinstance(op, SplitOp):
+            images = [(split, quad, blank) for image, _, blank in images for split, quad in op.split(image)]
+        else:
+            images = [(image if blank else op.apply(image), quad, blank) for image, quad, blank in images]
+        timings.append((type(op).__name__[:-2].lower(), time.perf_counter() - t))
+        if isinstance(op, SplitOp) and check_blanks:
+            images, timings = _check_blanks(images, blank_check, timings)
+
+    if blank_check is not None and blank_check.action == 'drop':
+        images = [(image, quad, blank) for image, quad, blank in images if not blank]
+    elif blank_check is not None:
+        images = [(blank_check.make_placeholder(image) if blank else image, quad, blank) for image, quad, blank in images]
+
+    results = []
+    for index, (image, quad, blank) in enumerate(images):
+        image_timings = list(timings)
+        dhash = None
+        if not blank:
+            t = time.perf_counter()
+            dhash = compute_dhash(image)
+            image_timings.append(('hash', time.perf_counter() - t))
+
+        # Placeholders for blank pages are only ever written as the master
+        stem = output_stem if len(images) == 1 else '%s_%02d' % (output_stem, index + 1)
+        output_filepath = '%s.%s' % (stem, encode_op.ext)
+        outputs = [(encode_op.ext, encode_op.ext, encode_op.params, output_filepath, 0)]
+        if not blank:
+            outputs += [(op.label, op.ext, op.params, op.get_filepath(stem), op.size) for op in derive_ops]
+
+        t = time.perf_counter()
+        pool = _get_encode_pool()
+        futures = [pool.submit(_write_output, image, ext, params, filepath, size, i == 0) for i, (_, ext, params, filepath, size) in enumerate(outputs)]
+        written = [future.result() for future in futures]
+        for (label, _, _, _, _), (encode_seconds, _, _) in zip(outputs, written):
+            image_timings.append(('encode %s' % label, encode_seconds))
+        image_timings.append(('write', sum(write_seconds for _, write_seconds, _ in written)))
+        if len(outputs) > 1:
+            image_timings.append(('outputs', time.perf_counter() - t))
+
+        h, w = image.shape[:2]
+        sha256 = written[0][2]
+        derivatives = [filepath for _, _, _, filepath, _ in outputs[1:]]
+        results.append(PostProcessResult(output_filepath, w, h, sha256, started_at, image_timings, quad, blank, dhash, derivatives))
+    return results
+
+
+def _load_image(filepath: str) -> np.ndarray:
+    """
+    Decodes the image at filepath straight from a memory map of the file. Scans are
+    staged in RAM where possible, so this decodes them where they already lie, without
+    first copying the whole file into a buffer of our own.
+    """
+    with open(filepath, 'rb') as fp:
+        try:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            raise RuntimeError('Failed to load image: %s' % filepath)
+    with mapped:
+        data = np.frombuffer(mapped, dtype=np.uint8)
+        image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        # The map can't be closed while an array still refers to it
+        del data
+    if image is None:
+        raise RuntimeError('Failed to load image: %s' % filepath)
+    return image
+
+
+def _get_encode_pool() -> ThreadPoolExecutor:
+    global _encode_pool
+    if _encode_pool is None:
+        _encode_pool = ThreadPoolExecutor(_encode_threads, thread_name_prefix='encode')
+    return _encode_pool
+
+
+def _init_worker(threads: int):
+    # Every worker process gets an equal share of the cores, for both its encode
+    # threads and OpenCV's own thread pool: otherwise each of them would size both by
+    # every core in the machine, and the workers would oversubscribe the CPU many times
+    # over
+    global _encode_threads
+    _encode_threads = min(ENCODE_THREADS, threads)
+    cv2.setNumThreads(threads)
+
+
+def _write_output(image: np.ndarray, ext: str, params: list[int], filepath: str, size: int, is_master: bool) -> tuple[float, float, Optional[str]]:
+    """
+    Writes one output of an image to filepath, scaled down to size first if given.
+    Returns the time spent scaling and encoding, the time spent writing, and for the
+    master, the SHA-256 of the file: hashed while the encoded data is in memory, so the
+    file never needs to be read back just to identify it.
+    """
+    t = time.perf_counter()
+    h, w = image.shape[:2]
+    if size and max(h, w) > size:
+        scale = size / max(h, w)
+        image = cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.' + ext, image, params)
+    if not ok:
+        raise RuntimeError('Failed to encode image as %s' % ext)
+    encode_seconds = time.perf_counter() - t
+
+    t = time.perf_counter()
+    with open(filepath, 'wb') as fp:
+        fp.write(encoded)
+    sha256 = hashlib.sha256(encoded).hexdigest() if is_master else None
+    return encode_seconds, time.perf_counter() - t, sha256
+
+
+def _check_blanks(images: list, blank_check: BlankCheck, timings: list) -> tuple[list, list]:
+    t = time.perf_counter()
+    images = [(image, quad, blank or blank_check.is_blank(image)) for image, quad, blank in images]
+    return images, timings + [('blank', time.perf_counter() - t)]
+
+
+class PostProcessor:
+    """
+    Runs post-processing chains in a pool of worker processes, so that CPU-heavy image
+    operations use every core without holding the GIL in the GUI or scan threads.
+    Jobs can be submitted at any time; each one's callback is invoked from a pool
+    management thread once the job completes. Depth counts jobs that have been
+    submitted but haven't yet completed.
+    """
+
+    def __init__(self, name: str, ops: list[PostProcessOp], max_workers: Optional[int] = None, on_depth_changed: Optional[Callable[[], None]] = None, blank_check: Optional[BlankCheck] = None):
+        self.name = name
+        self.ops = ops
+        self.blank_check = blank_check
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.on_depth_changed = on_depth_changed
+        self._executor = None
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def start(self):
+        assert self._executor is None
+        threads = max(1, (os.cpu_count() or 1) // self.max_workers)
+        self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker, initargs=(threads,))
+
+    def stop(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def submit(self, input_filepath: str, output_stem: str, on_done: Callable[[Future], None], check_blank: bool = False) -> Future:
+        """
+        Post-processes the image at input_filepath, writing the results to output_stem
+        plus an extension (see run_postprocess_chain()); if check_blank is set, blank
+        images are handled according to the processor's blank_check.
+        """
+        assert self._executor is not None
+        future = self._executor.submit(run_postprocess_chain, input_filepath, output_stem, self.ops, self.blank_check if check_blank else None)
+        self._adjust_depth(1)
+        future.add_done_callback(on_done)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future):
+        self._adjust_depth(-1)
+
+    def _adjust_depth(self, delta: int):
+        with self._lock:
+            self._depth += delta
+            metrics.gauge('fscan_stage_depth', stage=self.name).set(self._depth)
+        if self.on_depth_changed:
+            self.on_depth_changed()
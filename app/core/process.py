@@ -1,26 +1,186 @@
 import os
+import time
+import signal
+import asyncio
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 
 from .. import g
+from .metrics import metrics
 
 
-def run_process(args):
-    # Echo the command we're about the run
-    g.log.debug('> %s' % (args if isinstance(args, str) else ' '.join(args)))
-
-    # Prepare the subprocess args, piping STDOUT and STDERR so we can capture output.
-    # If running on Windows, suppress the console window that would ordinarily be spawned when running a pyinstaller-built EXE.
-    kwargs = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT}
-    if hasattr(subprocess, 'STARTUPINFO'):
-        kwargs['startupinfo'] = subprocess.STARTUPINFO()
-        kwargs['startupinfo'].dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        kwargs['stdin'] = subprocess.PIPE
-    process = subprocess.Popen(args, **kwargs)
-
-    with process.stdout:
-        for line in iter(process.stdout.readline, b''):
-            g.log.debug(line.rstrip().decode('utf-8'))
-    exitcode = process.wait()
-    if exitcode != 0:
-        log.warning('exitcode: %d' % exitcode)
-    return exitcode
+class ProcessTimeoutError(RuntimeError):
+    pass
+
+
+class ProcessCancelledError(RuntimeError):
+    pass
+
+
+class CancelToken:
+    """
+    Thread-safe flag that can be passed to run_process (or start_process) in order to
+    cancel it from another thread. Cancelling kills the process and all of its
+    children.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def reset(self):
+        with self._lock:
+            self._cancelled = False
+
+    def add_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            self._callbacks.append(callback)
+            cancelled = self._cancelled
+        if cancelled:
+            callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+
+def _kill_process_tree(pid: int):
+    if os.name == 'nt':
+        kwargs = {'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL}
+        if hasattr(subprocess, 'STARTUPINFO'):
+            kwargs['startupinfo'] = subprocess.STARTUPINFO()
+            kwargs['startupinfo'].dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        subprocess.call(['taskkill', '/F', '/T', '/PID', str(pid)], **kwargs)
+    else:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+# Threads that run on_line callbacks, so a slow one never holds up the event loop
+CALLBACK_THREADS = 4
+
+
+class ProcessRunner:
+    """
+    Runs subprocesses on a single asyncio event loop, hosted by a background thread, so
+    that any number of processes can be driven at once without a thread per process.
+    Use get_process_runner() to get the shared instance.
+
+    Each process's on_line callback is run on a small thread pool rather than the loop,
+    one line at a time and in order: a callback that blocks (on disk, say) only holds up
+    reading that process's output, not the timeouts or output of any other.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._callback_pool = ThreadPoolExecutor(CALLBACK_THREADS, thread_name_prefix='fscan-process-callback')
+        self._thread = threading.Thread(target=self._loop.run_forever, name='fscan-process-runner', daemon=True)
+        self._thread.start()
+
+    def start(self, args, on_line: Optional[Callable[[str], None]] = None, timeout: Optional[float] = None, cancel_token: Optional[CancelToken] = None):
+        """
+        Starts the given process and returns a concurrent.futures.Future that resolves
+        to its exit code. If the process runs past its timeout (in seconds) or is
+        cancelled via cancel_token, it's killed along with its children, and the future
+        raises ProcessTimeoutError or ProcessCancelledError.
+        """
+        return asyncio.run_coroutine_threadsafe(self._run(args, on_line, timeout, cancel_token), self._loop)
+
+    async def _run(self, args, on_line, timeout, cancel_token):
+        # Echo the command we're about the run
+        g.log.debug('> %s' % (args if isinstance(args, str) else ' '.join(args)))
+
+        # Prepare the subprocess args, piping STDOUT and STDERR so we can capture output.
+        # If running on Windows, suppress the console window that would ordinarily be spawned when running a pyinstaller-built EXE.
+        # Elsewhere, start a new session so that the process and all its children can be killed as a group.
+        kwargs = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT}
+        if hasattr(subprocess, 'STARTUPINFO'):
+            kwargs['startupinfo'] = subprocess.STARTUPINFO()
+            kwargs['startupinfo'].dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            kwargs['stdin'] = subprocess.PIPE
+        else:
+            kwargs['start_new_session'] = True
+        started_at = time.perf_counter()
+        if isinstance(args, str):
+            process = await asyncio.create_subprocess_shell(args, **kwargs)
+        else:
+            process = await asyncio.create_subprocess_exec(*args, **kwargs)
+        program = os.path.basename(args.split()[0].strip('"') if isinstance(args, str) else args[0])
+        metrics.histogram('fscan_process_spawn_seconds', program=program).record(time.perf_counter() - started_at)
+
+        task = asyncio.current_task()
+        on_cancel = lambda: self._loop.call_soon_threadsafe(task.cancel)
+        if cancel_token:
+            cancel_token.add_callback(on_cancel)
+        try:
+            return await asyncio.wait_for(self._communicate(process, on_line), timeout)
+        except asyncio.TimeoutError:
+            g.log.warning('Process %d timed out after %.1fs; killing it.' % (process.pid, timeout))
+            await self._kill(process)
+            raise ProcessTimeoutError('Process timed out after %.1fs' % timeout)
+        except asyncio.CancelledError:
+            g.log.warning('Process %d cancelled; killing it.' % process.pid)
+            await self._kill(process)
+            raise ProcessCancelledError('Process was cancelled')
+        finally:
+            if cancel_token:
+                cancel_token.remove_callback(on_cancel)
+
+    async def _communicate(self, process, on_line):
+        async for line in process.stdout:
+            line = line.rstrip().decode('utf-8', errors='replace')
+            g.log.debug(line)
+            if on_line:
+                await self._loop.run_in_executor(self._callback_pool, on_line, line)
+        exitcode = await process.wait()
+        if exitcode != 0:
+            g.log.warning('exitcode: %d' % exitcode)
+        return exitcode
+
+    async def _kill(self, process):
+        if process.returncode is None:
+            await self._loop.run_in_executor(None, _kill_process_tree, process.pid)
+            await process.wait()
+
+
+__runner__: Optional[ProcessRunner] = None
+__runner_lock__ = threading.Lock()
+
+
+def get_process_runner() -> ProcessRunner:
+    global __runner__
+    with __runner_lock__:
+        if __runner__ is None:
+            __runner__ = ProcessRunner()
+        return __runner__
+
+
+def start_process(args, on_line=None, timeout=None, cancel_token=None):
+    return get_process_runner().start(args, on_line, timeout, cancel_token)
+
+
+def run_process(args, on_line=None, timeout=None, cancel_token=None):
+    """
+    Runs the given process to completion, blocking the calling thread, and returns its
+    exit code. Raises ProcessTimeoutError or ProcessCancelledError if the process is
+    killed; see ProcessRunner.start.
+    """
+    return start_process(args, on_line, timeout, cancel_token).result()
@@ -0,0 +1,293 @@
+"""
+On-demand profiling, for finding out where the time goes when a station slows down.
+A profiling session covers either a window of time (started and stopped from the
+console's context menu, a hotkey, the CLI's --profiler option or the PROFILER config
+var) or a single run of a ScanWorker command (PROFILER_COMMANDS). Sessions are written
+to ~/.FScan/profiles, next to the logs, in one of two kinds:
+
+    sample    A sampling profiler: a background thread records every thread's stack
+              every PROFILER_SAMPLE_INTERVAL_MS, for next to no overhead on the threads
+              themselves. Written as collapsed stacks (.collapsed), one line per
+              distinct stack, ready for flamegraph.pl, speedscope or inferno.
+    cprofile  cProfile, which counts every call, but slows down the code it's
+              profiling. Only covers the work that's wrapped in profiler.profile():
+              ScanWorker commands and the scan and commit stages of the pipeline.
+              Written as .pstats, for pstats or snakeviz.
+
+Neither covers post-processing, which runs in separate worker processes; the timings in
+fscan_postprocess_seconds (see metrics.py) break that down instead.
+"""
+import os
+import sys
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from .. import g
+from ..config import get_config_var
+
+PROFILE_KINDS = ('sample', 'cprofile')
+DEFAULT_SAMPLE_INTERVAL_MS = 5
+
+
+def get_profile_dir() -> str:
+    return os.path.join(os.path.expanduser('~'), '.FScan', 'profiles')
+
+
+def _get_profile_filepath(name: str, ext: str) -> str:
+    dirpath = get_profile_dir()
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    stem = os.path.join(dirpath, 'FScan_%s_%s' % (datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S'), name))
+    filepath = '%s.%s' % (stem, ext)
+    index = 1
+    while os.path.exists(filepath):
+        index += 1
+        filepath = '%s_%d.%s' % (stem, index, ext)
+    return filepath
+
+
+def _get_sample_interval() -> float:
+    value = get_config_var('PROFILER_SAMPLE_INTERVAL_MS', str(DEFAULT_SAMPLE_INTERVAL_MS))
+    try:
+        return float(value) / 1000
+    except ValueError:
+        g.log.error('Ignoring invalid PROFILER_SAMPLE_INTERVAL_MS: %s' % value)
+        return DEFAULT_SAMPLE_INTERVAL_MS / 1000
+
+
+class StackSampler:
+    """
+    Samples the stack of every other thread in the process at a fixed interval, and
+    counts how often each distinct stack is seen, rooted at the thread's name.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.counts: dict[str, int] = {}
+        self.sample_count = 0
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        assert self._thread is None
+        self._thread = threading.Thread(target=self._run, name='StackSampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _get_label(self, code) -> str:
+        # Formatting a frame is the expensive part of a sample, and the same few hundred
+        # functions make up nearly every stack
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        return label
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(self._get_label(frame.f_code))
+                    frame = frame.f_back
+                labels.append(names.get(ident, 'thread-%d' % ident))
+                stack = ';'.join(reversed(labels))
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+            self.sample_count += 1
+
+    def write(self, filepath: str):
+        with open(filepath, 'w', encoding='utf-8') as fp:
+            for stack, count in sorted(self.counts.items()):
+                fp.write('%s %d\n' % (stack, count))
+
+
+class ProfileSession:
+    """
+    One profiling session, of either kind. cProfile only profiles the thread that
+    enables it, so a cprofile session keeps a profile for each thread that runs wrapped
+    work. Once the session is finished, it's written out as soon as none of those
+    threads is still in the middle of wrapped work.
+    """
+
+    def __init__(self, kind: str, name: str):
+        if kind not in PROFILE_KINDS:
+            raise RuntimeError('Unknown profiler: %s (expected one of: %s)' % (kind, ', '.join(PROFILE_KINDS)))
+        self.kind = kind
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+        self._sampler = None
+        self._profiles: dict[int, cProfile.Profile] = {}
+        self._active: set[int] = set()
+        self._lock = threading.Lock()
+        if kind == 'sample':
+            self._sampler = StackSampler(max(_get_sample_interval(), 0.001))
+            self._sampler.start()
+
+    @contextmanager
+    def profile(self):
+        ident = threading.get_ident()
+        with self._lock:
+            if self.kind != 'cprofile' or self.finished_at is not None or ident in self._active:
+                profile = None
+            else:
+                profile = self._profiles.setdefault(ident, cProfile.Profile())
+                self._active.add(ident)
+        if profile is None:
+            yield
+            return
+
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self._active.discard(ident)
+                ready = self.finished_at is not None and not self._active
+            if ready:
+                self._write()
+
+    def finish(self):
+        if self._sampler:
+            self._sampler.stop()
+        with self._lock:
+            self.finished_at = time.perf_counter()
+            ready = not self._active
+        if ready:
+            self._write()
+
+    def _write(self):
+        elapsed = self.finished_at - self.started_at
+        if self._sampler:
+            if not self._sampler.counts:
+                g.log.warning('Profile %s: no samples taken in %.1f s.' % (self.name, elapsed))
+                return
+            filepath = _get_profile_filepath(self.name, 'collapsed')
+            self._sampler.write(filepath)
+            g.log.info('Profile %s: %d samples over %.1f s, written to %s' % (self.name, self._sampler.sample_count, elapsed, filepath))
+        else:
+            profiles = [profile for profile in self._profiles.values() if profile.getstats()]
+            if not profiles:
+                g.log.warning('Profile %s: nothing was profiled in %.1f s.' % (self.name, elapsed))
+                return
+            filepath = _get_profile_filepath(self.name, 'pstats')
+            pstats.Stats(*profiles).dump_stats(filepath)
+            g.log.info('Profile %s: %d thread(s) over %.1f s, written to %s' % (self.name, len(profiles), elapsed, filepath))
+
+
+class Profiler:
+    """
+    Starts and stops profiling sessions for the whole process. At most one window is
+    open at a time; command sessions are opened alongside it, except that a cprofile
+    window already covers every command, since a thread can only run one cProfile.
+    Safe to use from any thread.
+    """
+
+    def __init__(self):
+        self._window: Optional[ProfileSession] = None
+        self._lock = threading.Lock()
+
+    @property
+    def kind(self) -> Optional[str]:
+        window = self._window
+        return window.kind if window else None
+
+    def start(self, kind: str, name: str = 'window') -> bool:
+        """
+        Opens a window of the given kind. Returns False if one is already open.
+        """
+        with self._lock:
+            if self._window:
+                return False
+            self._window = ProfileSession(kind, name)
+        g.log.info('Profiling (%s) started; profiles are written to %s' % (kind, get_profile_dir()))
+        return True
+
+    def start_from_config(self, name: str) -> bool:
+        """
+        Opens a window if PROFILER is set to one of PROFILE_KINDS.
+        """
+        kind = get_config_var('PROFILER', '')
+        if not kind:
+            return False
+        try:
+            return self.start(kind, name)
+        except RuntimeError as exc:
+            g.log.error('%s' % exc)
+            return False
+
+    def stop(self):
+        """
+        Closes the open window, if there is one, and writes it out.
+        """
+        with self._lock:
+            window, self._window = self._window, None
+        if window:
+            window.finish()
+
+    def toggle(self, kind: str):
+        if self.kind:
+            self.stop()
+        else:
+            self.start(kind)
+
+    def profile(self):
+        """
+        Returns a context manager that profiles the work done inside it with the open
+        cprofile window, if there is one. Costs next to nothing otherwise.
+        """
+        window = self._window
+        return window.profile() if window else _NOT_PROFILING
+
+    @contextmanager
+    def command(self, name: str):
+        """
+        Profiles a ScanWorker command, by class name: in its own session, if it's listed
+        in PROFILER_COMMANDS (or that's *), and in the open window, if there is one.
+        """
+        names = get_config_var('PROFILER_COMMANDS', '')
+        window = self._window
+        session = None
+        if names and (names.strip() == '*' or name in [n.strip() for n in names.split(',')]) and not (window and window.kind == 'cprofile'):
+            try:
+                session = ProfileSession(get_config_var('PROFILER_COMMANDS_KIND', 'cprofile'), name)
+            except RuntimeError as exc:
+                g.log.error('%s' % exc)
+        if session:
+            try:
+                with session.profile():
+                    yield
+            finally:
+                session.finish()
+        else:
+            with self.profile():
+                yield
+
+
+class _NotProfiling:
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NOT_PROFILING = _NotProfiling()
+
+profiler = Profiler()
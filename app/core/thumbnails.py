@@ -0,0 +1,119 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from typing import Optional
+
+from ..lazyimport import lazy_import
+
+cv2 = lazy_import('cv2')
+
+INDEX_FILENAME = 'thumbnails.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+'''
+
+
+def get_default_thumbnail_dir() -> str:
+    return os.path.join(os.path.expanduser('~'), '.FScan', 'thumbnails')
+
+
+def _hash_file(filepath: str) -> str:
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _get_reduced_imread_flag(width: int, height: int, size: int) -> int:
+    # Let the decoder skip as much detail as it can while still producing an image at
+    # least as large as the thumbnail
+    longest = max(width, height)
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if longest // factor >= size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+class ThumbnailStore:
+    """
+    On-disk cache of thumbnails, keyed by the content hash of each source image, so
+    that a thumbnail only ever needs to be generated once for a given image, even
+    across restarts. A small index maps each source path to its hash, along with the
+    mtime and size the file had when it was hashed: if the file changes, it's rehashed
+    and gets a new thumbnail.
+
+    A store can be used from any thread.
+    """
+
+    def __init__(self, dirpath: str, size: int):
+        self.dirpath = dirpath
+        self.size = size
+        if not os.path.isdir(self.dirpath):
+            os.makedirs(self.dirpath)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.dirpath, INDEX_FILENAME), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get_content_hash(self, source_path: str, known_sha256: Optional[str] = None) -> str:
+        """
+        Returns the SHA-256 of the file at source_path, only reading the file if it's
+        never been hashed before or has changed since. If the caller already knows the
+        file's hash (e.g. from a collection index), it can pass it as known_sha256 to
+        avoid hashing a file that's new to the store.
+        """
+        st = os.stat(source_path)
+        with self._lock:
+            row = self._db.execute('SELECT mtime_ns, size, sha256 FROM sources WHERE path = ?', (source_path,)).fetchone()
+        if row and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+            return row[2]
+
+        sha256 = known_sha256 if known_sha256 and not row else _hash_file(source_path)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO sources (path, mtime_ns, size, sha256) VALUES (?, ?, ?, ?)', (source_path, st.st_mtime_ns, st.st_size, sha256))
+        return sha256
+
+    def get_thumbnail_path(self, sha256: str) -> str:
+        return os.path.join(self.dirpath, sha256[:2], '%s_%d.png' % (sha256, self.size))
+
+    def get_thumbnail(self, source_path: str, known_sha256: Optional[str] = None, width: int = 0, height: int = 0) -> str:
+        """
+        Returns the path to a cached thumbnail of the image at source_path, generating it
+        first if necessary. If the source image's dimensions are known, they're used to
+        decode it at reduced resolution. Blocks; call from a background thread.
+        """
+        thumbnail_path = self.get_thumbnail_path(self.get_content_hash(source_path, known_sha256))
+        if os.path.isfile(thumbnail_path):
+            return thumbnail_path
+
+        image = cv2.imread(source_path, _get_reduced_imread_flag(width, height, self.size) if width and height else cv2.IMREAD_COLOR)
+        if image is None:
+            raise RuntimeError('Failed to load image: %s' % source_path)
+        h, w = image.shape[:2]
+        scale = min(1.0, self.size / max(w, h))
+        thumbnail = cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+        # Write to a temporary file and then rename, so that a thumbnail that exists is
+        # always complete
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        temp_path = '%s.%d.tmp' % (thumbnail_path, threading.get_ident())
+        ok, encoded = cv2.imencode('.png', thumbnail)
+        if not ok:
+            raise RuntimeError('Failed to encode thumbnail for %s' % source_path)
+        with open(temp_path, 'wb') as fp:
+            fp.write(encoded)
+        os.replace(temp_path, thumbnail_path)
+        return thumbnail_path
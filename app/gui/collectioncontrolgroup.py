@@ -1,11 +1,16 @@
+import os
+
 from PySide6.QtCore import Signal
-from PySide6.QtWidgets import QWidget, QGridLayout, QLabel, QLineEdit, QPushButton
+from PySide6.QtWidgets import QWidget, QGridLayout, QLabel, QLineEdit, QPushButton, QFileDialog
 
 
 class CollectionControlGroup(QWidget):
 
+    collectionSelected = Signal(str)
+
     def __init__(self):
         super().__init__()
+        self.collection = None
 
         self.label_collection = QLabel()
         self.label_collection.setText('Collection:')
@@ -15,7 +20,13 @@ class CollectionControlGroup(QWidget):
 
         self.button_collection = QPushButton()
         self.button_collection.setText('...')
-        self.button_collection.setEnabled(False)
+        self.button_collection.clicked.connect(self.onBrowseToCollection)
+
+        self.label_last_item = QLabel()
+        self.label_last_item.setText('Last Item:')
+
+        self.edit_last_item = QLineEdit()
+        self.edit_last_item.setReadOnly(True)
 
         self.grid = QGridLayout()
         self.grid.setContentsMargins(4, 4, 4, 4)
@@ -25,3 +36,30 @@ class CollectionControlGroup(QWidget):
         self.grid.addWidget(self.label_collection, 0, 0)
         self.grid.addWidget(self.edit_collection, 0, 1)
         self.grid.addWidget(self.button_collection, 0, 2)
+        self.grid.addWidget(self.label_last_item, 1, 0)
+        self.grid.addWidget(self.edit_last_item, 1, 1, 1, 2)
+
+    def onBrowseToCollection(self):
+        default_dir = self.collection.dirpath if self.collection else os.path.expanduser('~')
+        selected_dir = QFileDialog.getExistingDirectory(self, 'Select Collection Directory', default_dir)
+        if selected_dir:
+            self.collectionSelected.emit(os.path.normpath(selected_dir))
+
+    def onCollectionChanged(self, collection):
+        self.collection = collection
+        if collection:
+            self.edit_collection.setText(collection.dirpath)
+            recent = collection.list_recent(1)
+            self.edit_last_item.setText(self._formatItem(recent[0]) if recent else 'n/a')
+        else:
+            self.edit_collection.setText('n/a')
+            self.edit_last_item.setText('n/a')
+
+    def onItemCommitted(self, job, item):
+        if job.collection is self.collection:
+            self.edit_last_item.setText(self._formatItem(item))
+
+    @staticmethod
+    def _formatItem(item):
+        sides = [side for side, image in (('front', item.front), ('back', item.back)) if image]
+        return '#%d (%s)' % (item.seq, ' + '.join(sides))
@@ -7,10 +7,11 @@ from ..core.naps2.profile import list_naps2_devices, list_naps2_profile_names
 
 class ConfigureProfilesDialog(QDialog):
 
-    def __init__(self, install, profile_config):
+    def __init__(self, install, profile_config, scanner_count=1):
         super().__init__()
         self.install = install
         self.profile_config = profile_config
+        self.scanner_count = scanner_count
 
         self.setWindowFlags(Qt.Dialog | Qt.WindowStaysOnTopHint)
         self.setWindowTitle('Configure Profiles')
@@ -32,5 +33,12 @@ class ConfigureProfilesDialog(QDialog):
 
         self.layout.addWidget(self.label_statement)
 
+        # Only the first scanner's profiles can be edited here
+        if self.scanner_count > 1:
+            self.label_multiple = QLabel()
+            self.label_multiple.setWordWrap(True)
+            self.label_multiple.setText('%d scanners are configured: only the first is shown here. To change the others, edit SCAN_PROFILE_NAME_FRONT and SCAN_PROFILE_NAME_BACK in fscan.ini, which list one profile per scanner, separated by \'|\'.' % self.scanner_count)
+            self.layout.addWidget(self.label_multiple)
+
     def sizeHint(self):
         return QSize(480, 100)
@@ -1,24 +1,50 @@
 import os
 
-from PySide6.QtCore import Qt, Slot, QSize
-from PySide6.QtWidgets import QTextEdit, QMenu, QSizePolicy
+from PySide6.QtCore import Qt, Slot, QSize, QTimer
+from PySide6.QtWidgets import QPlainTextEdit, QMenu, QSizePolicy
 from PySide6.QtGui import QTextCursor, QKeySequence, QTextOption, QAction
 
 from .. import g
+from ..config import get_config_var
+from ..core.profiling import profiler
 from ..richtexthandler import RichTextHandlerObject, RichTextHandler
 from ..loggers import ConsoleFormatter
 
+FLUSH_INTERVAL_MS = 50
+DEFAULT_MAX_LINES = 5000
 
-class ConsoleWidget(QTextEdit):
+
+def _get_max_lines() -> int:
+    value = get_config_var('CONSOLE_MAX_LINES', str(DEFAULT_MAX_LINES))
+    try:
+        max_lines = int(value)
+    except ValueError:
+        max_lines = 0
+    if max_lines < 1:
+        g.log.error('Ignoring invalid CONSOLE_MAX_LINES: %s (using %d)' % (value, DEFAULT_MAX_LINES))
+        return DEFAULT_MAX_LINES
+    return max_lines
+
+
+class ConsoleWidget(QPlainTextEdit):
+    """
+    Displays log output. Lines are buffered as they're logged and flushed to the widget
+    in a single insert at most every FLUSH_INTERVAL_MS, and only the most recent
+    CONSOLE_MAX_LINES lines are kept. The view only follows new output while it's
+    scrolled to the bottom, so scrolling up to read earlier output isn't interrupted.
+    """
 
     def __init__(self):
         super().__init__()
 
+        self.maxLines = _get_max_lines()
+        self.setMaximumBlockCount(self.maxLines)
         self.setReadOnly(True)
         self.setWordWrapMode(QTextOption.NoWrap)
+        self.setLineWrapMode(QPlainTextEdit.NoWrap)
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.setStyleSheet('''
-            QTextEdit {
+            QPlainTextEdit {
                 background-color: #2b2b2b;
                 font-family: "Consolas";
                 font-size: 10pt;
@@ -28,47 +54,80 @@ class ConsoleWidget(QTextEdit):
             }''')
         self.setSizePolicy(QSizePolicy(QSizePolicy.Preferred, QSizePolicy.Preferred))
 
-        self.handlerObj = RichTextHandlerObject()
+        self.flushTimer = QTimer(self)
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.setInterval(FLUSH_INTERVAL_MS)
+        self.flushTimer.timeout.connect(self.flush)
+
+        self.handlerObj = RichTextHandlerObject(self.maxLines)
         self.handler = RichTextHandler(self.handlerObj)
         self.handler.setFormatter(ConsoleFormatter())
-        self.handlerObj.wroteLine.connect(self.write)
-        g.log.addHandler(self.handler)
+        self.handlerObj.linesPending.connect(self.onLinesPending)
+        g.log.addSink(self.handler)
 
         self.actionCopy = QAction('&Copy', self, shortcut=QKeySequence.Copy, statusTip='Copy selected text to the clipboard', triggered=self.copy)
         self.actionSelectAll = QAction('Select &All', self, shortcut=QKeySequence.SelectAll, statusTip='Select all text in the output window', triggered=self.selectAll)
         self.actionScrollToEnd = QAction('Scroll to &End', self, statusTip='Move the cursor to the end of the output', triggered=self.scrollToEnd)
         self.actionWordWrap = QAction('&Word Wrap', self, statusTip='Toggle word wrap', checkable=True, triggered=self.toggleWordWrap)
         self.actionClear = QAction('C&lear', self, statusTip='Clear the output window', triggered=self.clear)
+        self.actionProfileSample = QAction('&Profile (Sampling)', self, shortcut=QKeySequence('Ctrl+Alt+P'), statusTip='Start or stop sampling every thread\'s stack, for a flamegraph', checkable=True, triggered=lambda: self.toggleProfiling('sample'))
+        self.actionProfileSample.setShortcutContext(Qt.ApplicationShortcut)
+        self.addAction(self.actionProfileSample)
+        self.actionProfileCProfile = QAction('Profile (c&Profile)', self, statusTip='Start or stop profiling every call with cProfile', checkable=True, triggered=lambda: self.toggleProfiling('cprofile'))
 
     def sizeHint(self):
         return QSize(800, 160)
 
-    @Slot(str)
-    def write(self, line):
-        self.append(line)
-        self.scrollToEnd()
+    @Slot()
+    def onLinesPending(self):
+        if not self.flushTimer.isActive():
+            self.flushTimer.start()
+
+    @Slot()
+    def flush(self):
+        lines = self.handlerObj.take()
+        if lines:
+            self.write(lines)
+
+    def write(self, lines):
+        scrollBar = self.verticalScrollBar()
+        atBottom = scrollBar.value() >= scrollBar.maximum()
+        self.appendHtml(''.join('<p>%s</p>' % line for line in lines))
+        if atBottom:
+            self.scrollToEnd()
 
     def scrollToEnd(self):
         self.moveCursor(QTextCursor.End)
         self.moveCursor(QTextCursor.StartOfLine)
 
     def toggleWordWrap(self):
-        if self.wordWrapMode() == QTextOption.NoWrap:
+        if self.lineWrapMode() == QPlainTextEdit.NoWrap:
             self.setWordWrapMode(QTextOption.WordWrap)
+            self.setLineWrapMode(QPlainTextEdit.WidgetWidth)
         else:
             self.setWordWrapMode(QTextOption.NoWrap)
+            self.setLineWrapMode(QPlainTextEdit.NoWrap)
 
     def clear(self):
-        self.setText('')
+        self.setPlainText('')
         self.scrollToEnd()
 
+    def toggleProfiling(self, kind):
+        # Stops whichever kind is running, so the hotkey always works as an off switch
+        profiler.toggle(kind)
+
     def contextMenuEvent(self, event):
         menu = QMenu(self)
         menu.addAction(self.actionCopy)
         menu.addAction(self.actionSelectAll)
         menu.addAction(self.actionScrollToEnd)
         menu.addSeparator()
-        self.actionWordWrap.setChecked(self.wordWrapMode() != QTextOption.NoWrap)
+        self.actionWordWrap.setChecked(self.lineWrapMode() != QPlainTextEdit.NoWrap)
         menu.addAction(self.actionWordWrap)
         menu.addAction(self.actionClear)
+        menu.addSeparator()
+        self.actionProfileSample.setChecked(profiler.kind == 'sample')
+        self.actionProfileCProfile.setChecked(profiler.kind == 'cprofile')
+        menu.addAction(self.actionProfileSample)
+        menu.addAction(self.actionProfileCProfile)
         menu.exec_(event.globalPos())
@@ -2,6 +2,7 @@ from PySide6.QtWidgets import QWidget, QVBoxLayout
 
 from .maincontrols import MainControls
 from .workarea import WorkArea
+from .recentitemswidget import RecentItemsWidget
 from .consolewidget import ConsoleWidget
 
 
@@ -12,6 +13,7 @@ class MainWidget(QWidget):
 
         self.controls = MainControls()
         self.workarea = WorkArea()
+        self.recent = RecentItemsWidget()
         self.console = ConsoleWidget()
 
         self.layout = QVBoxLayout()
@@ -21,4 +23,5 @@ class MainWidget(QWidget):
 
         self.layout.addWidget(self.controls)
         self.layout.addWidget(self.workarea)
+        self.layout.addWidget(self.recent)
         self.layout.addWidget(self.console)
@@ -1,4 +1,4 @@
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QEvent, QTimer, Signal
 from PySide6.QtWidgets import QMainWindow
 
 from ..version import VERSION
@@ -7,6 +7,9 @@ from .mainwidget import MainWidget
 
 class MainWindow(QMainWindow):
 
+    # Emitted once, after the window's first frame has been painted
+    firstPainted = Signal()
+
     def __init__(self):
         super().__init__()
 
@@ -17,3 +20,13 @@ class MainWindow(QMainWindow):
 
         self.w = MainWidget()
         self.setCentralWidget(self.w)
+
+        self.hasPainted = False
+
+    def event(self, event):
+        # Child widgets are painted in the same pass as the window itself, so wait for
+        # the event loop to come back around before reporting that the frame is done
+        if event.type() == QEvent.Paint and not self.hasPainted:
+            self.hasPainted = True
+            QTimer.singleShot(0, self.firstPainted.emit)
+        return super().event(event)
@@ -0,0 +1,105 @@
+from PySide6.QtCore import Qt, QSize, Signal
+from PySide6.QtWidgets import QListWidget, QListWidgetItem, QListView, QSizePolicy
+from PySide6.QtGui import QBrush, QColor, QPixmap
+
+from .thumbnailservice import ThumbnailService
+
+RECENT_ITEM_LIMIT = 200
+
+DUPLICATE_BACKGROUND = QColor(160, 96, 0)
+
+
+class RecentItemsWidget(QListWidget):
+    """
+    Horizontal strip of thumbnails showing the most recently scanned items in the
+    current collection, newest first. Selecting an item emits imageSelected with the
+    path of its front (or back) image; while the newest item is selected, newly
+    committed items are selected as they arrive. Items that look like rescans of
+    earlier items are highlighted.
+    """
+
+    imageSelected = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.collection = None
+        self.thumbnails = ThumbnailService()
+        self.thumbnails.thumbnailReady.connect(self.onThumbnailReady)
+        self.listItemsByPath = {}
+
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(False)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True)
+        self.setIconSize(QSize(self.thumbnails.size, self.thumbnails.size))
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setSizePolicy(QSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed))
+        self.setFixedHeight(self.thumbnails.size + 48)
+        self.currentItemChanged.connect(self.onCurrentItemChanged)
+
+    def onCollectionChanged(self, collection):
+        self.collection = collection
+        self.clear()
+        self.listItemsByPath = {}
+        if collection:
+            for item in collection.list_recent(RECENT_ITEM_LIMIT):
+                self.addCollectionItem(item, prepend=False)
+
+    def onItemCommitted(self, job, item):
+        if job.collection is not self.collection:
+            return
+
+        followNewest = self.currentRow() <= 0
+
+        # A back image is attached to an existing item: replace its entry
+        for row in range(self.count()):
+            if self.item(row).data(Qt.UserRole).seq == item.seq:
+                self.removeRow(row)
+                break
+        self.addCollectionItem(item, prepend=True)
+        while self.count() > RECENT_ITEM_LIMIT:
+            self.removeRow(self.count() - 1)
+
+        if followNewest:
+            self.setCurrentRow(0)
+
+    def removeRow(self, row):
+        listItem = self.takeItem(row)
+        for path in [path for path, x in self.listItemsByPath.items() if x is listItem]:
+            del self.listItemsByPath[path]
+
+    def addCollectionItem(self, item, prepend):
+        image = item.front or item.back
+        listItem = QListWidgetItem('#%d' % item.seq)
+        listItem.setData(Qt.UserRole, item)
+        toolTip = '#%d (%s)' % (item.seq, ' + '.join(side for side, x in (('front', item.front), ('back', item.back)) if x))
+        duplicateOf = item.front.duplicate_of if item.front else None
+        if duplicateOf:
+            listItem.setText('#%d = #%d?' % (item.seq, duplicateOf))
+            listItem.setBackground(QBrush(DUPLICATE_BACKGROUND))
+            toolTip += '\nLooks like a rescan of #%d' % duplicateOf
+        listItem.setToolTip(toolTip)
+        listItem.setSizeHint(QSize(self.thumbnails.size + 8, self.thumbnails.size + 24))
+        if prepend:
+            self.insertItem(0, listItem)
+        else:
+            self.addItem(listItem)
+
+        if image:
+            path = self.collection.get_abspath(image)
+            self.listItemsByPath[path] = listItem
+            thumbnail = self.thumbnails.request(path, image.sha256, image.width, image.height)
+            if thumbnail is not None:
+                listItem.setIcon(QPixmap.fromImage(thumbnail))
+
+    def onCurrentItemChanged(self, current, previous):
+        item = current.data(Qt.UserRole) if current else None
+        image = item and (item.front or item.back)
+        if image and self.collection:
+            self.imageSelected.emit(self.collection.get_abspath(image))
+
+    def onThumbnailReady(self, path, image):
+        listItem = self.listItemsByPath.get(path)
+        if listItem is not None and self.row(listItem) >= 0:
+            listItem.setIcon(QPixmap.fromImage(image))
@@ -1,7 +1,8 @@
 from PySide6.QtCore import Signal
-from PySide6.QtWidgets import QWidget, QGridLayout, QLabel, QLineEdit, QPushButton
+from PySide6.QtWidgets import QWidget, QGridLayout, QLabel, QLineEdit, QPushButton, QSpinBox
 
 from .. import g
+from ..core.naps2.data import ScanProgressKind
 from ..state.scan import ScanWorkerState
 
 
@@ -9,7 +10,8 @@ class ScanControlGroup(QWidget):
 
     configureRequested = Signal()
     configureProfilesRequested = Signal()
-    scanRequested = Signal()
+    scanRequested = Signal(bool, int)
+    cancelScanRequested = Signal()
 
     def __init__(self):
         super().__init__()
@@ -43,10 +45,32 @@ class ScanControlGroup(QWidget):
         self.edit_status.setReadOnly(True)
 
         self.button_scan = QPushButton()
-        self.button_scan.setText('Scan')
-        self.button_scan.clicked.connect(self.scanRequested)
+        self.button_scan.setText('Scan Front')
+        self.button_scan.clicked.connect(self.onScanClicked)
         self.button_scan.setEnabled(False)
 
+        # After scanning a glassful of fronts, flip each photo over where it lies and
+        # scan the backs: each back is paired with the front it was flipped from
+        self.button_scan_back = QPushButton()
+        self.button_scan_back.setText('Scan Back')
+        self.button_scan_back.clicked.connect(self.onScanBackClicked)
+        self.button_scan_back.setEnabled(False)
+
+        # Scanning more than one page at a time runs a single batch in NAPS2; 0 means
+        # 'scan every page in the feeder'
+        self.label_pages = QLabel()
+        self.label_pages.setText('Pages:')
+
+        self.spin_pages = QSpinBox()
+        self.spin_pages.setRange(0, 999)
+        self.spin_pages.setValue(1)
+        self.spin_pages.setSpecialValueText('Feeder')
+
+        self.button_cancel = QPushButton()
+        self.button_cancel.setText('Cancel')
+        self.button_cancel.clicked.connect(self.cancelScanRequested)
+        self.button_cancel.setEnabled(False)
+
         self.grid = QGridLayout()
         self.grid.setContentsMargins(4, 4, 4, 4)
         self.grid.setSpacing(4)
@@ -61,8 +85,18 @@ class ScanControlGroup(QWidget):
         self.grid.addWidget(self.label_status, 2, 0)
         self.grid.addWidget(self.edit_status, 2, 1)
         self.grid.addWidget(self.button_scan, 2, 2)
+        self.grid.addWidget(self.label_pages, 3, 0)
+        self.grid.addWidget(self.spin_pages, 3, 1)
+        self.grid.addWidget(self.button_scan_back, 3, 2)
+        self.grid.addWidget(self.button_cancel, 4, 2)
+
+    def onScanClicked(self):
+        self.scanRequested.emit(True, self.spin_pages.value())
 
-    def onScanWorkerStateChanged(self, newState, newInstall, newProfileConfig):
+    def onScanBackClicked(self):
+        self.scanRequested.emit(False, self.spin_pages.value())
+
+    def onScanWorkerStateChanged(self, newState, newInstall, newProfileConfig, newQueueDepths):
         if newInstall:
             self.edit_naps2.setText(newInstall.app_dir)
         else:
@@ -73,21 +107,48 @@ class ScanControlGroup(QWidget):
         else:
             self.edit_profiles.setText('n/a')
 
+        self.edit_status.setText(self._formatStatus(newState, newQueueDepths))
+        self.button_cancel.setEnabled(newState == ScanWorkerState.SCANNING)
+
         if newState == ScanWorkerState.UNINITIALIZED:
             self.button_naps2.setEnabled(True)
             self.button_profiles.setEnabled(False)
             self.button_scan.setEnabled(False)
+            self.button_scan_back.setEnabled(False)
         elif newState == ScanWorkerState.NO_PROFILES:
             self.button_naps2.setEnabled(True)
             self.button_profiles.setEnabled(True)
             self.button_scan.setEnabled(False)
+            self.button_scan_back.setEnabled(False)
         elif newState == ScanWorkerState.READY_TO_SCAN:
             self.button_naps2.setEnabled(True)
             self.button_profiles.setEnabled(True)
             self.button_scan.setEnabled(True)
+            self.button_scan_back.setEnabled(True)
         elif newState == ScanWorkerState.SCANNING:
+            # Further scans can be requested while scanning: they'll be queued
             self.button_naps2.setEnabled(False)
             self.button_profiles.setEnabled(True)
-            self.button_scan.setEnabled(False)
+            self.button_scan.setEnabled(True)
+            self.button_scan_back.setEnabled(True)
         else:
             raise ValueError('Unhandled scan worker state %r' % newState)
+
+    def onScanProgressed(self, job, progress):
+        if progress.kind == ScanProgressKind.STARTED:
+            self.edit_status.setText('%s: scanning...' % job.label)
+        elif progress.kind == ScanProgressKind.PAGE_ACQUIRED:
+            self.edit_status.setText('%s: acquired page %d' % (job.label, progress.page or 1))
+        elif progress.kind == ScanProgressKind.WRITING:
+            self.edit_status.setText('%s: writing...' % job.label)
+
+    @staticmethod
+    def _formatStatus(state, queueDepths):
+        if state == ScanWorkerState.UNINITIALIZED:
+            return 'NAPS2 not configured'
+        if state == ScanWorkerState.NO_PROFILES:
+            return 'Profiles not configured'
+        stage_descs = ['%d %s' % (depth, name) for name, depth in queueDepths.items() if depth > 0]
+        if stage_descs:
+            return '%s (%s)' % ('Scanning' if state == ScanWorkerState.SCANNING else 'Processing', ', '.join(stage_descs))
+        return 'Ready'
@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, Signal
+from PySide6.QtGui import QImage
+
+from .. import g
+from ..config import get_config_var
+from ..core.thumbnails import ThumbnailStore, get_default_thumbnail_dir
+
+
+def _get_int_config_var(name: str, default: int, minimum: int) -> int:
+    value = get_config_var(name, str(default))
+    try:
+        number = int(value)
+    except ValueError:
+        number = minimum - 1
+    if number < minimum:
+        g.log.error('Ignoring invalid %s: %s (using %d)' % (name, value, default))
+        return default
+    return number
+
+
+class ThumbnailService(QObject):
+    """
+    Provides ready-to-paint thumbnails for collection images. Thumbnails are generated
+    (or loaded from the on-disk ThumbnailStore) in background threads, and the most
+    recently used ones are kept in memory up to a fixed budget in bytes.
+
+    request() returns a thumbnail immediately if it's in memory; otherwise it returns
+    None and thumbnailReady is emitted once the thumbnail has been loaded.
+    """
+
+    thumbnailReady = Signal(str, QImage)
+
+    def __init__(self):
+        super().__init__()
+        self.size = _get_int_config_var('THUMBNAIL_SIZE', 160, 1)
+        self.budget_bytes = _get_int_config_var('THUMBNAIL_CACHE_MB', 64, 0) * 1024 * 1024
+        self.store = ThumbnailStore(get_config_var('THUMBNAIL_DIR', get_default_thumbnail_dir()), self.size)
+
+        self._images = OrderedDict()
+        self._total_bytes = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='fscan-thumbnails')
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def request(self, source_path, sha256=None, width=0, height=0):
+        with self._lock:
+            image = self._images.get(source_path)
+            if image is not None:
+                self._images.move_to_end(source_path)
+                return image
+            if source_path in self._pending:
+                return None
+            self._pending.add(source_path)
+        self._executor.submit(self._load, source_path, sha256, width, height)
+        return None
+
+    def _load(self, source_path, sha256, width, height):
+        try:
+            thumbnail_path = self.store.get_thumbnail(source_path, sha256, width, height)
+            image = QImage(thumbnail_path).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            if image.isNull():
+                raise RuntimeError('Failed to load thumbnail: %s' % thumbnail_path)
+        except Exception as exc:
+            g.log.warning('Failed to load thumbnail for %s: %s' % (source_path, exc))
+            with self._lock:
+                self._pending.discard(source_path)
+            return
+
+        with self._lock:
+            self._pending.discard(source_path)
+            self._images[source_path] = image
+            self._total_bytes += image.sizeInBytes()
+            while self._total_bytes > self.budget_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._total_bytes -= evicted.sizeInBytes()
+        self.thumbnailReady.emit(source_path, image)
@@ -1,29 +1,194 @@
-import numpy as np
-import cv2
+from __future__ import annotations
 
-from PySide6.QtCore import Qt
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import Qt, Signal, QPointF
 from PySide6.QtWidgets import QWidget, QSizePolicy
-from PySide6.QtGui import QImage, QPainter, QBrush, QColor
+from PySide6.QtGui import QImage, QPainter, QColor
+
+from .. import g
+from ..lazyimport import lazy_import
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+BACKGROUND_BGR = (35, 35, 35)
+MIN_ZOOM = 1.0 / 64
+MAX_ZOOM = 16.0
+
+
+class ImagePyramid:
+    """
+    A decoded image along with a series of successively half-sized copies of it, down
+    to roughly min_size pixels on the longest side. Rendering at any zoom level can
+    then sample from a level that's no more than 2x larger than the output, so the
+    cost of drawing depends only on the size of the viewport.
+    """
+
+    def __init__(self, image: np.ndarray, min_size: int = 256):
+        self.levels = [image]
+        while max(self.levels[-1].shape[:2]) > min_size * 2:
+            self.levels.append(cv2.pyrDown(self.levels[-1]))
+
+    @property
+    def width(self) -> int:
+        return self.levels[0].shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.levels[0].shape[0]
+
+    def select(self, zoom: float) -> tuple[np.ndarray, float]:
+        """
+        Returns the smallest level that still has at least as much detail as the given
+        zoom factor calls for, along with that level's scale relative to the original.
+        """
+        index = 0
+        while index + 1 < len(self.levels) and 0.5 ** (index + 1) >= zoom:
+            index += 1
+        level = self.levels[index]
+        return level, level.shape[1] / self.width
 
 
 class WorkArea(QWidget):
+    """
+    Displays a single scanned image with pan and zoom. The decoded image is held in one
+    NumPy buffer (plus its mip pyramid), and each repaint resamples only the part that's
+    visible into a viewport-sized buffer, which QImage wraps without copying.
+
+    Scroll to zoom about the cursor, drag to pan, and double-click to fit the image to
+    the window.
+    """
+
+    imageLoaded = Signal(str, object)
 
     def __init__(self):
         super().__init__()
         self.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding))
+        self.pyramid = None
+        self.filepath = None
+        self.zoom = 1.0
+        self.center = (0.0, 0.0)  # Point in image coordinates shown at the viewport center
+        self.dragPos = None
+
         self.mat = None
         self.image = None
+        self.dirty = True
+
+        self._loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fscan-workarea')
+        self.imageLoaded.connect(self.onImageLoaded)
+
+    def shutdown(self):
+        self._loader.shutdown(wait=False, cancel_futures=True)
+
+    def loadImage(self, filepath):
+        """
+        Decodes the image at filepath and builds its pyramid in a background thread,
+        then displays it.
+        """
+        self.filepath = filepath
+        self._loader.submit(self._load, filepath)
+
+    def _load(self, filepath):
+        image = cv2.imread(filepath, cv2.IMREAD_COLOR)
+        if image is None:
+            g.log.warning('Failed to load image: %s' % filepath)
+            return
+        self.imageLoaded.emit(filepath, ImagePyramid(image))
+
+    def onImageLoaded(self, filepath, pyramid):
+        # Ignore stale results if another image was requested in the meantime
+        if filepath == self.filepath:
+            self.setPyramid(pyramid)
+
+    def setPyramid(self, pyramid):
+        self.pyramid = pyramid
+        self.fitToWindow()
+
+    def fitToWindow(self):
+        if self.pyramid:
+            self.zoom = min(self.width() / self.pyramid.width, self.height() / self.pyramid.height)
+            self.zoom = max(MIN_ZOOM, min(MAX_ZOOM, self.zoom))
+            self.center = (self.pyramid.width / 2, self.pyramid.height / 2)
+        self.invalidate()
+
+    def invalidate(self):
+        self.dirty = True
+        self.update()
 
     def resizeEvent(self, event):
-        w, h = event.size().width(), event.size().height()
-        self.mat = np.zeros((h, w, 3), np.uint8)
-        self.mat[:,0:w//2] = (35,35,35)
-        self.mat[:,w//2:w] = (35,35,35)
+        # The viewport buffer is reallocated lazily, at paint time
+        self.invalidate()
+
+    def wheelEvent(self, event):
+        if not self.pyramid:
+            return
+
+        # Zoom about the point under the cursor, keeping that point fixed on screen
+        pos = event.position()
+        anchor = self._widgetToImage(pos)
+        factor = 1.25 ** (event.angleDelta().y() / 120)
+        self.zoom = max(MIN_ZOOM, min(MAX_ZOOM, self.zoom * factor))
+        self.center = (
+            anchor[0] - (pos.x() - self.width() / 2) / self.zoom,
+            anchor[1] - (pos.y() - self.height() / 2) / self.zoom,
+        )
+        self.invalidate()
 
-        self.image = QImage(self.mat.data, w, h, 3 * w, QImage.Format_BGR888)
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.dragPos = event.position()
+
+    def mouseMoveEvent(self, event):
+        if self.dragPos is not None and self.pyramid:
+            pos = event.position()
+            self.center = (
+                self.center[0] - (pos.x() - self.dragPos.x()) / self.zoom,
+                self.center[1] - (pos.y() - self.dragPos.y()) / self.zoom,
+            )
+            self.dragPos = pos
+            self.invalidate()
+
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.dragPos = None
+
+    def mouseDoubleClickEvent(self, event):
+        self.fitToWindow()
+
+    def _widgetToImage(self, pos: QPointF) -> tuple[float, float]:
+        return (
+            self.center[0] + (pos.x() - self.width() / 2) / self.zoom,
+            self.center[1] + (pos.y() - self.height() / 2) / self.zoom,
+        )
+
+    def render(self):
+        w, h = self.width(), self.height()
+        if w <= 0 or h <= 0:
+            return
+        if self.mat is None or self.mat.shape[:2] != (h, w):
+            self.mat = np.empty((h, w, 3), np.uint8)
+            self.image = QImage(self.mat.data, w, h, self.mat.strides[0], QImage.Format_BGR888)
+
+        # Map the selected pyramid level straight into the viewport buffer: warpAffine
+        # only computes output pixels, so no more than the visible region is sampled
+        level, level_scale = self.pyramid.select(self.zoom)
+        s = self.zoom / level_scale
+        tx = w / 2 - self.center[0] * self.zoom
+        ty = h / 2 - self.center[1] * self.zoom
+        matrix = np.array([[s, 0, tx], [0, s, ty]], np.float64)
+        interpolation = cv2.INTER_NEAREST if s >= 2.0 else cv2.INTER_LINEAR
+        cv2.warpAffine(level, matrix, (w, h), dst=self.mat, flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=BACKGROUND_BGR)
 
     def paintEvent(self, event):
         p = QPainter(self)
-        p.fillRect(self.rect(), QBrush(QColor(192, 208, 222), Qt.DiagCrossPattern))
+        if not self.pyramid:
+            # Nothing to show yet: don't touch NumPy (or even import it) until we do
+            p.fillRect(self.rect(), QColor(*reversed(BACKGROUND_BGR)))
+            return
+
+        if self.dirty:
+            self.render()
+            self.dirty = False
         if self.image:
-            p.drawImage(self.rect(), self.image, self.rect())
+            p.drawImage(event.rect(), self.image, event.rect())
@@ -0,0 +1,33 @@
+import sys
+import types
+import importlib
+import threading
+
+__lazy_import_lock__ = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that isn't imported until one of its attributes is first
+    accessed. Once the real module is loaded, its attributes are copied onto this
+    object, so later accesses cost no more than they would on the module itself.
+    """
+
+    def __getattr__(self, attr):
+        with __lazy_import_lock__:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Returns the named module if it's already been imported, or otherwise a LazyModule
+    that will import it on first use. Use this for heavy modules (numpy, cv2,
+    requests) at the top of any module that's imported at startup, and use
+    `from __future__ import annotations` if the module refers to them in annotations.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
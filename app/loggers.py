@@ -1,6 +1,10 @@
 import os
 import sys
+import time
+import queue
+import atexit
 import logging
+import logging.handlers
 import datetime
 import colorama
 
@@ -59,31 +63,135 @@ class ConsoleFormatter(logging.Formatter):
         return super().format(record)
 
 
+class BufferedFileHandler(logging.FileHandler):
+    """
+    File handler that lets lines accumulate in the file's write buffer rather than
+    flushing after every record. The buffer is flushed when a record at or above
+    flushLevel is written, so that warnings and errors are on disk right away, or when
+    a record is written more than flushInterval seconds after the last flush. Once
+    logging goes quiet, FlushingQueueListener flushes whatever is left.
+    """
+
+    def __init__(self, filename, flushInterval=1.0, flushLevel=logging.WARNING, bufferSize=64 * 1024):
+        self.flushInterval = flushInterval
+        self.flushLevel = flushLevel
+        self.bufferSize = bufferSize
+        self.lastFlushAt = time.monotonic()
+        self.forceFlush = False
+        super().__init__(filename, encoding='utf-8')
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=self.bufferSize, encoding=self.encoding, errors=self.errors)
+
+    def emit(self, record):
+        # StreamHandler.emit() calls flush() after every write; only let it through
+        # when one is due
+        self.forceFlush = record.levelno >= self.flushLevel
+        super().emit(record)
+
+    def flush(self):
+        now = time.monotonic()
+        if self.forceFlush or now - self.lastFlushAt >= self.flushInterval:
+            super().flush()
+            self.lastFlushAt = now
+
+    def close(self):
+        self.forceFlush = True
+        super().close()
+
+
+class LightweightQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that enqueues records as-is. The default prepare() formats each
+    record before it's enqueued, which would put formatting back on the logging
+    thread; here all formatting is left to the sinks, on the listener's thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    """
+    Queue listener that flushes its handlers whenever the queue has been empty for
+    flushInterval seconds, so that buffered lines reach the disk even once logging
+    goes quiet (e.g. because the application has hung).
+    """
+
+    def __init__(self, queue, *handlers, flushInterval=1.0, respect_handler_level=False):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        self.flushInterval = flushInterval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, self.flushInterval if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+            for handler in self.handlers:
+                handler.flush()
+
+
 class ConsoleLogger(logging.Logger):
+    """
+    Logger whose records are handed off to a queue, and written out to each of its sinks
+    (stdout, the log file, and any added with addSink) by a single background thread.
+    Logging from any thread costs no more than an enqueue.
+    """
 
     def __init__(self, name):
         super().__init__(name)
         self.logFilepath = None
+        self.listener = None
 
     @classmethod
-    def new(cls, name):
+    def new(cls, name, stream=None, streamLevel=logging.NOTSET):
+        """
+        Creates a logger that writes to stream (stdout by default), at streamLevel and
+        above, and writes everything to a new log file in ~/.FScan/logs.
+        """
         log = cls(name)
 
-        stdoutHandler = ColorizingStreamHandler(sys.stdout)
+        stdoutHandler = ColorizingStreamHandler(stream or sys.stdout)
         stdoutFormatter = ConsoleFormatter()
         stdoutHandler.setFormatter(stdoutFormatter)
-        log.addHandler(stdoutHandler)
+        stdoutHandler.setLevel(streamLevel)
 
         logDirpath = os.path.join(os.path.expanduser('~'), '.FScan', 'logs')
         if not os.path.isdir(logDirpath):
             os.makedirs(logDirpath)
 
         logFilename = 'FScan_%s.txt' % datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S')
-        logFilepath = os.path.join(logDirpath, logFilename)
-        fileHandler = logging.FileHandler(logFilepath)
+        log.logFilepath = os.path.join(logDirpath, logFilename)
+        fileHandler = BufferedFileHandler(log.logFilepath)
         fileFormatter = logging.Formatter('[%(asctime)s|%(levelname)-1.1s] %(message)s', datefmt='%H:%M:%S')
         fileHandler.setFormatter(fileFormatter)
-        log.addHandler(fileHandler)
+
+        records = queue.SimpleQueue()
+        log.listener = FlushingQueueListener(records, stdoutHandler, fileHandler, flushInterval=fileHandler.flushInterval, respect_handler_level=True)
+        log.listener.start()
+        log.addHandler(LightweightQueueHandler(records))
+        atexit.register(log.close)
 
         log.setLevel(logging.DEBUG)
         return log
+
+    def addSink(self, handler):
+        """
+        Adds a handler to be run on the listener's thread, for every record logged.
+        """
+        self.listener.handlers = self.listener.handlers + (handler,)
+
+    def removeSink(self, handler):
+        self.listener.handlers = tuple(h for h in self.listener.handlers if h is not handler)
+
+    def close(self):
+        """
+        Writes out any records still in the queue, then flushes and closes every sink.
+        """
+        if self.listener:
+            listener, self.listener = self.listener, None
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
@@ -12,7 +12,10 @@ from .version import VERSION
 from .resources import Resources
 from .loggers import ConsoleLogger
 from .config import get_config_var
+from .startupprofiler import startup_profiler
+from .core.profiling import profiler
 from .state.scan import ScanWorker
+from .state.control import ScanWorkerController
 from .gui.darkpalette import DarkPalette
 from .gui.mainwindow import MainWindow
 from .gui.initnaps2dialog import InitNAPS2Dialog
@@ -23,6 +26,7 @@ class MainApplication(QApplication):
 
     def __init__(self, argv):
         super().__init__(argv)
+        startup_profiler.mark('qapplication')
 
         self.setApplicationName('FScan')
         self.setStyle('Fusion')
@@ -41,6 +45,7 @@ class MainApplication(QApplication):
         self.main = MainWindow()
         self.main.setWindowIcon(self.r.iconApp)
         self.main.show()
+        startup_profiler.mark('window')
 
         self.exceptionDialog = None
         sys.excepthook = self.handleGlobalException
@@ -54,13 +59,25 @@ class MainApplication(QApplication):
         controls.scan.configureRequested.connect(self.onConfigureRequested)
         controls.scan.configureProfilesRequested.connect(self.onConfigureProfilesRequested)
         controls.scan.scanRequested.connect(self.onScanRequested)
+        controls.scan.cancelScanRequested.connect(self.onCancelScanRequested)
         self.scan_worker.stateChanged.connect(controls.scan.onScanWorkerStateChanged)
+        self.scan_worker.scanProgressed.connect(controls.scan.onScanProgressed)
+        controls.collection.collectionSelected.connect(self.onCollectionSelected)
+        self.scan_worker.collectionChanged.connect(controls.collection.onCollectionChanged)
+        self.scan_worker.itemCommitted.connect(controls.collection.onItemCommitted)
+        self.scan_worker.collectionChanged.connect(self.main.w.recent.onCollectionChanged)
+        self.scan_worker.itemCommitted.connect(self.main.w.recent.onItemCommitted)
+        self.main.w.recent.imageSelected.connect(self.main.w.workarea.loadImage)
+
+        # If API_PORT is set, other programs can drive scans over a local HTTP API
+        self.control = ScanWorkerController.from_config(self.scan_worker)
 
         self.init_naps2_dialog = None
         self.configure_profiles_dialog = None
 
         g.log.info('FScan v%s | %s | %s' % (VERSION, time.strftime('%r | %A, %B %d, %Y'), socket.gethostname()))
         g.log.debug('Running from %s%s' % (sys.executable, ' (frozen)' if hasattr(sys, 'frozen') else ''))
+        profiler.start_from_config('session')
 
         if True:
             self.scan_worker.crashed.connect(self.onThreadCrash)
@@ -69,15 +86,26 @@ class MainApplication(QApplication):
             self.scan_thread.started.connect(self.scan_worker.start)
             self.scan_thread.finished.connect(self.quit)
             self.aboutToQuit.connect(self.onUserQuit)
-            self.scan_thread.start()
+            self.main.firstPainted.connect(self.onFirstPaint)
         else:
             self.scan_worker.run()
 
+    def onFirstPaint(self):
+        # Don't start initializing the scan worker until the window is up
+        startup_profiler.mark('first paint')
+        self.scan_thread.start()
+
     def onUserQuit(self):
         if self.scan_thread and self.scan_worker:
             self.scan_worker.stop()
             self.scan_thread.quit()
             self.scan_thread.wait()
+        # Only once the worker is done emitting the events it publishes
+        if self.control:
+            self.control.stop()
+        self.main.w.recent.thumbnails.shutdown()
+        self.main.w.workarea.shutdown()
+        profiler.stop()
 
     def onPromptInstall(self, suggested_install):
         if suggested_install:
@@ -88,8 +116,8 @@ class MainApplication(QApplication):
             g.log.debug('No existing NAPS2 installation found.')
         self.showInitNAPS2Dialog(suggested_install)
 
-    def onPromptConfigureProfiles(self, install, profile_config):
-        self.showConfigureProfilesDialog(install, profile_config)
+    def onPromptConfigureProfiles(self, install, profile_config, scanner_count):
+        self.showConfigureProfilesDialog(install, profile_config, scanner_count)
 
     def onConfigureRequested(self):
         self.scan_worker.requestConfigure()
@@ -97,8 +125,14 @@ class MainApplication(QApplication):
     def onConfigureProfilesRequested(self):
         self.scan_worker.requestConfigureProfiles()
     
-    def onScanRequested(self):
-        self.scan_worker.requestScan(is_front=True)
+    def onScanRequested(self, is_front, count):
+        self.scan_worker.requestScan(is_front=is_front, count=count)
+
+    def onCancelScanRequested(self):
+        self.scan_worker.requestCancelScan()
+
+    def onCollectionSelected(self, dirpath):
+        self.scan_worker.requestSetCollection(dirpath)
 
     def showInitNAPS2Dialog(self, install):
         if self.init_naps2_dialog or self.configure_profiles_dialog:
@@ -125,11 +159,11 @@ class MainApplication(QApplication):
             self.init_naps2_dialog = None
             self.scan_worker.setNAPS2Install(install)
 
-    def showConfigureProfilesDialog(self, install, profile_config):
+    def showConfigureProfilesDialog(self, install, profile_config, scanner_count=1):
         if self.init_naps2_dialog or self.configure_profiles_dialog:
             return
 
-        self.configure_profiles_dialog = ConfigureProfilesDialog(install, profile_config)
+        self.configure_profiles_dialog = ConfigureProfilesDialog(install, profile_config, scanner_count)
         self.configure_profiles_dialog.finished.connect(self.onConfigureProfilesDialogClosed)
         self.configure_profiles_dialog.show()
 
@@ -1,14 +1,38 @@
 import html
 import logging
+import threading
+from collections import deque
 
 from PySide6.QtCore import QObject, Signal
 
 
 class RichTextHandlerObject(QObject):
-    wroteLine = Signal(str)
+    """
+    Holds lines written by a RichTextHandler (from any thread) until the GUI thread
+    takes them. linesPending is only emitted when the buffer goes from empty to
+    non-empty, so a flood of records costs one queued signal per batch rather than one
+    per line. At most maxlen lines are held: if the GUI falls behind, the oldest lines
+    are dropped, since they'd have been scrolled out of the console anyway.
+    """
+    linesPending = Signal()
 
-    def __init__(self):
+    def __init__(self, maxlen=None):
         super().__init__()
+        self._lines = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def push(self, line):
+        with self._lock:
+            was_empty = not self._lines
+            self._lines.append(line)
+        if was_empty:
+            self.linesPending.emit()
+
+    def take(self):
+        with self._lock:
+            lines = list(self._lines)
+            self._lines.clear()
+        return lines
 
 
 class RichTextHandler(logging.Handler):
@@ -27,7 +51,7 @@ class RichTextHandler(logging.Handler):
 
     def emit(self, record):
         rtf_line = self.format(record)
-        self.obj.wroteLine.emit(rtf_line)
+        self.obj.push(rtf_line)
 
     def format(self, record):
         style = self._getStyle(record.levelno)
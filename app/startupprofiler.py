@@ -0,0 +1,48 @@
+import sys
+import time
+import threading
+
+from . import g
+from .config import get_config_var
+
+
+class StartupProfiler:
+    """
+    Records how long each phase of application startup takes. Call mark() at the end of
+    each phase, with the phase's name; report() then logs the timings, once. Marks may
+    be recorded from any thread, including before logging is set up.
+
+    Enabled by running with --profile-startup, or by setting PROFILE_STARTUP=1.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.enabled = '--profile-startup' in sys.argv or get_config_var('PROFILE_STARTUP', '0') not in ('', '0')
+        self.marks = []
+        self.reported = False
+        self._last_mark_at = self.started_at
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str):
+        if not self.enabled or self.reported:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            self.marks.append((phase, now - self._last_mark_at, now - self.started_at))
+            self._last_mark_at = now
+
+    def report(self):
+        with self._lock:
+            if not self.enabled or self.reported:
+                return
+            self.reported = True
+            marks = list(self.marks)
+
+        g.log.info('Startup timings:')
+        for phase, elapsed, total in marks:
+            g.log.info('  %-14s %8.1f ms  (at %8.1f ms)' % (phase, elapsed * 1000, total * 1000))
+
+
+# Created as soon as this module is first imported: main.py imports it before anything
+# else, so that the 'imports' phase covers loading the rest of the application
+startup_profiler = StartupProfiler()
@@ -0,0 +1,139 @@
+from PySide6.QtCore import Qt
+
+from .. import g
+from ..config import get_config_var
+from ..core.controlserver import ControlServer
+from .scan import ScanWorker
+
+
+class ScanWorkerController:
+    """
+    Connects a ScanWorker to a ControlServer: API requests are turned into worker
+    requests, and the worker's signals are published to API clients as events. Signals
+    are connected directly, so events are published from whichever thread emits them,
+    without a trip through the Qt event loop.
+    """
+
+    def __init__(self, worker: ScanWorker):
+        self.worker = worker
+        self.server = None
+
+    @classmethod
+    def from_config(cls, worker: ScanWorker):
+        """
+        Returns a controller with its server started if API_PORT is configured, or None
+        otherwise. The server only listens on localhost unless API_HOST is set, and
+        requires a bearer token if API_TOKEN is set.
+        """
+        value = get_config_var('API_PORT')
+        if not value:
+            return None
+        try:
+            port = int(value)
+        except ValueError:
+            g.log.error('Not starting the control API: invalid API_PORT: %s' % value)
+            return None
+        controller = cls(worker)
+        controller.start(get_config_var('API_HOST', '127.0.0.1'), port, get_config_var('API_TOKEN') or None)
+        return controller
+
+    def start(self, host: str, port: int, token=None):
+        self.server = ControlServer(self, host, port, token)
+        for signal, slot in self._get_connections():
+            signal.connect(slot, Qt.DirectConnection)
+        self.server.start()
+
+    def stop(self):
+        # Signals can still be emitted from worker and pipeline threads while the worker
+        # shuts down, so the handlers let go of the server before it's stopped
+        server, self.server = self.server, None
+        if server:
+            for signal, slot in self._get_connections():
+                signal.disconnect(slot)
+            server.stop()
+
+    def _get_connections(self):
+        worker = self.worker
+        return [
+            (worker.stateChanged, self.onStateChanged),
+            (worker.jobQueued, self.onJobQueued),
+            (worker.scanProgressed, self.onScanProgressed),
+            (worker.jobScanned, self.onJobScanned),
+            (worker.jobSplit, self.onJobSplit),
+            (worker.jobDropped, self.onJobDropped),
+            (worker.itemCommitted, self.onItemCommitted),
+            (worker.jobFailed, self.onJobFailed),
+            (worker.collectionChanged, self.onCollectionChanged),
+        ]
+
+    def _publish(self, event_type: str, **fields):
+        server = self.server
+        if server:
+            server.publish(event_type, **fields)
+
+    # ScanController interface, called from the server's thread
+
+    def submit_scan(self, is_front, count):
+        return self.worker.requestScan(is_front, count)
+
+    def cancel(self):
+        self.worker.requestCancelScan()
+
+    def configure(self):
+        # Never opens a dialog: nobody may be at the station to answer it
+        self.worker.requestReinitialize()
+
+    def set_collection(self, dirpath):
+        self.worker.requestSetCollection(dirpath)
+
+    def get_status(self):
+        worker = self.worker
+        profile_config = worker.profile_config
+        return {
+            'state': worker.state.name.lower(),
+            'naps2_app_dir': worker.install.app_dir if worker.install else None,
+            'front_profile': profile_config.front_profile_name if profile_config else None,
+            'back_profile': profile_config.back_profile_name if profile_config else None,
+            'scanners': [scanner.name for scanner in worker.pipeline.scanners],
+            'collection': worker.collection.dirpath if worker.collection else None,
+            'depths': worker.pipeline.depths,
+        }
+
+    # ScanWorker signal handlers, called from worker and pipeline threads
+
+    def onStateChanged(self, state, install, profile_config, depths):
+        self._publish('state', state=state.name.lower(), depths=depths)
+
+    def onJobQueued(self, job):
+        self._publish('queued', job=job.job_id, side='front' if job.is_front else 'back', count=job.count)
+
+    def onScanProgressed(self, job, progress):
+        self._publish('progress', job=job.job_id, scanner=job.scanner, page=progress.page, kind=progress.kind.name.lower(), message=progress.message)
+
+    def onJobScanned(self, job, pages):
+        self._publish('scanned', job=job.job_id, scanner=job.scanner, pages=pages)
+
+    def onJobSplit(self, job, photos):
+        self._publish('split', job=job.job_id, scanner=job.scanner, page=job.page, photos=photos)
+
+    def onJobDropped(self, job):
+        self._publish('dropped', job=job.job_id, scanner=job.scanner, page=job.page)
+
+    def onItemCommitted(self, job, item):
+        image = item.front if job.is_front else item.back
+        self._publish('committed', job=job.job_id, scanner=job.scanner, page=job.page, photo=job.region, item={
+            'seq': item.seq,
+            'side': image.side,
+            'path': job.collection.get_abspath(image),
+            'sha256': image.sha256,
+            'width': image.width,
+            'height': image.height,
+            'duplicate_of': image.duplicate_of,
+            'derivatives': job.collection.get_derivative_abspaths(image),
+        })
+
+    def onJobFailed(self, job_id, page, reason):
+        self._publish('failed', job=job_id, page=page, error=reason)
+
+    def onCollectionChanged(self, collection):
+        self._publish('collection', path=collection.dirpath if collection else None)
@@ -1,23 +1,31 @@
+import os
 import time
+import sqlite3
 import traceback
 from enum import Enum
 from dataclasses import dataclass
 from queue import Queue
+from typing import Optional
 
 from PySide6.QtCore import QObject, Signal, Slot
 
 from .. import g
-from ..config import get_config_var
+from ..config import get_config_var, update_config
+from ..core.collection import Collection
+from ..core.journal import JobJournal
+from ..core.metrics import MetricsExporter, metrics
 from ..core.naps2.data import NAPS2Install, ProfileConfig
 from ..core.naps2.install import set_configured_naps2_install, get_configured_naps2_install, get_suggested_naps2_install, install_naps2_portable
-from ..core.naps2.profile import get_profile_config, set_profile_config
-from ..core.naps2.scan import invoke_naps2_scan
+from ..core.naps2.profile import get_profile_configs, set_profile_config
+from ..core.pipeline import ScanPipeline, Scanner
+from ..core.profiling import profiler
+from ..startupprofiler import startup_profiler
 
 class ScanWorkerState(Enum):
     UNINITIALIZED = 1  # No NAPS2 paths have been configured
     NO_PROFILES   = 2  # NAPS2 is installed but we have no valid scan profile names selected
     READY_TO_SCAN = 3  # Configured and idle, ready to begin a new scan
-    SCANNING = 4       # Currently running a scan
+    SCANNING = 4       # Currently running a scan, possibly with more scans queued
 
 
 @dataclass
@@ -25,13 +33,44 @@ class ExitCommand:
     pass
 
 
+def _open_collection(dirpath: str) -> Optional[Collection]:
+    try:
+        collection = Collection(dirpath)
+    except (OSError, sqlite3.Error) as exc:
+        g.log.error('Failed to open collection at %s: %s' % (dirpath, exc))
+        return None
+    g.log.info('Opened collection at %s (next item: #%d).' % (collection.dirpath, collection.next_seq()))
+    return collection
+
+
 @dataclass
 class InitScanCommand:
+    # If not, a missing NAPS2 installation is only logged, rather than prompting for one
+    prompt: bool = True
+
+    # Replaces the scanners, so it has to wait until no scans are queued or running
+    waits_for_scans = True
+
     def run(self, worker):
+        # The collection we scan into is independent of NAPS2 configuration: open it
+        # first, if one is configured
+        collection_dir = get_config_var('COLLECTION_DIR')
+        if collection_dir and not worker.collection:
+            worker.setCollection(_open_collection(collection_dir))
+
+        # Finish off anything a previous session scanned but didn't get to commit: this
+        # only needs the collection, not NAPS2
+        if not worker.recovered:
+            worker.recovered = True
+            worker.pipeline.recover(worker.getCollectionForRecovery)
+
         worker.setInstall(None)
-        worker.setProfileConfig(None)
+        worker.setProfileConfigs([])
 
         install: Optional[NAPS2Install] = get_configured_naps2_install()
+        if not install and not self.prompt:
+            g.log.warning('NAPS2 installation is not configured.')
+            return
         if not install:
             # Open a dialog prompting the user to configure a NAPS2 installation: and
             # wait a beat so we don't open a dialog immediately on application startup
@@ -41,11 +80,19 @@ class InitScanCommand:
             return
         worker.setInstall(install)
 
-        profile_config: Optional[ProfileConfig] = get_profile_config(install.data_dir)
-        if not profile_config:
+        profile_configs: list[ProfileConfig] = get_profile_configs(install.data_dir)
+        if not profile_configs:
             # open 'Configure Profiles' dialog
             return
-        worker.setProfileConfig(profile_config)
+        worker.setProfileConfigs(profile_configs)
+
+
+@dataclass
+class RunDeferredCommand:
+    def run(self, worker):
+        commands, worker.deferred_commands = worker.deferred_commands, []
+        for command in commands:
+            worker.command_queue.put(command)
 
 
 @dataclass
@@ -60,6 +107,8 @@ class ConfigureScanCommand:
 @dataclass
 class SetInstallCommand:
     install: NAPS2Install
+    waits_for_scans = True
+
     def run(self, worker):
         set_configured_naps2_install(self.install)
         g.log.info('Now using NAPS2 installation at %s.' % self.install.app_dir)
@@ -77,6 +126,16 @@ class AutoInstallCommand:
         worker.command_queue.put(SetInstallCommand(install))
 
 
+@dataclass
+class SetCollectionCommand:
+    dirpath: str
+    def run(self, worker):
+        collection = _open_collection(self.dirpath)
+        if collection:
+            update_config({'COLLECTION_DIR': collection.dirpath})
+            worker.setCollection(collection)
+
+
 @dataclass
 class ConfigureProfilesCommand:
     def run(self, worker):
@@ -84,30 +143,31 @@ class ConfigureProfilesCommand:
             g.log.error('NAPS2 installation is not configured.')
             return
 
-        worker.promptConfigureProfilesRequested.emit(worker.install, worker.profile_config)
+        worker.promptConfigureProfilesRequested.emit(worker.install, worker.profile_config, len(worker.profile_configs))
 
 
 @dataclass
 class ScanCommand:
     is_front: bool
+    count: int = 1
+    job_id: Optional[int] = None
     def run(self, worker):
+        reason = None
         if not worker.install:
-            g.log.warning('Scan command ignored! NAPS2 integration not configured.')
-            return
-        if not worker.profile_config:
-            g.log.warning('Scan command ignored! NAPS2 profiles are not configured.')
+            reason = 'NAPS2 integration not configured.'
+        elif not worker.profile_config:
+            reason = 'NAPS2 profiles are not configured.'
+        elif not worker.collection:
+            reason = 'No collection is selected.'
+        if reason:
+            g.log.warning('Scan command ignored! %s' % reason)
+            worker.jobFailed.emit(self.job_id, None, reason)
             return
-        if worker.is_scanning:
-            g.log.warning('Scan command ignored! Scanning already in progress.')
-            return
-
-        profile_name = worker.profile_config.front_profile_name if self.is_front else worker.profile_config.back_profile_name
 
-        worker.is_scanning = True
-        worker.stateChanged.emit(worker.state, worker.install, worker.profile_config)
-        invoke_naps2_scan(worker.install, profile_name, 'E:\\fscan_files\\test\\scan_001.png')
-        worker.is_scanning = False
-        worker.stateChanged.emit(worker.state, worker.install, worker.profile_config)
+        # Hand the scan off to the pipeline: if every scanner is already busy, this one
+        # is queued to run on whichever scanner frees up first
+        job = worker.pipeline.submit(self.is_front, worker.collection, self.count, self.job_id)
+        worker.jobQueued.emit(job)
 
 
 class ScanWorker(QObject):
@@ -115,9 +175,17 @@ class ScanWorker(QObject):
     crashed = Signal(str)
 
     promptInstallRequested = Signal(object)
-    promptConfigureProfilesRequested = Signal(object, object)
-
-    stateChanged = Signal(object, object, object)
+    promptConfigureProfilesRequested = Signal(object, object, int)
+
+    stateChanged = Signal(object, object, object, object)
+    scanProgressed = Signal(object, object)
+    collectionChanged = Signal(object)
+    itemCommitted = Signal(object, object)
+    jobScanned = Signal(object, int)
+    jobSplit = Signal(object, int)
+    jobDropped = Signal(object)
+    jobQueued = Signal(object)
+    jobFailed = Signal(object, object, str)
 
     def __init__(self):
         super().__init__()
@@ -127,8 +195,16 @@ class ScanWorker(QObject):
 
         self.install = None
         self.profile_config = None
-        self.is_scanning = False
-    
+        self.profile_configs = []
+        self.collection = None
+        self.recovered = False
+        self.deferred_commands = []
+        self.pipeline = ScanPipeline(on_depth_changed=self.emitStateChanged, on_progress=self.scanProgressed.emit, on_committed=self.itemCommitted.emit, on_failed=self.onJobFailed, journal=JobJournal.from_config(), on_scanned=self.jobScanned.emit, on_split=self.jobSplit.emit, on_dropped=self.jobDropped.emit)
+
+    @property
+    def is_scanning(self):
+        return self.pipeline.scan_stage.depth > 0
+
     @property
     def state(self):
         if not self.install:
@@ -138,13 +214,37 @@ class ScanWorker(QObject):
         return ScanWorkerState.SCANNING if self.is_scanning else ScanWorkerState.READY_TO_SCAN
 
     def setInstall(self, install):
-        assert self.state != ScanWorkerState.SCANNING
         self.install = install
-        self.stateChanged.emit(self.state, self.install, self.profile_config)
-
-    def setProfileConfig(self, config):
-        self.profile_config = config
-        self.stateChanged.emit(self.state, self.install, self.profile_config)
+        self.emitStateChanged()
+
+    def setProfileConfigs(self, configs):
+        """
+        Sets the profile config for each attached scanner: the first is the one shown in
+        the GUI (and edited by the Configure Profiles dialog).
+        """
+        self.profile_configs = configs
+        self.profile_config = configs[0] if configs else None
+        self.pipeline.set_scanners([Scanner.from_profile_config(self.install, config) for config in configs])
+        self.emitStateChanged()
+
+    def setCollection(self, collection):
+        self.collection = collection
+        self.collectionChanged.emit(self.collection)
+
+    def getCollectionForRecovery(self, dirpath):
+        if self.collection and os.path.normcase(self.collection.dirpath) == os.path.normcase(os.path.normpath(dirpath)):
+            return self.collection
+        return _open_collection(dirpath)
+
+    def onJobFailed(self, job, reason):
+        self.jobFailed.emit(job.job_id, job.page, reason)
+
+    def emitStateChanged(self):
+        # Called from the pipeline's threads whenever a stage's depth changes: once the
+        # last scan is done, run whatever was waiting for it
+        if self.deferred_commands and not self.is_scanning:
+            self.command_queue.put(RunDeferredCommand())
+        self.stateChanged.emit(self.state, self.install, self.profile_config, self.pipeline.depths)
 
     @Slot()
     def start(self):
@@ -166,16 +266,58 @@ class ScanWorker(QObject):
     def requestConfigure(self):
         self.command_queue.put(ConfigureScanCommand())
 
+    def requestReinitialize(self):
+        """
+        Re-detects the NAPS2 installation and profiles, without prompting for anything.
+        """
+        self.command_queue.put(InitScanCommand(prompt=False))
+
+    def requestSetCollection(self, dirpath):
+        self.command_queue.put(SetCollectionCommand(dirpath))
+
     def requestConfigureProfiles(self):
         self.command_queue.put(ConfigureProfilesCommand())
 
-    def requestScan(self, is_front):
-        self.command_queue.put(ScanCommand(is_front))
+    def requestScan(self, is_front, count=1) -> int:
+        """
+        Queues a scan, returning the ID that its job will have. Safe to call from any
+        thread.
+        """
+        job_id = self.pipeline.allocate_job_id()
+        self.command_queue.put(ScanCommand(is_front, count, job_id))
+        return job_id
+
+    def requestCancelScan(self):
+        # Bypasses the command queue, since the whole point is to interrupt work that's
+        # already in progress
+        self.pipeline.cancel()
 
     def run(self):
-        while True:
-            command = self.command_queue.get()
-            if isinstance(command, ExitCommand):
-                break
-            command.run(self)
+        exporter = MetricsExporter.from_config(metrics)
+        if exporter:
+            exporter.start()
+        self.pipeline.start()
+        try:
+            while True:
+                command = self.command_queue.get()
+                if isinstance(command, ExitCommand):
+                    break
+                if getattr(command, 'waits_for_scans', False) and self.is_scanning:
+                    if not self.deferred_commands:
+                        g.log.info('Waiting for queued scans to finish before reconfiguring NAPS2.')
+                    self.deferred_commands.append(command)
+                    if not self.is_scanning:
+                        # The last scan finished between checking and deferring
+                        self.command_queue.put(RunDeferredCommand())
+                    continue
+                name = type(command).__name__
+                with metrics.time('fscan_command_seconds', command=name), profiler.command(name):
+                    command.run(self)
+                if isinstance(command, InitScanCommand):
+                    startup_profiler.mark('worker init')
+                    startup_profiler.report()
+        finally:
+            self.pipeline.stop()
+            if exporter:
+                exporter.stop()
         self.finished.emit()
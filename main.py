@@ -1,4 +1,18 @@
-from app.mainapplication import MainApplication
+import sys
+import multiprocessing
+
+from app.startupprofiler import startup_profiler
 
 if __name__ == '__main__':
+    # Required for post-processing worker processes to start in a frozen build
+    multiprocessing.freeze_support()
+
+    # 'main.py scan ...' etc. runs the headless CLI, without loading Qt at all
+    from app.cli import COMMANDS
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        from app.cli import main
+        sys.exit(main(sys.argv[1:]))
+
+    from app.mainapplication import MainApplication
+    startup_profiler.mark('imports')
     MainApplication.run()